@@ -1,7 +1,24 @@
-from flask import Flask, render_template, jsonify
+from flask import Flask, Response, render_template, jsonify, abort, request, send_from_directory
+import hmac
+import json
 import logging
+import threading
+import time
+import numpy as np
 from pymongo import MongoClient
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit
+import os
+import sys
+
+# Trace codec is shared with the acquisition side in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from IFSS_Storage import (AxisCache, BUCKET_SECONDS, decode_trace, decode_frequencies, document_axis_id,
+                          spectrogram_rows, pool_spectrogram)
+from IFSS_Control import send_command
+from IFSS_Live import subscribe
 
 # Logging setup
 for handler in logging.root.handlers[:]:
@@ -14,51 +31,146 @@ client = MongoClient('mongodb://localhost:27017/')
 db = client["ifss"]
 spectrumData = db["spectrumData"]
 satSchedule = db["satSchedule"]
+spectrumAxis = db["spectrumAxis"]
+spectrumBuckets = db["spectrumBuckets"]
+spectrumMinute = db["spectrumMinute"]
+axisCache = AxisCache(spectrumAxis)
+
+# Seconds between SSE comments on an idle /live stream, so dropped clients are noticed
+LIVE_KEEPALIVE = 15
+# Version of the /axis/<id> descriptor layout, part of its ETag
+AXIS_DESCRIPTOR_VERSION = 1
+# /spectrogram grid size when the client does not ask for one, and the most it may ask for
+SPECTROGRAM_SIZE = (720, 1024)
+SPECTROGRAM_MAX_SIZE = 4096
+# Pass tile pyramids rendered by IFSS_Tiles.py (its TILE_DIR). A rendered pass never changes
+TILE_DIR = '/home/its/IFSS/tiles'
+TILE_MAX_AGE = 7 * 86400
+# Seconds a cached /daily-schedule is served before checking for a newly ingested satSchedule document
+SCHEDULE_RECHECK = 30
+# POST /control/<command> (pause, resume, skip) is an operator-only interface: it is served to
+# loopback clients, and to others only with this shared token (IFSS_CONTROL_TOKEN in the
+# gunicorn environment) in an X-IFSS-Token header. Cross-site requests are refused by Origin.
+CONTROL_TOKEN = os.environ.get('IFSS_CONTROL_TOKEN')
+LOOPBACK = ('127.0.0.1', '::1')
+
+class LiveRelay:
+    '''
+    Follow the IFSS live feed (IFSS_Live.py) on one background thread per worker process and
+    keep the latest trace as (seq, SSE payload, float32 trace bytes, axis id, timestamp, sat). Every
+    /live and /trace/latest.bin client of the worker is served from it, so a trace is decoded
+    once however many browsers are open.
+    '''
+
+    def __init__(self):
+        self.latest = None
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def ensure_started(self):
+        with self._condition:
+            # Started on first use so every gunicorn worker runs its own after the fork
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="LiveRelay", daemon=True)
+                self._thread.start()
+
+    def wait(self, seen, timeout):
+        '''The latest trace once its seq differs from seen, or whatever is latest after timeout.'''
+        with self._condition:
+            self._condition.wait_for(lambda: self.latest is not None and self.latest[0] != seen, timeout)
+            return self.latest
+
+    def _run(self):
+        for message in subscribe():
+            try:
+                values = decode_trace(message).astype('<f4').tobytes()
+            except Exception as e:
+                logging.error(f"Live trace {message.get('seq')} could not be relayed: {e}")
+                continue
+            # Only a notification, the trace itself is fetched from /trace/latest.bin
+            payload = json.dumps({key: message[key] for key in ("seq", "timestamp", "sat", "acqStatus", "axisId")})
+            with self._condition:
+                self.latest = (message["seq"], payload, values, message["axisId"], message["timestamp"], message["sat"])
+                self._condition.notify_all()
+
+liveRelay = LiveRelay()
+
+class ScheduleCache:
+    '''
+    Today's schedule rows as a ready JSON body and its ETag, rebuilt only when IFSS.py has ingested a
+    new satSchedule document or the UTC day has changed. Whether one was ingested is checked at most every
+    SCHEDULE_RECHECK seconds, with an index-only lookup of the newest _id; polls in between never touch MongoDB.
+    '''
+
+    def __init__(self, satSchedule):
+        self.satSchedule = satSchedule
+        self.day = self.latest = self.body = self.tag = None
+        self.checked = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        '''(ETag, JSON body) of today's schedule.'''
+        with self._lock:
+            now = datetime.utcnow()
+            day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+            if day != self.day or time.monotonic() - self.checked >= SCHEDULE_RECHECK:
+                query = {"timestamp": {"$gte": day, "$lt": day + timedelta(days=1)}}
+                newest = self.satSchedule.find_one(query, {"_id": 1}, sort=[("timestamp", -1)])
+                latest = newest["_id"] if newest else None
+                if day != self.day or latest != self.latest:
+                    self.body = json.dumps(self._rows(query, day.date()))
+                    self.tag = f"{day:%Y%m%d}-{latest or 'none'}"
+                    self.day, self.latest = day, latest
+                self.checked = time.monotonic()
+            return self.tag, self.body
+
+    def _rows(self, query, today):
+        # The fetched schedule covers 48 hours, only the passes starting on the current UTC day are served
+        schedules_list = []
+        for document in self.satSchedule.find(query).sort("timestamp", 1):
+            document_id = str(document["_id"])
+            if "schedule" in document:
+                for schedule in document["schedule"]:
+                    if schedule_date(schedule.get("startDate")) not in (today, None):
+                        continue
+                    extracted_schedule = {
+                        "item": schedule.get("item"),
+                        "dir": schedule.get("dir"),
+                        "el": schedule.get("el"),
+                        "endDate": schedule.get("endDate"),
+                        "endTime": schedule.get("endTime"),
+                        "idle": schedule.get("idle"),
+                        "mode": schedule.get("mode"),
+                        "ovr": schedule.get("ovr"),
+                        "sat": schedule.get("sat"),
+                        "startDate": schedule.get("startDate"),
+                        "startTime": schedule.get("startTime"),
+                    }
+                    schedules_list.append(extracted_schedule)
+            else:
+                logging.info(f"Document {document_id} contains no schedule data.")
+        logging.info(f"Daily schedule cache rebuilt: {len(schedules_list)} rows")
+        return schedules_list
+
+def schedule_date(value):
+    '''Date of a schedule startDate in either format the schedule export uses, None if unrecognised.'''
+    for fmt in ('%Y-%m-%d', '%d-%b-%Y'):
+        try:
+            return datetime.strptime(str(value).strip(), fmt).date()
+        except ValueError:
+            pass
+    return None
+
+scheduleCache = ScheduleCache(satSchedule)
 
 @app.route('/daily-schedule')
 def daily_schedule():
-    # print('Running daily-schedule')
-    utc_now = datetime.utcnow()
-    today_start = utc_now.replace(hour=0, minute=0, second=0, microsecond=0)
-    today_end = today_start + timedelta(days=1)
-
-    schedules_today = satSchedule.find({
-        "timestamp": {
-            "$gte": today_start,
-            "$lt": today_end
-        }
-    })
-    query = {
-        "timestamp": {
-            "$gte": today_start,
-            "$lt": today_end
-        }
-    }
-
-    schedules_list = []
-    for document in schedules_today:
-        document_id = str(document["_id"])
-        if "schedule" in document:
-            for schedule in document["schedule"]:
-                extracted_schedule = {
-                    "item": schedule.get("item"),
-                    "dir": schedule.get("dir"),
-                    "el": schedule.get("el"),
-                    "endDate": schedule.get("endDate"),
-                    "endTime": schedule.get("endTime"),
-                    "idle": schedule.get("idle"),
-                    "mode": schedule.get("mode"),
-                    "ovr": schedule.get("ovr"),
-                    "sat": schedule.get("sat"),
-                    "startDate": schedule.get("startDate"),
-                    "startTime": schedule.get("startTime"),
-                }
-                schedules_list.append(extracted_schedule)
-                # logging.info("Added schedule: %s", extracted_schedule)
-        else:
-            logging.info(f"Document {document_id} contains no schedule data.")
-
-    return jsonify(schedules_list)
+    '''Today's schedule rows. Polls that send the ETag back get a 304 until a new schedule is ingested or the day changes.'''
+    tag, body = scheduleCache.get()
+    headers = {"ETag": f'"{tag}"', "Cache-Control": "no-cache"}
+    if request.if_none_match.contains(tag):
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype='application/json', headers=headers)
 
 @app.route('/')
 def index():
@@ -66,10 +178,200 @@ def index():
 
 @app.route('/data')
 def data():
-    document = spectrumData.find().sort([('_id', -1)]).limit(1)
+    document = spectrumData.find().sort([('timestamp', -1)]).limit(1)
     for doc in document:
-        return jsonify(doc['frequencies'])
+        # Packed traces are expanded back to the {MHz: dBm} shape the page expects
+        if 'trace' not in doc:
+            return jsonify(doc['frequencies'])
+        frequencies = decode_frequencies(doc, axisCache.get(document_axis_id(doc)))
+        values = decode_trace(doc)
+        return jsonify(dict(zip((str(round(freq, 4)) for freq in frequencies.tolist()), values.tolist())))
     return jsonify({})
 
+@app.route('/live')
+def live():
+    '''Server-Sent Events stream of new traces, each sent once with its feed sequence number as the event id.'''
+    liveRelay.ensure_started()
+    last = request.headers.get('Last-Event-ID')
+
+    def stream():
+        seen = int(last) if last and last.isdigit() else None
+        yield "retry: 2000\n\n"
+        while True:
+            latest = liveRelay.wait(seen, LIVE_KEEPALIVE)
+            if latest is None or latest[0] == seen:
+                yield ": keepalive\n\n"
+                continue
+            seen, payload = latest[:2]
+            yield f"id: {seen}\nevent: trace\ndata: {payload}\n\n"
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/trace/latest.bin')
+def latest_trace():
+    '''
+    The latest trace as little-endian float32 dBm, its frequency axis in X-Axis-Id (see /axis/<id>).
+    Served from the live feed while IFSS runs, from spectrumData otherwise. ETag is the trace.
+    '''
+    liveRelay.ensure_started()
+    latest = liveRelay.latest
+    if latest is not None:
+        seq, _, values, axis_id, timestamp, sat = latest
+        tag = f"seq-{seq}"
+    else:
+        document = spectrumData.find_one({"trace": {"$exists": True}}, sort=[('timestamp', -1)])
+        if document is None:
+            return Response(status=204)
+        seq, values, axis_id = None, decode_trace(document).astype('<f4').tobytes(), str(document_axis_id(document))
+        timestamp, tag, sat = document["timestamp"].isoformat() + "Z", f"doc-{document['_id']}", document.get("meta", {}).get("sat", "")
+    headers = {"ETag": f'"{tag}"', "Cache-Control": "no-cache", "X-Axis-Id": axis_id, "X-Trace-Timestamp": timestamp,
+               "X-Trace-Sat": (sat or "").strip()}
+    if seq is not None:
+        headers["X-Trace-Seq"] = str(seq)
+    if request.if_none_match.contains(tag):
+        return Response(status=304, headers=headers)
+    return Response(values, mimetype='application/octet-stream', headers=headers)
+
+@app.route('/axis/<axis_id>')
+def axis_descriptor(axis_id):
+    '''Frequency axis of a trace: point i is at startFreq + i * stepFreq Hz. Axis documents never change, so neither does this.'''
+    try:
+        axis = axisCache.get(ObjectId(axis_id))
+    except Exception:
+        abort(404)
+    if axis is None:
+        abort(404)
+    tag = f"{axis_id}-v{AXIS_DESCRIPTOR_VERSION}"
+    headers = {"ETag": f'"{tag}"', "Cache-Control": "public, max-age=31536000, immutable"}
+    if request.if_none_match.contains(tag):
+        return Response(status=304, headers=headers)
+    descriptor = {"id": axis_id, "version": AXIS_DESCRIPTOR_VERSION,
+                  **{key: axis.get(key) for key in ("startFreq", "stepFreq", "length", "centerFreq", "span", "rbw", "refLevel")}}
+    return jsonify(descriptor), 200, headers
+
+def _utc(value):
+    '''Naive UTC datetime of an ISO string; one without an offset or Z is taken as UTC.'''
+    if len(value) > 19 and value[-6] == ' ':
+        # An unencoded +HH:MM offset arrives with the + decoded to a space
+        value = value[:-6] + '+' + value[-5:]
+    parsed = datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def _spectrogram_range(args):
+    '''(start, end, axisId) a /spectrogram request covers, from its scheduleRunId or start/end and axisId.'''
+    axis_id = ObjectId(args['axisId']) if 'axisId' in args else None
+    if 'scheduleRunId' in args:
+        query = {"scheduleRunId": ObjectId(args['scheduleRunId'])}
+        if axis_id is not None:
+            query["axisId"] = axis_id
+        first = spectrumBuckets.find_one(query, sort=[('start', 1)])
+        if first is not None:
+            last = spectrumBuckets.find_one(query, sort=[('start', -1)])
+            return first["start"], last["end"] + timedelta(milliseconds=1), axis_id or first["axisId"]
+        first = spectrumMinute.find_one(query, sort=[('minute', 1)])
+        if first is None:
+            return None
+        last = spectrumMinute.find_one(query, sort=[('minute', -1)])
+        return first["minute"], last["minute"] + timedelta(minutes=1), axis_id or first["axisId"]
+    start, end = _utc(args['start']), _utc(args['end'])
+    if axis_id is None:
+        # The configuration in use most recently within the range
+        latest = spectrumBuckets.find_one({"start": {"$lt": end}, "end": {"$gte": start}}, sort=[('start', -1)]) or \
+            spectrumMinute.find_one({"minute": {"$gte": start, "$lt": end}}, sort=[('minute', -1)])
+        if latest is None:
+            return None
+        axis_id = latest["axisId"]
+    return start, end, axis_id
+
+@app.route('/spectrogram')
+def spectrogram():
+    '''
+    Spectrogram of a pass (scheduleRunId) or of start..end (ISO UTC), pooled on the server to at most
+    height x width cells by max or mean (reduce). Time bins spanning a bucket or more read the buckets'
+    summary rows, so a day costs about as much as an hour. Little-endian float32 rows, NaN where no
+    traces were stored, described by the X- headers; format=json instead gives only the rows with data.
+    '''
+    args = request.args
+    reduce = args.get('reduce', 'max')
+    try:
+        height = min(int(args.get('height', SPECTROGRAM_SIZE[0])), SPECTROGRAM_MAX_SIZE)
+        width = min(int(args.get('width', SPECTROGRAM_SIZE[1])), SPECTROGRAM_MAX_SIZE)
+        covered = _spectrogram_range(args)
+    except (KeyError, ValueError, TypeError, InvalidId) as e:
+        return jsonify({"error": f"Bad spectrogram request: {e}"}), 400
+    if reduce not in ('max', 'mean') or height < 1 or width < 1:
+        return jsonify({"error": "reduce must be max or mean, height and width positive"}), 400
+    if covered is None:
+        return Response(status=204)
+    start, end, axis_id = covered
+    axis = axisCache.get(axis_id)
+    if axis is None or end <= start:
+        return Response(status=204)
+    row_seconds = (end - start).total_seconds() / height
+    loaded = spectrogram_rows(spectrumBuckets, spectrumMinute, axis_id, start, end, reduce, summaries=row_seconds >= BUCKET_SECONDS)
+    if loaded is None:
+        return Response(status=204)
+    grid, firsts, widths = pool_spectrogram(*loaded, start, end, height, width, reduce)
+    frequencies = axis["startFreq"] + (firsts + (widths - 1) / 2) * axis["stepFreq"]
+    if args.get('format') == 'json':
+        filled = np.flatnonzero(~np.isnan(grid[:, 0]))
+        times = np.datetime64(start, 'ms') + (filled * row_seconds * 1000).astype('timedelta64[ms]')
+        return jsonify({"axisId": str(axis_id), "reduce": reduce, "start": start.isoformat() + "Z", "end": end.isoformat() + "Z",
+                        "rowSeconds": row_seconds, "frequencies": (frequencies / 1e6).round(6).tolist(),
+                        "times": [str(t) + "Z" for t in times], "z": grid[filled].astype(np.float64).round(2).tolist()})
+    headers = {"X-Axis-Id": str(axis_id), "X-Reduce": reduce, "X-Rows": str(grid.shape[0]), "X-Columns": str(grid.shape[1]),
+               "X-Start": start.isoformat() + "Z", "X-End": end.isoformat() + "Z", "X-Row-Seconds": repr(row_seconds),
+               "X-Freq-First": repr(float(frequencies[0])), "X-Freq-Last": repr(float(frequencies[-1]))}
+    return Response(grid.astype('<f4').tobytes(), mimetype='application/octet-stream', headers=headers)
+
+@app.route('/passes')
+def passes():
+    return render_template('passes.html')
+
+@app.route('/tiles/days/<day>')
+def tile_day(day):
+    '''Rendered passes that started on a UTC day (YYYY-MM-DD). Grows during the day, so always revalidated.'''
+    return send_from_directory(os.path.join(TILE_DIR, 'days'), f"{day}.json", max_age=0)
+
+@app.route('/tiles/<scheduleRunId>/<axisId>/<path:name>')
+def tile(scheduleRunId, axisId, name):
+    '''manifest.json or <level>/<row>_<column>.png of a rendered pass, straight from disk.'''
+    return send_from_directory(TILE_DIR, f"{scheduleRunId}/{axisId}/{name}", max_age=TILE_MAX_AGE)
+
+def control_allowed():
+    '''Whether the request may change the running IFSS, see CONTROL_TOKEN.'''
+    origin = request.headers.get('Origin')
+    if origin is not None and urlsplit(origin).netloc != request.host:
+        return False
+    token = request.headers.get('X-IFSS-Token')
+    if CONTROL_TOKEN and token and hmac.compare_digest(token.encode(), CONTROL_TOKEN.encode()):
+        return True
+    return request.remote_addr in LOOPBACK
+
+@app.route('/control/status')
+def control_status():
+    return forward_control('status')
+
+@app.route('/control/<command>', methods=['POST'])
+def control(command):
+    '''Operator-only: pause, resume or skip captures, see CONTROL_TOKEN.'''
+    if command not in ('pause', 'resume', 'skip', 'status'):
+        abort(404)
+    if not control_allowed():
+        logging.info(f"Control {command} refused for {request.remote_addr} (origin {request.headers.get('Origin')})")
+        return jsonify({"ok": False, "error": "Operator token required"}), 403
+    return forward_control(command)
+
+def forward_control(command):
+    # Forwarded to the running IFSS over its control socket, see IFSS_Control.py
+    try:
+        reply = send_command(command)
+    except OSError as e:
+        logging.error(f"Control channel unavailable for {command}: {e}")
+        return jsonify({"ok": False, "error": "IFSS is not running"}), 503
+    return jsonify(reply), (200 if reply.get("ok") else 400)
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080, debug=False)
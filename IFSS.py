@@ -1,31 +1,39 @@
-import schedule
 import http.client
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timedelta, timezone, time
+from time import sleep, monotonic
 import logging
-from time import sleep
 from pymongo import MongoClient
 import IFSS_RSA
 import csv
 import re
 import pandas as pd
+import threading
+from IFSS_Scheduler import EventScheduler, PASS_WINDOW, row_window
+from IFSS_Storage import ensure_schedule_collection
 
 # MongoDB setup
 client = MongoClient('mongodb://localhost:27017/')
 db = client["ifss"]
-satSchedule = db["satSchedule"]
+satSchedule = ensure_schedule_collection(db)
+
+# IFSS_RSA.main() is started again this long after it stops, doubling per consecutive failure up to
+# MAIN_RETRY_MAX; a run that lasted longer than MAIN_RETRY_MAX starts the backoff over
+MAIN_RETRY_DELAY = 30
+MAIN_RETRY_MAX = 900
 
 # Reset the Root Logger and seup logging
 for handler in logging.root.handlers[:]:
     logging.root.removeHandler(handler)
 logging.basicConfig(filename='/home/its/IFSS/IFSS_SA.log', level=logging.INFO, format='%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
-# Fetch report is done daily using schedule at 00:06 UTC 
+# Fetch report is done daily using an EventScheduler at 00:06 UTC 
 # since AOML/IRC all run cronjobs @ 00:05UTC for 48 hour window schedules)  
 def fetchReport():
     '''
     Designed to fetch satellite schedule data from a selected earth station EOS-FES, 
-    parse the data to filter records for the current day since the schedule is a 48 hour window, 
+    parse the data to keep every pass that has not ended yet within the 48 hour window, 
     and then insert the records into a MongoDB db ('ifss') collection ('satSchedule').
+    The passes are merged into the running IFSS_RSA pass index, so capture never stops for the refresh.
 
     Sample Data vs regex (parts[])
     
@@ -69,7 +77,7 @@ def fetchReport():
                 data = response.read().decode('utf-8')
                 lines = data.splitlines()
                 
-                todaysDate = datetime.utcnow().strftime('%d-%b-%Y')
+                now = datetime.utcnow()
                 rows = []
 
                 # Process each line of the fetched data
@@ -82,8 +90,9 @@ def fetchReport():
                         # Otherwise continue processing schedule
                         if satellite_name in excluded_satellites:
                             continue
-                        startDate = parts[5]
-                        if startDate == todaysDate:
+                        # Full AOS/LOS datetimes so passes crossing 00:00 UTC are kept whole
+                        aos, los = row_window(parts)
+                        if los > now and aos < now + PASS_WINDOW:
                             record = {
                                 "item": parts[0],
                                 "sat": parts[1].strip(),
@@ -99,8 +108,8 @@ def fetchReport():
                             }
                             rows.append(record)
 
-                # Sort the schedule entries by start time
-                rows.sort(key=lambda x: x['startTime'])
+                # Sort the schedule entries by start date and time
+                rows.sort(key=lambda x: datetime.strptime(f"{x['startDate']} {x['startTime']}", '%d-%b-%Y %H:%M:%S'))
 
                 # Write the schedule to a CSV file
                 output_path = "/home/its/IFSS/Tools/Report_Exports/schedule.csv"
@@ -128,13 +137,8 @@ def fetchReport():
     except Exception as e:
         logging.info(f'An error occurred in fetchReport(): {e}')
 
-    # Call IFSS_RSA.main() outside the try-except block to ensure it's called in all scenarios
-    logging.info('Attempting to call IFSS_RSA.main()')
-    try:
-        IFSS_RSA.main()  # Ensure this is the correct call
-        logging.info('IFSS_RSA.main() called successfully')
-    except Exception as e:
-        logging.error(f'Failed to call IFSS_RSA.main(): {e}')
+    # Merge outside the try-except block to ensure it's done in all scenarios
+    merge_schedule()
 
 def fetchTMTR_Report():
         try:
@@ -181,11 +185,12 @@ def fetchTMTR_Report():
                     return 'Day' if 6 <= hour <= 18 else 'Night'
 
 
-                # Filter by the current UTC date
+                # Filter to today and tomorrow (UTC), the 48 hour rolling window
                 current_utc_date = datetime.now(timezone.utc).date()
                 #Works
                 df['Start Date'] = pd.to_datetime(df['Start Date'], utc=True).dt.date
-                df = df[df["Start Date"] == current_utc_date]
+                df['End Date'] = df['Start Date']
+                df = df[(df["Start Date"] >= current_utc_date) & (df["Start Date"] < current_utc_date + PASS_WINDOW)]
 
                 df['MODE'] = df['Start Time'].astype(str).apply(determine_mode)
                 df['IDLE'] = 1
@@ -237,19 +242,48 @@ def fetchTMTR_Report():
         except Exception as e:
             logging.info(f'An error occurred in fetchReport(): {e}')
 
-        # Call IFSS_RSA.main() outside the try-except block to ensure it's called in all scenarios
+        # Merge outside the try-except block to ensure it's done in all scenarios
+        merge_schedule()
+
+def merge_schedule():
+    '''Hand the freshly written schedule.csv to the running pass scheduler in IFSS_RSA.'''
+    try:
+        IFSS_RSA.load_schedule()
+    except Exception as e:
+        logging.error(f'Failed to merge schedule into IFSS_RSA: {e}')
+
+def run_capture():
+    '''
+    Keep IFSS_RSA.main() running on the main thread, which also keeps the daily fetch thread alive.
+    This is the one recovery path for capture errors: main() raises on an unavailable instrument at
+    boot or a failed pass after tearing down everything it started (spool, sockets, workers, pending
+    pass events), and is called again here with backoff.
+    '''
+    delay = MAIN_RETRY_DELAY
+    while True:
         logging.info('Attempting to call IFSS_RSA.main()')
+        started = monotonic()
         try:
-            IFSS_RSA.main()  # Ensure this is the correct call
-            logging.info('IFSS_RSA.main() called successfully')
+            IFSS_RSA.main()
+            logging.error('IFSS_RSA.main() returned')
         except Exception as e:
             logging.error(f'Failed to call IFSS_RSA.main(): {e}')
+        if monotonic() - started > MAIN_RETRY_MAX:
+            delay = MAIN_RETRY_DELAY
+        logging.info(f'Calling IFSS_RSA.main() again in {delay} s')
+        sleep(delay)
+        delay = min(delay * 2, MAIN_RETRY_MAX)
 
-schedule.every().day.at("00:06").do(fetchTMTR_Report)
+if __name__ == "__main__":
+    # Guarded: instrument workers are spawned (IFSS_RSA.main), which imports this module again in every child
+    # Daily fetch as an event instead of polling schedule.run_pending() every second. It runs on its
+    # own thread and only merges into the pass index, so the 00:06 refresh is never held up by a pass
+    # in progress and capture carries straight on across midnight.
+    scheduler = EventScheduler("DailyScheduler")
+    scheduler.every_day(time(0, 6), "fetchTMTR_Report", fetchTMTR_Report)
 
-fetchTMTR_Report()
+    fetchTMTR_Report()
 
-while True:
-    schedule.run_pending()
-    sleep(1)
-    
+    threading.Thread(target=scheduler.run, name="DailyScheduler", daemon=True).start()
+
+    run_capture()
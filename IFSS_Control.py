@@ -0,0 +1,180 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+
+# Control channel for a running IFSS: pause, resume, skip the current pass and query status.
+# IFSS_RSA serves it on a Unix domain socket and keeps the result in a ControlState, so the
+# acquisition loop only ever reads in-memory flags (shared memory, so instrument worker
+# processes see them too). Requests and replies are one line of JSON:
+#     -> {"command": "pause"}
+#     <- {"ok": true, "status": {"paused": true, ...}}
+# This is an operator-only interface. The socket is local to the IFSS host; the dashboard's
+# /control routes (Dashboard/app.py) only accept commands from loopback or with the operator
+# token. Usable from there and from the command line:
+#     python3 IFSS_Control.py pause|resume|skip|status
+
+CONTROL_SOCKET = '/home/its/IFSS/IFSS_control.sock'
+COMMANDS = ("pause", "resume", "skip", "status")
+# Instrument worker processes are spawned (see IFSS_RSA.main), shared flags must come from the same context
+_SPAWN = multiprocessing.get_context("spawn")
+
+class ControlState:
+    '''
+    Operator requests as plain attributes for the capture loop, set from the control server
+    thread. The flags live in shared memory, so a ControlState handed to a worker process
+    follows the one in the parent. A skip ends the pass being captured, or skips the next
+    one if none is running, in every process that sees it. Skips are not per instrument: with
+    several INSTRUMENTS each worker takes the skip once, so a worker that is idle when it is
+    requested skips its own next pass. Skips requested before a process unpickled its
+    ControlState (a worker started or restarted later) are not taken by it.
+    '''
+
+    def __init__(self):
+        self._paused = _SPAWN.RawValue('b', 0)
+        self._skips = _SPAWN.RawValue('i', 0)
+        self._skips_taken = 0
+        self._resumed = _SPAWN.Event()
+        self._resumed.set()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_skips_taken"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._skips_taken = self._skips.value
+
+    @property
+    def paused(self):
+        return bool(self._paused.value)
+
+    @property
+    def skip_requested(self):
+        return self._skips.value != self._skips_taken
+
+    def pause(self):
+        self._paused.value = 1
+        self._resumed.clear()
+
+    def resume(self):
+        self._paused.value = 0
+        self._resumed.set()
+
+    def skip(self):
+        self._skips.value += 1
+
+    def take_skip(self):
+        '''True once per skip request in this process.'''
+        skips = self._skips.value
+        if skips != self._skips_taken:
+            self._skips_taken = skips
+            return True
+        return False
+
+    def wait_resumed(self, timeout=None):
+        return self._resumed.wait(timeout)
+
+class ControlServer:
+    '''
+    Serve ControlState over a Unix domain socket on a background thread. status, if given,
+    is called for extra fields (current pass, writer stats, ...) to include in every reply.
+    '''
+
+    def __init__(self, state, path=CONTROL_SOCKET, status=None):
+        self.state = state
+        self.path = path
+        self.status = status
+        self._socket = None
+        self._thread = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            # Left behind by a previous run that did not shut down cleanly
+            os.remove(self.path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(self.path)
+        os.chmod(self.path, 0o660)
+        self._socket.listen(4)
+        self._thread = threading.Thread(target=self._serve, name="ControlServer", daemon=True)
+        self._thread.start()
+        logging.info(f"Control channel listening on {self.path}")
+
+    def stop(self):
+        if self._socket is not None:
+            server, self._socket = self._socket, None
+            try:
+                # Wakes the accept() of the server thread
+                server.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            server.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def handle(self, command):
+        if command == "pause":
+            self.state.pause()
+            logging.info("Control: schedule paused")
+        elif command == "resume":
+            self.state.resume()
+            logging.info("Control: schedule resumed")
+        elif command == "skip":
+            self.state.skip()
+            logging.info("Control: skip of the current pass requested")
+        elif command != "status":
+            return {"ok": False, "error": f"Unknown command {command!r}, expected one of {', '.join(COMMANDS)}"}
+        status = {"paused": self.state.paused, "skipRequested": self.state.skip_requested}
+        if self.status is not None:
+            try:
+                status.update(self.status())
+            except Exception as e:
+                status["statusError"] = str(e)
+        return {"ok": True, "status": status}
+
+    def _serve(self):
+        while self._socket is not None:
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                break
+            with connection:
+                try:
+                    connection.settimeout(2)
+                    request = json.loads(connection.makefile('r').readline() or '{}')
+                    reply = self.handle(request.get("command"))
+                except Exception as e:
+                    reply = {"ok": False, "error": str(e)}
+                try:
+                    connection.sendall((json.dumps(reply, default=str) + "\n").encode())
+                except OSError:
+                    pass
+
+def send_command(command, path=CONTROL_SOCKET, timeout=2):
+    '''Send one command to a running IFSS and return its reply. Raises OSError if IFSS is not listening.'''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.settimeout(timeout)
+        connection.connect(path)
+        connection.sendall((json.dumps({"command": command}) + "\n").encode())
+        return json.loads(connection.makefile('r').readline())
+
+def main():
+    parser = argparse.ArgumentParser(description="Control a running IFSS")
+    parser.add_argument("command", choices=COMMANDS)
+    parser.add_argument("--socket", default=CONTROL_SOCKET)
+    args = parser.parse_args()
+    try:
+        reply = send_command(args.command, args.socket)
+    except OSError as e:
+        sys.exit(f"IFSS is not reachable on {args.socket}: {e}")
+    print(json.dumps(reply, indent=2))
+    if not reply.get("ok"):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+import argparse
+import json
+import os
+from datetime import datetime
+import numpy as np
+
+# IQ recordings and the host-side spectrum engine used to reanalyse them.
+#
+# IFSS_RSA in ACQUISITION_MODE "iq" streams a pass's IQ as interleaved little-endian int16 pairs
+# straight from the IQSTREAM buffer to <name>.sigmf-data with a SigMF style JSON sidecar
+#     <name>.sigmf-meta  {"global": {"core:datatype": "ci16_le", "core:sample_rate": ..., "ifss:scale_factor": V per count, ...},
+#                         "captures": [{"core:sample_start": 0, "core:frequency": Hz, "core:datetime": UTC}],
+#                         "annotations": [{"core:sample_start", "core:sample_count", "ifss:acqStatus": IQSTRM_STATUS bits}]}
+# welch() and stft() then regenerate spectra from any stretch of it at any RBW:
+#     python3 IFSS_IQ.py <name>.sigmf-meta --rbw 1e3 [--start 12.5] [--duration 2] [--hop 0.05] --out spectra.npz
+
+IQ_DIR = '/home/its/IFSS/iq'
+SIGMF_VERSION = "1.0.0"
+
+# Window functions and their equivalent noise bandwidth in bins
+WINDOWS = {
+    "hann": (np.hanning, 1.5),
+    "blackman": (np.blackman, 1.73),
+    "rect": (np.ones, 1.0),
+}
+# Segments transformed per FFT call, bounds the working memory of welch()/stft()
+FFT_CHUNK = 2048
+
+class IQRecorder:
+    '''
+    Append IQ blocks of one capture to <path>.sigmf-data and keep its .sigmf-meta sidecar.
+    write() hands the caller's buffer to an unbuffered file, so samples go from the IQSTREAM
+    buffer to the kernel without a copy in Python. The sidecar is written when the recording
+    opens, so an interrupted one stays readable, and completed by close(). scale_factor may be
+    given once the first block has arrived.
+    '''
+
+    def __init__(self, path, sample_rate, center_freq, scale_factor, start=None, **extra):
+        self.path = path
+        self.samples = 0
+        self.annotations = []
+        self.meta = {
+            "global": {
+                "core:datatype": "ci16_le",
+                "core:sample_rate": sample_rate,
+                "core:version": SIGMF_VERSION,
+                "core:recorder": "IFSS",
+                "core:hw": "Tektronix RSA306B",
+                "ifss:scale_factor": scale_factor,
+                **{f"ifss:{key}": value for key, value in extra.items()},
+            },
+            "captures": [{"core:sample_start": 0, "core:frequency": center_freq,
+                          "core:datetime": (start or datetime.utcnow()).isoformat() + "Z"}],
+            "annotations": self.annotations,
+        }
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._data = open(path + '.sigmf-data', 'wb', buffering=0)
+        self._write_meta()
+
+    @property
+    def scale_factor(self):
+        return self.meta["global"]["ifss:scale_factor"]
+
+    @scale_factor.setter
+    def scale_factor(self, value):
+        # IQSTREAM only reports it with the first block
+        self.meta["global"]["ifss:scale_factor"] = value
+        self._write_meta()
+
+    def write(self, block, acqStatus=0):
+        '''Append an int16 array of interleaved I/Q. acqStatus flags are kept as an annotation over the block.'''
+        count = len(block) // 2
+        self._data.write(memoryview(block).cast('B'))
+        if acqStatus:
+            self.annotations.append({"core:sample_start": self.samples, "core:sample_count": count, "ifss:acqStatus": int(acqStatus)})
+        self.samples += count
+
+    def new_capture(self, center_freq, when=None):
+        '''Start a new capture segment at the next sample, after the stream was restarted.'''
+        self.meta["captures"].append({"core:sample_start": self.samples, "core:frequency": center_freq,
+                                      "core:datetime": (when or datetime.utcnow()).isoformat() + "Z"})
+
+    def close(self):
+        if self._data.closed:
+            return
+        self._data.close()
+        self.meta["global"]["ifss:samples"] = self.samples
+        self._write_meta()
+
+    def _write_meta(self):
+        with open(self.path + '.sigmf-meta.tmp', 'w') as f:
+            json.dump(self.meta, f, indent=2, default=str)
+        os.replace(self.path + '.sigmf-meta.tmp', self.path + '.sigmf-meta')
+
+class SampleRing:
+    '''The latest `samples` IQ samples (int16 pairs) pushed through it, the input of live host-side spectra.'''
+
+    def __init__(self, samples):
+        self.buffer = np.zeros(2 * samples, dtype='<i2')
+        self.position = 0
+        self.filled = 0
+
+    def push(self, block):
+        block = block[-len(self.buffer):]
+        size = len(self.buffer)
+        first = min(len(block), size - self.position)
+        self.buffer[self.position:self.position + first] = block[:first]
+        self.buffer[:len(block) - first] = block[first:]
+        self.position = (self.position + len(block)) % size
+        self.filled = min(self.filled + len(block), size)
+
+    def clear(self):
+        self.position = self.filled = 0
+
+    def latest(self):
+        '''Int16 pairs in stream order.'''
+        return np.roll(self.buffer, -self.position)[len(self.buffer) - self.filled:]
+
+def open_recording(meta_path):
+    '''(sidecar dict, int16 memmap of shape samples x 2) of a recording.'''
+    with open(meta_path) as f:
+        meta = json.load(f)
+    data_path = meta_path[:-len('.sigmf-meta')] + '.sigmf-data'
+    if os.path.getsize(data_path) == 0:
+        return meta, np.zeros((0, 2), dtype='<i2')
+    return meta, np.memmap(data_path, dtype='<i2', mode='r').reshape(-1, 2)
+
+def load_iq(meta_path, start=0.0, duration=None):
+    '''Complex64 volts of a recording from `start` seconds for `duration` seconds (to the end if None).'''
+    meta, samples = open_recording(meta_path)
+    sample_rate = meta["global"]["core:sample_rate"]
+    first = int(start * sample_rate)
+    last = len(samples) if duration is None else min(len(samples), first + int(duration * sample_rate))
+    return meta, to_complex(samples[first:last], meta["global"]["ifss:scale_factor"])
+
+def to_complex(pairs, scale_factor):
+    '''Interleaved int16 I/Q (flat or n x 2) as complex64 volts.'''
+    return np.ascontiguousarray(pairs, dtype=np.float32).reshape(-1, 2).view(np.complex64)[:, 0] * np.float32(scale_factor)
+
+def spectrum_bins(sample_rate, rbw, bandwidth=None, window="hann"):
+    '''
+    FFT size whose bins are `rbw` wide (equivalent noise bandwidth) and the bin frequency
+    offsets from the centre, trimmed to +-bandwidth/2. Returns (nfft, keep slice, offsets Hz).
+    '''
+    nfft = max(int(round(WINDOWS[window][1] * sample_rate / rbw)), 8)
+    offsets = np.fft.fftshift(np.fft.fftfreq(nfft, 1 / sample_rate))
+    if bandwidth is None:
+        keep = slice(0, nfft)
+    else:
+        inside = np.flatnonzero(np.abs(offsets) <= bandwidth / 2)
+        keep = slice(inside[0], inside[-1] + 1)
+    return nfft, keep, offsets[keep]
+
+def _segment_power(iq, nfft, hop, window):
+    '''mW per bin (fftshifted) of every windowed segment, as an iterator of chunk x nfft arrays.'''
+    taper = WINDOWS[window][0](nfft).astype(np.float32)
+    # Amplitude normalisation: a tone reads its power in the bin it falls in. 10 * |V|^2 is mW in 50 ohm
+    norm = np.float32(10.0 / taper.sum() ** 2)
+    segments = np.lib.stride_tricks.sliding_window_view(iq, nfft)[::hop]
+    for first in range(0, len(segments), FFT_CHUNK):
+        spectra = np.fft.fft(segments[first:first + FFT_CHUNK] * taper, axis=1)
+        power = spectra.real ** 2 + spectra.imag ** 2
+        yield np.fft.fftshift(power, axes=1) * norm
+
+def welch(iq, sample_rate, rbw, bandwidth=None, window="hann", overlap=0.5):
+    '''Averaged spectrum of complex IQ volts at resolution bandwidth rbw. Returns (offsets Hz, dBm).'''
+    nfft, keep, offsets = spectrum_bins(sample_rate, rbw, bandwidth, window)
+    if len(iq) < nfft:
+        raise ValueError(f"{len(iq)} samples is less than one {nfft} point segment for RBW {rbw} Hz")
+    hop = max(int(nfft * (1 - overlap)), 1)
+    total = np.zeros(nfft, dtype=np.float64)
+    count = 0
+    for power in _segment_power(iq, nfft, hop, window):
+        total += power.sum(axis=0)
+        count += len(power)
+    return offsets, (10 * np.log10(np.maximum(total / count, 1e-20)))[keep].astype(np.float32)
+
+def stft(iq, sample_rate, rbw, hop_seconds, bandwidth=None, window="hann", overlap=0.5):
+    '''
+    Spectrogram of complex IQ volts: one Welch average per hop_seconds of signal at resolution
+    bandwidth rbw. Returns (row start times s, offsets Hz, rows x bins dBm).
+    '''
+    nfft, keep, offsets = spectrum_bins(sample_rate, rbw, bandwidth, window)
+    hop = max(int(nfft * (1 - overlap)), 1)
+    per_row = max(int(hop_seconds * sample_rate) // hop, 1)
+    rows = []
+    pending = np.zeros((0, nfft), dtype=np.float32)
+    for power in _segment_power(iq, nfft, hop, window):
+        pending = np.concatenate([pending, power]) if len(pending) else power
+        full = len(pending) // per_row * per_row
+        if full:
+            rows.append(pending[:full].reshape(-1, per_row, nfft).mean(axis=1))
+            pending = pending[full:]
+    if len(pending):
+        rows.append(pending.mean(axis=0, keepdims=True))
+    if not rows:
+        raise ValueError(f"{len(iq)} samples is less than one {nfft} point segment for RBW {rbw} Hz")
+    spectrogram = 10 * np.log10(np.maximum(np.vstack(rows), 1e-20))[:, keep]
+    times = np.arange(len(spectrogram)) * per_row * hop / sample_rate
+    return times, offsets, spectrogram.astype(np.float32)
+
+def main():
+    parser = argparse.ArgumentParser(description="Regenerate spectra from an IFSS IQ recording")
+    parser.add_argument("meta", help="<name>.sigmf-meta")
+    parser.add_argument("--rbw", type=float, required=True, help="resolution bandwidth in Hz")
+    parser.add_argument("--start", type=float, default=0.0, help="seconds into the recording")
+    parser.add_argument("--duration", type=float, default=None, help="seconds to analyse (default: to the end)")
+    parser.add_argument("--hop", type=float, default=None, help="spectrogram row length in seconds (default: one averaged spectrum)")
+    parser.add_argument("--window", choices=sorted(WINDOWS), default="hann")
+    parser.add_argument("--out", required=True, help=".npz file to write")
+    args = parser.parse_args()
+
+    meta, iq = load_iq(args.meta, args.start, args.duration)
+    sample_rate = meta["global"]["core:sample_rate"]
+    center = meta["captures"][0]["core:frequency"]
+    bandwidth = meta["global"].get("ifss:bandwidth")
+    if args.hop:
+        times, offsets, spectra = stft(iq, sample_rate, args.rbw, args.hop, bandwidth, args.window)
+        np.savez(args.out, frequencies=center + offsets, times=args.start + times, spectrogram=spectra)
+        print(f"{spectra.shape[0]} x {spectra.shape[1]} spectrogram at {args.rbw} Hz RBW written to {args.out}")
+    else:
+        offsets, spectrum = welch(iq, sample_rate, args.rbw, bandwidth, args.window)
+        np.savez(args.out, frequencies=center + offsets, spectrum=spectrum)
+        print(f"{len(spectrum)} point spectrum at {args.rbw} Hz RBW written to {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import base64
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+
+# Live trace feed from a running IFSS to the dashboard. Every trace handed to the TraceWriter is
+# published here once, tagged with a sequence number, to the subscribers of a Unix domain socket:
+# one per dashboard worker process (Dashboard/app.py), which fans it out to its browsers as
+# Server-Sent Events. Live display therefore never reads MongoDB, however many pages are open.
+# Messages are one line of JSON:
+#     {"seq": n, "timestamp": ISO UTC, "sat": name, "axisId": spectrumAxis _id, "acqStatus": bits,
+#      "encoding": "float32" | "int16", "scale": dB per count (int16 only), "trace": base64 trace blob}
+
+LIVE_SOCKET = '/home/its/IFSS/IFSS_live.sock'
+# Messages queued per subscriber. One further behind loses the oldest, which shows as a gap in seq
+SUBSCRIBER_BACKLOG = 32
+
+def encode_message(seq, document):
+    meta = document.get("meta", {})
+    message = {
+        "seq": seq,
+        "timestamp": document["timestamp"].isoformat() + "Z",
+        "sat": (meta.get("sat") or "").strip(),
+        "axisId": str(meta.get("axisId")),
+        "acqStatus": meta.get("acqStatus", 0),
+        "encoding": document["encoding"],
+        "trace": base64.b64encode(document["trace"]).decode(),
+    }
+    if "scale" in document:
+        message["scale"] = document["scale"]
+    return (json.dumps(message) + "\n").encode()
+
+def decode_message(line):
+    '''Message dict with the trace blob back as bytes, ready for IFSS_Storage.decode_trace().'''
+    message = json.loads(line)
+    message["trace"] = base64.b64decode(message["trace"])
+    return message
+
+class LiveFeed:
+    '''
+    Publish trace documents to every subscriber of the live socket. publish() only serialises
+    the document once and queues it per subscriber, it never waits for a subscriber; each has
+    a sender thread and a backlog of SUBSCRIBER_BACKLOG messages.
+    '''
+
+    def __init__(self, path=LIVE_SOCKET, backlog=SUBSCRIBER_BACKLOG):
+        self.path = path
+        self.backlog = backlog
+        self.seq = 0
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._socket = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(self.path)
+        os.chmod(self.path, 0o660)
+        self._socket.listen(8)
+        threading.Thread(target=self._accept, name="LiveFeed", daemon=True).start()
+        logging.info(f"Live feed listening on {self.path}")
+
+    def stop(self):
+        if self._socket is not None:
+            server, self._socket = self._socket, None
+            try:
+                server.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            server.close()
+        with self._lock:
+            for messages in self._subscribers:
+                messages.put(None)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def publish(self, document):
+        with self._lock:
+            self.seq += 1
+            if not self._subscribers:
+                return
+            line = encode_message(self.seq, document)
+            for messages in self._subscribers:
+                try:
+                    messages.put_nowait(line)
+                except queue.Full:
+                    try:
+                        messages.get_nowait()
+                    except queue.Empty:
+                        pass
+                    messages.put_nowait(line)
+
+    def _accept(self):
+        while self._socket is not None:
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                break
+            messages = queue.Queue(self.backlog)
+            with self._lock:
+                self._subscribers.append(messages)
+            threading.Thread(target=self._send, args=(connection, messages), name="LiveFeedSender", daemon=True).start()
+
+    def _send(self, connection, messages):
+        with connection:
+            for line in iter(messages.get, None):
+                try:
+                    connection.sendall(line)
+                except OSError:
+                    break
+        with self._lock:
+            self._subscribers.remove(messages)
+
+def subscribe(path=LIVE_SOCKET, retry=2):
+    '''Yield live feed messages (decode_message()) forever, reconnecting every `retry` seconds while IFSS is not running.'''
+    while True:
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                connection.connect(path)
+                for line in connection.makefile('rb'):
+                    yield decode_message(line)
+        except (OSError, ValueError) as e:
+            logging.debug(f"Live feed unavailable: {e}")
+        time.sleep(retry)
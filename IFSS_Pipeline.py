@@ -0,0 +1,369 @@
+import logging
+import queue
+import threading
+from time import monotonic
+from pymongo.errors import BulkWriteError
+from IFSS_Storage import PassBucketer
+
+# Producer/consumer stage between the acquisition loop and MongoDB. The acquisition
+# side only ever calls submit(), which never waits longer than put_timeout, so trace
+# cadence stays independent of database latency.
+
+# Queue marker telling the writer thread to flush and exit
+_STOP = object()
+# Marker a QueueWriter sends to have the parent TraceWriter flush
+_FLUSH = "flush"
+
+class _Flush:
+    '''Queue item asking the writer thread to flush, closing the open buckets of one pass or of all.'''
+    __slots__ = ("done", "scheduleRunId", "axisIds")
+
+    def __init__(self, scheduleRunId=None, axisIds=None):
+        self.done = threading.Event()
+        self.scheduleRunId = scheduleRunId
+        self.axisIds = axisIds
+
+class TraceWriter:
+    '''
+    Drain spectrum documents from a bounded queue into a MongoDB collection on a
+    background thread.
+
+    Backpressure: submit() blocks for at most put_timeout seconds when the queue is full
+    and then drops the document, counting it in stats()["dropped"]. The acquisition loop
+    is never held up by a slow or stalled database for longer than that.
+
+    Batching: documents are written with unordered insert_many calls of up to batch_size
+    documents, flushed at the latest flush_interval seconds after the first document of a
+    batch arrived. flush() and stop() force out whatever is pending. write_concern, if
+    given, is applied to the collection for these writes.
+
+    Buckets: with bucket_collection set, every trace is also grouped by an
+    IFSS_Storage.PassBucketer into per-pass bucket documents, written as they close.
+    flush(scheduleRunId) closes the open buckets of that pass (of its axisIds only if given,
+    for instruments sharing a pass), so a flush at LOS completes it while other passes keep
+    filling theirs; a flush without one and stop() close them all.
+
+    Spool: with an IFSS_Spool.TraceSpool, every batch is first appended to the local
+    spool and MongoDB is only ever written by replaying it. A failed write leaves the
+    records in the spool and a replayer thread retries every retry_interval seconds,
+    skipping documents whose _id already made it into the database.
+
+    Other collections: store() queues a single document for one of `collections` (e.g. a
+    spectrumAxis document made while MongoDB was down). It goes through the spool like the
+    traces and is never dropped for a full queue within its timeout.
+
+    Live feed: with an IFSS_Live.LiveFeed, every submitted document is also published to
+    it for the dashboard, whether or not it was queued.
+    '''
+
+    def __init__(self, collection, maxsize=600, put_timeout=0.05, batch_size=50, flush_interval=5.0,
+                 write_concern=None, bucket_collection=None, bucketer=None, collections=(), spool=None, retry_interval=10,
+                 feed=None, name="TraceWriter"):
+        if write_concern is not None:
+            collection = collection.with_options(write_concern=write_concern)
+            if bucket_collection is not None:
+                bucket_collection = bucket_collection.with_options(write_concern=write_concern)
+        self.collection = collection
+        self.bucket_collection = bucket_collection
+        self.bucketer = bucketer if bucketer is not None else PassBucketer()
+        self.collections = {collection.name: collection}
+        if bucket_collection is not None:
+            self.collections[bucket_collection.name] = bucket_collection
+        for other in collections:
+            self.collections[other.name] = other
+        self.spool = spool
+        self.feed = feed
+        self.retry_interval = retry_interval
+        # Records left over from a previous run may already be partly in MongoDB
+        self._verify = spool is not None and spool.pending()
+        self._stopping = threading.Event()
+        self._replayer = None
+        self.put_timeout = put_timeout
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.name = name
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {"submitted": 0, "written": 0, "dropped": 0, "failed": 0, "batches": 0, "buckets": 0, "stored": 0, "spooled": 0, "replayErrors": 0, "maxDepth": 0}
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+            if self.spool is not None and (self._replayer is None or not self._replayer.is_alive()):
+                self._stopping.clear()
+                self._replayer = threading.Thread(target=self._replay_loop, name=f"{self.name}Replay", daemon=True)
+                self._replayer.start()
+            logging.info(f"{self.name} started (queue size {self.queue.maxsize}, batch {self.batch_size}, flush every {self.flush_interval} s)")
+
+    def stop(self, timeout=30):
+        '''Flush everything still queued and stop the writer thread.'''
+        if self._thread is None:
+            return
+        self.queue.put(_STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logging.error(f"{self.name} did not drain within {timeout} s, {self.queue.qsize()} documents left")
+        self._thread = None
+        if self._replayer is not None:
+            self._stopping.set()
+            self._replayer.join(timeout)
+            self._replayer = None
+            if self.spool.pending():
+                logging.info(f"{self.name} left unreplayed records in the spool, they are written on next start")
+        logging.info(f"{self.name} stopped: {self.stats()}")
+
+    def flush(self, timeout=30, scheduleRunId=None, axisIds=None):
+        '''Block until every document submitted so far has been written. Returns False on timeout.'''
+        if self._thread is None:
+            return True
+        request = _Flush(scheduleRunId, axisIds)
+        try:
+            self.queue.put(request, timeout=timeout)
+        except queue.Full:
+            return False
+        return request.done.wait(timeout)
+
+    def submit(self, document):
+        '''Queue a document for writing. Returns False if it was dropped because the queue stayed full.'''
+        if self.feed is not None:
+            self.feed.publish(document)
+        try:
+            self.queue.put(document, timeout=self.put_timeout)
+        except queue.Full:
+            self._count("dropped")
+            return False
+        self._count("submitted")
+        depth = self.queue.qsize()
+        with self._lock:
+            if depth > self._stats["maxDepth"]:
+                self._stats["maxDepth"] = depth
+        return True
+
+    def store(self, collection_name, document, timeout=30):
+        '''Queue one document for collections[collection_name]. Returns False if the queue stayed full for timeout seconds.'''
+        try:
+            self.queue.put((collection_name, document), timeout=timeout)
+        except queue.Full:
+            return False
+        return True
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["depth"] = self.queue.qsize()
+        return stats
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._stats[key] += n
+
+    def _write(self, documents):
+        '''Write one batch. Returns the number of documents stored.'''
+        try:
+            return len(self.collection.insert_many(documents, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            logging.error(f"{self.name} partial batch write: {e.details.get('writeErrors', [])[:1]}")
+            return e.details.get("nInserted", 0)
+
+    def _spool_sink(self, name, documents, verify):
+        '''Idempotent insert of replayed spool records; raises if MongoDB did not take them.'''
+        collection = self.collections[name]
+        if verify:
+            query = {"_id": {"$in": [document["_id"] for document in documents]}}
+            times = [document["timestamp"] for document in documents if "timestamp" in document]
+            if times:
+                # Keeps the lookup on the time-series timestamp index
+                query["timestamp"] = {"$gte": min(times), "$lte": max(times)}
+            existing = {document["_id"] for document in collection.find(query, {"_id": 1})}
+            documents = [document for document in documents if document["_id"] not in existing]
+        if documents:
+            try:
+                collection.insert_many(documents, ordered=False)
+            except BulkWriteError as e:
+                # Duplicate keys are records that were already written before
+                if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                    raise
+        self._count(self._stat_name(collection), len(documents))
+
+    def _stat_name(self, collection):
+        if collection is self.collection:
+            return "written"
+        return "buckets" if collection is self.bucket_collection else "stored"
+
+    def _drain_spool(self, blocking):
+        '''Replay the spool into MongoDB until it is empty or a write fails.'''
+        while True:
+            try:
+                replayed = self.spool.replay(self._spool_sink, limit=self.batch_size, verify=self._verify, blocking=blocking)
+            except Exception as e:
+                if not self._verify:
+                    logging.error(f"{self.name} MongoDB write failed, spooling locally until it recovers: {e}")
+                self._verify = True
+                self._count("replayErrors")
+                return False
+            if replayed is None:
+                return False
+            if replayed == 0:
+                if self._verify:
+                    logging.info(f"{self.name} spool replayed, MongoDB writes caught up")
+                self._verify = False
+                return True
+
+    def _replay_loop(self):
+        while not self._stopping.wait(self.retry_interval):
+            if self.spool.pending():
+                self._drain_spool(blocking=True)
+        self._drain_spool(blocking=True)
+
+    def _write_buckets(self, buckets):
+        if not buckets:
+            return
+        try:
+            self.bucket_collection.insert_many(buckets, ordered=False)
+            self._count("buckets", len(buckets))
+        except Exception as e:
+            logging.error(f"{self.name} failed to write {len(buckets)} pass buckets: {e}")
+
+    def _store(self, name, document):
+        if self.spool is not None:
+            self.spool.append(name, [document])
+            if not self._verify:
+                self._drain_spool(blocking=False)
+            return
+        try:
+            self.collections[name].insert_one(document)
+            self._count("stored")
+        except Exception as e:
+            logging.error(f"{self.name} failed to write a {name} document: {e}")
+
+    def _flush_batch(self, batch, close_bucket=False, scheduleRunId=None, axisIds=None):
+        if self.bucket_collection is not None:
+            buckets = []
+            for document in batch:
+                buckets.extend(self.bucketer.add(document))
+            if close_bucket:
+                buckets.extend(self.bucketer.close(scheduleRunId, axisIds))
+            if self.spool is not None:
+                self.spool.append(self.bucket_collection.name, buckets)
+            else:
+                self._write_buckets(buckets)
+        if self.spool is not None:
+            if batch:
+                self.spool.append(self.collection.name, batch)
+                self._count("spooled", len(batch))
+                self._count("batches")
+                batch.clear()
+            # While MongoDB is failing or a backlog is being replayed, the replayer thread owns the writes
+            if not self._verify:
+                self._drain_spool(blocking=False)
+            return
+        if not batch:
+            return
+        started = monotonic()
+        try:
+            written = self._write(batch)
+        except Exception as e:
+            written = 0
+            logging.error(f"{self.name} failed to write {len(batch)} documents: {e}")
+        self._count("written", written)
+        self._count("failed", len(batch) - written)
+        self._count("batches")
+        elapsed = monotonic() - started
+        if elapsed > 1:
+            logging.info(f"{self.name} slow write: {len(batch)} documents in {elapsed:.2f} s, queue depth {self.queue.qsize()}")
+        batch.clear()
+
+    def _run(self):
+        batch = []
+        batch_started = None
+        while True:
+            timeout = None if not batch else max(0.0, batch_started + self.flush_interval - monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                self._flush_batch(batch)
+                continue
+            if item is _STOP:
+                self._flush_batch(batch, close_bucket=True)
+                break
+            if isinstance(item, _Flush):
+                self._flush_batch(batch, close_bucket=True, scheduleRunId=item.scheduleRunId, axisIds=item.axisIds)
+                item.done.set()
+                continue
+            if isinstance(item, tuple):
+                self._store(*item)
+                continue
+            if not batch:
+                batch_started = monotonic()
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                self._flush_batch(batch)
+
+class QueueWriter:
+    '''
+    TraceWriter stand-in for an instrument worker process: documents are passed through a
+    multiprocessing queue to the TraceWriter of the parent process by forward_documents().
+    submit() follows the same put_timeout drop policy and store() is passed on as is. flush() asks the parent to flush
+    and, given the worker's `flushed` event (a multiprocessing.Event that forward_documents()
+    sets under `key` once the parent's flush returned), waits for it like TraceWriter.flush().
+    '''
+
+    def __init__(self, queue, put_timeout=0.05, flushed=None, key=None):
+        self.queue = queue
+        self.put_timeout = put_timeout
+        self.flushed = flushed
+        self.key = key
+        self._stats = {"submitted": 0, "dropped": 0}
+
+    def submit(self, document):
+        try:
+            self.queue.put(document, timeout=self.put_timeout)
+        except queue.Full:
+            self._stats["dropped"] += 1
+            return False
+        self._stats["submitted"] += 1
+        return True
+
+    def store(self, collection_name, document, timeout=30):
+        try:
+            self.queue.put((collection_name, document), timeout=timeout)
+        except queue.Full:
+            return False
+        return True
+
+    def flush(self, timeout=30, scheduleRunId=None, axisIds=None):
+        if self.flushed is not None:
+            self.flushed.clear()
+        try:
+            self.queue.put((_FLUSH, self.key, scheduleRunId, axisIds), timeout=timeout)
+        except queue.Full:
+            return False
+        return self.flushed.wait(timeout) if self.flushed is not None else True
+
+    def stats(self):
+        return dict(self._stats)
+
+def forward_documents(source, writer, flushed=None):
+    '''
+    Feed documents from the QueueWriters of worker processes into writer until None arrives on
+    source. A worker's flush is answered by setting its event in `flushed` (by QueueWriter key).
+    '''
+    flushed = flushed or {}
+    while True:
+        item = source.get()
+        if item is None:
+            break
+        if isinstance(item, tuple) and item[0] == _FLUSH:
+            if writer.flush(scheduleRunId=item[2], axisIds=item[3]):
+                if item[1] in flushed:
+                    flushed[item[1]].set()
+            else:
+                logging.error(f"{writer.name} did not flush within timeout for instrument worker {item[1]}")
+            continue
+        if isinstance(item, tuple):
+            if not writer.store(*item):
+                logging.error(f"{writer.name} did not take a {item[0]} document from an instrument worker")
+            continue
+        writer.submit(item)
@@ -1,13 +1,24 @@
 from ctypes import *
 from RSA_API import *
-import sys
-from time import sleep
-from datetime import datetime
+from time import sleep, monotonic
+from datetime import datetime, timedelta
 import logging
-from pymongo import MongoClient
-import subprocess
+from pymongo import MongoClient, WriteConcern
+from pymongo.errors import PyMongoError
 import csv
 import os
+import re
+import numpy as np
+import multiprocessing
+import threading
+from IFSS_Pipeline import TraceWriter, QueueWriter, forward_documents
+from IFSS_Spool import TraceSpool
+from IFSS_Scheduler import EventScheduler, PassIndex
+from IFSS_Control import ControlState, ControlServer
+from IFSS_Live import LiveFeed
+from bson.objectid import ObjectId
+from IFSS_IQ import IQ_DIR, IQRecorder, SampleRing, spectrum_bins, to_complex, welch
+from IFSS_Storage import ensure_spectrum_collection, ensure_bucket_collection, ensure_aggregate_collections, TraceAccumulator, upsert_axis, spectrum_axis, dpx_axis, iq_axis, encode_trace, encode_dpx_summary
 
 # MongoDB setup
 client = MongoClient('mongodb://localhost:27017/')
@@ -15,6 +26,9 @@ db = client["ifss"]
 spectrumData = db["spectrumData"]
 satSchedule = db["satSchedule"]
 scheduleRun = db["scheduleRun"]
+spectrumAxis = db["spectrumAxis"]
+spectrumBuckets = db["spectrumBuckets"]
+spectrumPassSummary = db["spectrumPassSummary"]
 
 # Reset the Root Logger and seup logging
 for handler in logging.root.handlers[:]:
@@ -23,17 +37,100 @@ logging.basicConfig(filename='/home/its/IFSS/IFSS_SA.log', level=logging.INFO, f
 
 RTLD_LAZY = 0x0001
 LAZYLOAD = RTLD_LAZY | RTLD_GLOBAL
-rsa = CDLL("/home/its/IFSS/Tools/lib/libRSA_API.so", LAZYLOAD)
-usbapi = CDLL("/home/its/IFSS/Tools/lib/libcyusb_shared.so", LAZYLOAD)
+if os.environ.get("IFSS_RSA_BACKEND") == "sim":
+    # Simulated instrument for hardware-free benchmarking, see RSA_SIM.py
+    from RSA_SIM import SimulatedRSA
+    rsa = SimulatedRSA.from_env()
+else:
+    rsa = CDLL("/home/its/IFSS/Tools/lib/libRSA_API.so", LAZYLOAD)
+    usbapi = CDLL("/home/its/IFSS/Tools/lib/libcyusb_shared.so", LAZYLOAD)
 
 CSV_FILE_PATH = '/home/its/IFSS/Tools/Report_Exports/schedule.csv'
+# Local write-ahead spool every trace goes through on its way to MongoDB
+SPOOL_DIR = '/home/its/IFSS/spool'
+
+# Acquisition mode: with CONTINUOUS_RUN the RSA is started once at AOS and stopped at LOS,
+# otherwise DEVICE_Run/DEVICE_Stop wrap every trace. TRACE_INTERVAL is the pause in seconds
+# between traces (0 pulls traces back-to-back).
+CONTINUOUS_RUN = True
+TRACE_INTERVAL = 1
+
+# ACQUISITION_MODE "spectrum" pulls swept SPECTRUM_* traces as above. "dpx" runs the DPX engine
+# back-to-back, catching signals down to the frame's minSigDuration that 1 Hz snapshots miss, and
+# stores one summary per DPX_SUMMARY_SECONDS: max-hold and mean of every FFT, the share of
+# spectrogram lines above DPX_OCCUPANCY_THRESHOLD dBm per point and, from the DPX spectrum bitmap,
+# the range of amplitudes each point was seen at (steady carriers are narrow, bursts and fading
+# wide). TRACE_INTERVAL does not apply.
+ACQUISITION_MODE = "spectrum"
+DPX_SUMMARY_SECONDS = 1
+DPX_OCCUPANCY_THRESHOLD = -90
+# DPX bitmap and spectrogram lines cover refLevel down to refLevel - DPX_DYNAMIC_RANGE dB
+DPX_DYNAMIC_RANGE = 100
+DPX_BITMAP_WIDTH = 801
+# "iq" streams the pass's IQ at each band's span as acquisition bandwidth, int16 straight from the
+# IQSTREAM buffer to a SigMF recording per band in IQ_DIR (see IFSS_IQ.py, which regenerates spectra
+# from them at any RBW). Every IQ_SPECTRUM_SECONDS of stream a spectrum at the band's RBW is computed
+# on the host from the latest IQ and stored like a trace. TRACE_INTERVAL does not apply. Note the
+# disk rate: 4 bytes per sample at 1.4x the span, e.g. 28 MB/s for a 5 MHz band.
+IQ_SPECTRUM_SECONDS = 1
+
+# spectrumData writes are batched into unordered insert_many calls of up to WRITE_BATCH_SIZE
+# traces, flushed at least every WRITE_FLUSH_INTERVAL seconds, at LOS and on shutdown
+WRITE_BATCH_SIZE = 50
+WRITE_FLUSH_INTERVAL = 5
+WRITE_CONCERN = WriteConcern(w=1, j=False)
+
+# The instrument is checked, and reconnected or reconfigured if needed, SESSION_LEAD seconds
+# ahead of every AOS. A USB error is retried in-process RECONNECT_ATTEMPTS times, backing off
+# RECONNECT_BACKOFF seconds more each time, before main() gives up and IFSS.py starts it again.
+# A first trace later than FIRST_TRACE_BUDGET_MS (per acquisition mode) after AOS is logged. DPX
+# and IQ only have their first trace once a whole summary/spectrum period has been collected.
+SESSION_LEAD = 30
+RECONNECT_ATTEMPTS = 5
+RECONNECT_BACKOFF = 2
+FIRST_TRACE_BUDGET_MS = {"spectrum": 500, "dpx": 500 + DPX_SUMMARY_SECONDS * 1000, "iq": 500 + IQ_SPECTRUM_SECONDS * 1000}
+# Longest wait for a single trace before the instrument is considered gone
+TRACE_TIMEOUT = 5
+# AcqDataStatus bits counted per pass and logged when a trace carries them
+ACQ_STATUS_FLAGS = {
+    "adcOverrange": AcqDataStatus_ADC_OVERRANGE,
+    "refOscUnlock": AcqDataStatus_REF_OSC_UNLOCK,
+    "lowSupplyVoltage": AcqDataStatus_LOW_SUPPLY_VOLTAGE,
+    "adcDataLost": AcqDataStatus_ADC_DATA_LOST,
+}
+
+# Bands captured during a pass as (center frequency Hz, reference level dBm, span Hz, RBW Hz).
+# With more than one band every pass sweeps through them in turn, one trace per band, and
+# TRACE_INTERVAL applies per sweep. Revisit rates per band are logged and kept with the pass.
+SWEEP_BANDS = [
+    (140e6, -30, 15e6, 15e3),
+]
+
+# Analyzers at this site as {"device": index in DEVICE_Search order, "bands": sweep bands,
+# "sats": satellite names it captures, None for every pass} and optionally "mode" to override
+# ACQUISITION_MODE for it. With more than one, each runs in
+# its own worker process (the RSA API drives one device per process) and they all feed the
+# TraceWriter of the main process through a queue of WORKER_QUEUE_SIZE documents.
+INSTRUMENTS = [
+    {"device": 0, "bands": SWEEP_BANDS, "sats": None},
+]
+WORKER_QUEUE_SIZE = 600
+
+# Passes of the rolling schedule window, dispatched at AOS on passScheduler by process_schedule()
+# with the instrument session and writer set up in captureContext
+passScheduler = EventScheduler("PassScheduler", propagate_errors=True)
+passIndex = PassIndex(passScheduler, lambda row, aos, los: run_pass(row, aos, los),
+                      prepare=lambda row, aos, los: prepare_pass(row, aos, los), lead=timedelta(seconds=SESSION_LEAD))
+captureContext = {}
+# Pause/resume/skip requests from the control channel (IFSS_Control.py)
+control = ControlState()
 
 ################ RSA SETUP AND CONFIG ################
 def err_check(rs):
     if ReturnStatus(rs) != ReturnStatus.noError:
         raise RSAError(ReturnStatus(rs).name)
 
-def search_connect():
+def search_connect(device=0):
     numFound = c_int(0)
     intArray = c_int * DEVSRCH_MAX_NUM_DEVICES
     deviceIDs = intArray()
@@ -45,11 +142,10 @@ def search_connect():
 
     err_check(rsa.DEVICE_Search(byref(numFound), deviceIDs, deviceSerial, deviceType))
 
-    if numFound.value < 1:
-        logging.info('No instruments found. Exiting script.')
-        sys.exit(0)
-    elif numFound.value == 1:
-        err_check(rsa.DEVICE_Connect(deviceIDs[0]))
+    if numFound.value <= device:
+        # Raised rather than exiting so InstrumentSession can keep retrying a device that dropped off USB
+        raise RSAError(f"Instrument {device} not found, {numFound.value} found")
+    err_check(rsa.DEVICE_Connect(deviceIDs[device]))
     rsa.CONFIG_Preset()
 
 def config_spectrum(cf=1e9, refLevel=0, span=40e6, rbw=300e3):
@@ -68,175 +164,850 @@ def config_spectrum(cf=1e9, refLevel=0, span=40e6, rbw=300e3):
     rsa.SPECTRUM_GetSettings(byref(specSet))
     return specSet
 
-def acquire_spectrum(specSet):
+def config_dpx(cf=1e9, refLevel=0, span=40e6, rbw=300e3):
+    yTop = refLevel
+    yBottom = refLevel - DPX_DYNAMIC_RANGE
+    err_check(rsa.CONFIG_SetCenterFreq(c_double(cf)))
+    err_check(rsa.CONFIG_SetReferenceLevel(c_double(refLevel)))
+    err_check(rsa.DPX_SetEnable(c_bool(True)))
+    err_check(rsa.DPX_SetParameters(c_double(span), c_double(rbw), c_int(DPX_BITMAP_WIDTH), c_int(1), VerticalUnitType.VerticalUnit_dBm,
+                                    c_double(yTop), c_double(yBottom), c_bool(False), c_double(1.0), c_bool(False)))
+    # One spectrogram line per millisecond
+    err_check(rsa.DPX_SetSogramParameters(c_double(1e-3), c_double(1e-3), c_double(yTop), c_double(yBottom)))
+    err_check(rsa.DPX_Configure(c_bool(True), c_bool(True)))
+    err_check(rsa.DPX_SetSpectrumTraceType(DPX_TRACEIDX_1, TraceType.TraceTypeMax))
+    err_check(rsa.DPX_SetSpectrumTraceType(DPX_TRACEIDX_2, TraceType.TraceTypeMin))
+    err_check(rsa.DPX_SetSpectrumTraceType(DPX_TRACEIDX_3, TraceType.TraceTypeAverage))
+    dpxSet = DPX_SettingStruct()
+    err_check(rsa.DPX_GetSettings(byref(dpxSet)))
+    return dpxSet
+
+def config_iqstream(cf=1e9, refLevel=0, bandwidth=5e6):
+    '''
+    Configure IQ streaming to the client as int16 pairs. Returns the actual settings as
+    {"bandwidth": Hz, "sampleRate": samples/s, "bufferSize": samples per IQSTREAM_GetIQData}.
+    '''
+    err_check(rsa.CONFIG_SetCenterFreq(c_double(cf)))
+    err_check(rsa.CONFIG_SetReferenceLevel(c_double(refLevel)))
+    err_check(rsa.IQSTREAM_SetAcqBandwidth(c_double(bandwidth)))
+    err_check(rsa.IQSTREAM_SetOutputConfiguration(IQSOUTDEST.IQSOD_CLIENT, IQSOUTDTYPE.IQSODT_INT16))
+    bwActual = c_double(0)
+    sampleRate = c_double(0)
+    bufferSize = c_int(0)
+    err_check(rsa.IQSTREAM_GetAcqParameters(byref(bwActual), byref(sampleRate)))
+    err_check(rsa.IQSTREAM_GetIQDataBufferSize(byref(bufferSize)))
+    return {"bandwidth": bwActual.value, "sampleRate": sampleRate.value, "bufferSize": bufferSize.value}
+
+def alloc_iq_buffer(iqSet, rbw):
+    '''
+    Like alloc_trace_buffer() for IQSTREAM_GetIQData blocks of int16 I/Q pairs, plus the
+    SampleRing the host-side spectrum at rbw is computed from. Returns (iqData, iqView, ring).
+    '''
+    iqData = (c_int16 * (2 * iqSet["bufferSize"]))()
+    nfft, _, _ = spectrum_bins(iqSet["sampleRate"], rbw)
+    return iqData, np.ctypeslib.as_array(iqData), SampleRing(max(nfft, iqSet["bufferSize"]))
+
+def alloc_trace_buffer(specSet):
+    '''
+    Allocate a C float array of specSet.traceLength once and wrap it in a NumPy view
+    sharing the same memory. SPECTRUM_GetTrace writes straight into it, so the
+    returned (traceData, traceView) pair can be reused for every trace of a run.
+    '''
+    traceData = (c_float * specSet.traceLength)()
+    traceView = np.ctypeslib.as_array(traceData)
+    return traceData, traceView
+
+def acquire_spectrum(specSet, traceBuffer=None, continuous=False, traceInfo=None):
+    # The returned array is a view on traceBuffer and is overwritten by the next call.
+    # With continuous=True the caller owns DEVICE_Run/DEVICE_Stop for the whole pass.
+    # A Spectrum_TraceInfo passed as traceInfo receives the device timestamp and acqDataStatus of the trace.
+    if traceBuffer is None:
+        traceBuffer = alloc_trace_buffer(specSet)
+    traceData, traceView = traceBuffer
     ready = c_bool(False)
-    traceArray = c_float * specSet.traceLength
-    traceData = traceArray()
     outTracePoints = c_int(0)
     traceSelector = SpectrumTraces.SpectrumTrace1
 
-    rsa.DEVICE_Run()
-    rsa.SPECTRUM_AcquireTrace()
+    if not continuous:
+        err_check(rsa.DEVICE_Run())
+    err_check(rsa.SPECTRUM_AcquireTrace())
+    deadline = monotonic() + TRACE_TIMEOUT
     while not ready.value:
-        rsa.SPECTRUM_WaitForDataReady(c_int(100), byref(ready))
-    rsa.SPECTRUM_GetTrace(traceSelector, specSet.traceLength, byref(traceData), byref(outTracePoints))
-    rsa.DEVICE_Stop()
-    
-    # Convert C float array to Python list of floats...arggghhh
-    return [float(traceData[i]) for i in range(specSet.traceLength)]
-
-def restart_service():
+        if monotonic() > deadline:
+            raise RSAError(f"No trace within {TRACE_TIMEOUT} s")
+        err_check(rsa.SPECTRUM_WaitForDataReady(c_int(100), byref(ready)))
+    err_check(rsa.SPECTRUM_GetTrace(traceSelector, specSet.traceLength, byref(traceData), byref(outTracePoints)))
+    if traceInfo is not None:
+        err_check(rsa.SPECTRUM_GetTraceInfo(byref(traceInfo)))
+    if not continuous:
+        rsa.DEVICE_Stop()
+
+    return traceView[:outTracePoints.value]
+
+def acquire_iq(iqBuffer, recorder, seconds=IQ_SPECTRUM_SECONDS):
+    '''
+    Stream `seconds` of IQ into recorder. IQSTREAM_GetIQData fills the C array of iqBuffer and
+    each block is written to the recording from that memory as is; only the SampleRing for
+    the live spectrum takes a copy. The stream must be running (InstrumentSession.start_stream).
+    Returns (scale factor V per count, OR of the acqStatus bits of every block, device timestamp
+    of the last block).
+    '''
+    iqData, iqView, ring = iqBuffer
+    iqLen = c_int(0)
+    iqInfo = IQSTRMIQINFO()
+    status = 0
+    blocks = 0
+    deadline = monotonic() + seconds
+    timeout = monotonic() + TRACE_TIMEOUT
+    while blocks == 0 or monotonic() < deadline:
+        err_check(rsa.IQSTREAM_GetIQData(byref(iqData), byref(iqLen), byref(iqInfo)))
+        if iqLen.value == 0:
+            if monotonic() > timeout:
+                raise RSAError(f"No IQ within {TRACE_TIMEOUT} s")
+            sleep(0.001)
+            continue
+        block = iqView[:2 * iqLen.value]
+        if recorder.scale_factor is None:
+            recorder.scale_factor = iqInfo.scaleFactor
+        recorder.write(block, iqInfo.acqStatus)
+        ring.push(block)
+        status |= iqInfo.acqStatus
+        blocks += 1
+        timeout = monotonic() + TRACE_TIMEOUT
+    return iqInfo.scaleFactor, status, iqInfo.timestamp
+
+def iq_acq_status(iqStatus):
+    '''AcqDataStatus bits equivalent to the IQSTRM_STATUS bits of a stream.'''
+    status = AcqDataStatus_ADC_OVERRANGE if iqStatus & IQSTRM_STATUS_OVERRANGE else 0
+    if iqStatus & (IQSTRM_STATUS_XFER_DISCONTINUITY | IQSTRM_STATUS_IBUFFOVFLOW | IQSTRM_STATUS_OBUFFOVFLOW):
+        status |= AcqDataStatus_ADC_DATA_LOST
+    return status
+
+def device_time(timestamp):
+    '''UTC datetime of a device timestamp, from the reference time the API keeps for the connected instrument.'''
+    seconds = c_int64(0)
+    nanoseconds = c_uint64(0)
+    err_check(rsa.REFTIME_GetTimeFromTimestamp(c_uint64(timestamp), byref(seconds), byref(nanoseconds)))
+    return datetime.utcfromtimestamp(seconds.value) + timedelta(microseconds=nanoseconds.value // 1000)
+
+def iq_spectrum(iqSet, ring, scaleFactor, rbw):
+    '''
+    Host-side dBm spectrum at rbw of the latest IQ in ring, trimmed to the acquisition bandwidth.
+    None while the ring holds less than one FFT segment (right after the stream started).
+    '''
+    nfft, _, _ = spectrum_bins(iqSet["sampleRate"], rbw)
+    if ring.filled // 2 < nfft:
+        return None
+    return welch(to_complex(ring.latest(), scaleFactor), iqSet["sampleRate"], rbw, iqSet["bandwidth"])[1]
+
+def iq_recording(session, band, row, aos, scheduleRunId):
+    '''Open the SigMF recording of one band of a pass in IQ_DIR.'''
+    cf, refLevel, span, rbw = session.bands[band]
+    iqSet = session.specSet
+    sat = re.sub(r'[^\w.-]', '_', row[1].strip())
+    path = os.path.join(IQ_DIR, f"{aos:%Y%m%dT%H%M%SZ}_{sat}_{cf / 1e6:.3f}MHz_RSA{session.device}")
+    return IQRecorder(path, iqSet["sampleRate"], cf, None, start=datetime.utcnow(), bandwidth=iqSet["bandwidth"],
+                      ref_level=refLevel, rbw=rbw, sat=row[1].strip(), scheduleRunId=str(scheduleRunId))
+
+class InstrumentSession:
+    '''
+    Owns the RSA connection and the bands (centre frequency, reference level, span, RBW)
+    it captures. prepare() verifies the instrument still answers with the settings of the
+    selected band and reconnects and reconfigures it in-process when it does not, so a
+    pass starts on a warm instrument and a USB drop costs a reconnect instead of a service
+    restart.
+
+    mode is ACQUISITION_MODE: bands are configured with config_spectrum(), config_dpx() or
+    config_iqstream(). In "iq" mode specSet is the config_iqstream() dict, traceBuffer the
+    alloc_iq_buffer() tuple, and the IQ stream runs between start_stream() and stop_stream(),
+    which also own DEVICE_Run/DEVICE_Stop in that mode.
+
+    Sweep mode: with several bands, select() switches between them. prepare() runs the full
+    configuration of every band not seen yet once, ahead of the pass, and caches the
+    validated settings, trace buffer and spectrumAxis id, so select() inside a pass only
+    sets what differs from the band before, usually just the centre frequency. specSet,
+    traceBuffer and axis_id follow the selected band.
+
+    spectrumAxis ids are looked up in MongoDB. If it cannot be reached the id is made here
+    and the axis document handed to writer (and so to its spool) like the traces that
+    reference it, so a database outage cannot fail a prepare() or a pass. With axis_device
+    the device index is part of every spectrumAxis document, so instruments capturing the
+    same pass and band (INSTRUMENTS workers) keep separate buckets and pass summaries.
+    '''
+
+    def __init__(self, bands, device=0, mode="spectrum", writer=None, axis_device=False):
+        self.bands = list(bands)
+        self.device = device
+        self.mode = mode
+        self.writer = writer
+        self.axis_device = axis_device
+        self.current = 0
+        self.connected = False
+        self.reconnects = 0
+        self.streaming = False
+        self._cache = {}
+        # After a failed spectrumAxis lookup MongoDB is not asked again (each try can take the
+        # driver's whole server selection timeout) until this monotonic time
+        self._axis_offline_until = 0
+        # Band whose settings the instrument holds, None after a (re)connect
+        self._applied = None
+
+    @property
+    def specSet(self):
+        return self._cache[self.current][0]
+
+    @property
+    def traceBuffer(self):
+        return self._cache[self.current][1]
+
+    @property
+    def axis_id(self):
+        return self._cache[self.current][2]
+
+    def prepare(self):
+        '''Make sure the instrument is connected and configured. Returns the seconds it took.'''
+        started = monotonic()
+        for attempt in range(1, RECONNECT_ATTEMPTS + 1):
+            try:
+                if not self.connected:
+                    self._connect()
+                elif not self._configured():
+                    logging.info("Instrument settings drifted, reconfiguring")
+                    self._applied = None
+                    self.select(self.current)
+                self._warm()
+                return monotonic() - started
+            except RSAError as e:
+                logging.error(f"Instrument session attempt {attempt}/{RECONNECT_ATTEMPTS} failed: {e}")
+                self.disconnect()
+                sleep(RECONNECT_BACKOFF * attempt)
+        raise RSAError(f"Instrument unavailable after {RECONNECT_ATTEMPTS} reconnect attempts")
+
+    def recover(self, continuous=False):
+        '''Reconnect after an error mid pass and, for a continuous run, start the instrument again.'''
+        self.disconnect()
+        self.reconnects += 1
+        elapsed = self.prepare()
+        if continuous and self.mode != "iq":
+            err_check(rsa.DEVICE_Run())
+        logging.info(f"Instrument recovered in {elapsed:.2f} s ({self.reconnects} reconnects this run)")
+
+    def disconnect(self):
+        if self.connected:
+            self.stop_stream()
+            rsa.DEVICE_Stop()
+            rsa.DEVICE_Disconnect()
+        self.connected = False
+        self.streaming = False
+        self._applied = None
+
+    def start_stream(self):
+        '''Start IQ streaming of the selected band unless it runs already. Returns True if it was started.'''
+        if self.streaming:
+            return False
+        err_check(rsa.DEVICE_Run())
+        err_check(rsa.IQSTREAM_Start())
+        self.streaming = True
+        self.traceBuffer[2].clear()
+        return True
+
+    def stop_stream(self):
+        if self.streaming:
+            rsa.IQSTREAM_Stop()
+            rsa.DEVICE_Stop()
+            self.streaming = False
+
+    def select(self, index, running=False):
+        '''Switch the instrument to band index. With running, the run is restarted so the new settings take effect.'''
+        if index == self._applied:
+            self.current = index
+            return
+        cf, refLevel, span, rbw = self.bands[index]
+        self.stop_stream()
+        # The IQ stream starts and stops the device itself
+        running = running and self.mode != "iq"
+        if running:
+            rsa.DEVICE_Stop()
+        cached = self._cache.get(index)
+        previous = self.bands[self._applied] if self._applied is not None else None
+        if self.mode == "iq":
+            # The RBW only matters to the host-side spectrum, the instrument just needs the acquisition bandwidth
+            if cached is None or previous is None or previous[1:3] != (refLevel, span):
+                iqSet = config_iqstream(cf, refLevel, span)
+                if cached is None:
+                    iqBuffer = alloc_iq_buffer(iqSet, rbw)
+                    _, _, offsets = spectrum_bins(iqSet["sampleRate"], rbw, iqSet["bandwidth"])
+                    self._cache[index] = (iqSet, iqBuffer, self._axis_id(iq_axis(offsets, cf, iqSet["bandwidth"], rbw, refLevel)))
+            else:
+                err_check(rsa.CONFIG_SetCenterFreq(c_double(cf)))
+        elif self.mode == "dpx":
+            if cached is None or previous is None or previous[1:] != (refLevel, span, rbw):
+                # DPX_SetParameters carries span, RBW and the bitmap's dBm range, there is no cheaper partial update
+                dpxSet = config_dpx(cf, refLevel, span, rbw)
+                if cached is None:
+                    self._cache[index] = (dpxSet, None, self._axis_id(dpx_axis(dpxSet, cf, span, refLevel)))
+            else:
+                err_check(rsa.CONFIG_SetCenterFreq(c_double(cf)))
+        elif cached is None:
+            specSet = config_spectrum(cf, refLevel, span, rbw)
+            # Frequency axis is stored once per configuration and referenced by every trace
+            self._cache[index] = (specSet, alloc_trace_buffer(specSet), self._axis_id(spectrum_axis(specSet, cf, refLevel)))
+        elif self._applied is None:
+            # Instrument was preset by a (re)connect, the cached settings go back in without a SetDefault/GetSettings round-trip
+            err_check(rsa.SPECTRUM_SetEnable(c_bool(True)))
+            err_check(rsa.CONFIG_SetCenterFreq(c_double(cf)))
+            err_check(rsa.CONFIG_SetReferenceLevel(c_double(refLevel)))
+            err_check(rsa.SPECTRUM_SetSettings(cached[0]))
+        else:
+            _, previousRefLevel, previousSpan, previousRbw = self.bands[self._applied]
+            err_check(rsa.CONFIG_SetCenterFreq(c_double(cf)))
+            if refLevel != previousRefLevel:
+                err_check(rsa.CONFIG_SetReferenceLevel(c_double(refLevel)))
+            if (span, rbw) != (previousSpan, previousRbw):
+                err_check(rsa.SPECTRUM_SetSettings(cached[0]))
+        self._applied = self.current = index
+        if running:
+            err_check(rsa.DEVICE_Run())
+
+    def _warm(self):
+        '''Configure and cache every band that is not cached yet, then go back to the selected one.'''
+        current = self.current
+        missing = [index for index in range(len(self.bands)) if index not in self._cache]
+        if not missing:
+            return
+        for index in missing:
+            self.select(index)
+        self.select(current)
+        logging.info(f"Cached the settings of {len(missing)} bands")
+
+    def _axis_id(self, axis):
+        if self.axis_device:
+            axis = {**axis, "device": self.device}
+        if monotonic() >= self._axis_offline_until or self.writer is None:
+            try:
+                return upsert_axis(spectrumAxis, axis)
+            except PyMongoError as e:
+                if self.writer is None:
+                    raise
+                self._axis_offline_until = monotonic() + SESSION_LEAD
+                logging.error(f"spectrumAxis lookup failed, storing new axis documents through the writer for the next {SESSION_LEAD} s: {e}")
+        axis = {"_id": ObjectId(), **axis}
+        logging.info(f"spectrumAxis document {axis['_id']} for {axis['centerFreq'] / 1e6:.3f} MHz made locally")
+        if not self.writer.store(spectrumAxis.name, axis):
+            logging.error(f"Writer did not take spectrumAxis document {axis['_id']}")
+        return axis["_id"]
+
+    def _connect(self):
+        search_connect(self.device)
+        self.connected = True
+        self._applied = None
+        logging.info(f"Connected to RSA306B {self.device}")
+        self.select(self.current)
+
+    def _configured(self):
+        cf = c_double(0)
+        refLevel = c_double(0)
+        specSet = Spectrum_Settings()
+        err_check(rsa.CONFIG_GetCenterFreq(byref(cf)))
+        err_check(rsa.CONFIG_GetReferenceLevel(byref(refLevel)))
+        band_cf, band_refLevel, _, _ = self.bands[self.current]
+        if abs(cf.value - band_cf) >= 1 or abs(refLevel.value - band_refLevel) >= 0.01:
+            return False
+        if self.mode != "spectrum":
+            return True
+        err_check(rsa.SPECTRUM_GetSettings(byref(specSet)))
+        return specSet.span == self.specSet.span and specSet.rbw == self.specSet.rbw
+
+class InstrumentWorker:
+    '''
+    One entry of INSTRUMENTS driven by instrument_worker() in its own process. send() queues
+    a command for it and restarts the process first if it died. flushed is set by the
+    document forwarder once a flush the worker asked for is done.
+    '''
+
+    def __init__(self, instrument, documents, context):
+        self.instrument = instrument
+        self.documents = documents
+        self.context = context
+        self.commands = context.Queue()
+        self.flushed = context.Event()
+        self.process = None
+
+    def start(self):
+        self.process = self.context.Process(target=instrument_worker, args=(self.instrument, self.commands, self.documents, self.flushed, control),
+                                            name=f"RSA{self.instrument['device']}", daemon=True)
+        self.process.start()
+
+    def send(self, *command):
+        if not self.process.is_alive():
+            logging.error(f"Instrument worker {self.instrument['device']} exited ({self.process.exitcode}), restarting it")
+            self.start()
+        self.commands.put(command)
+
+    def stop(self, timeout=30):
+        self.commands.put(None)
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+
+def instrument_worker(instrument, commands, documents, flushed, sharedControl):
+    '''Worker process body: run prepare and pass commands for one instrument until None arrives.'''
+    global control
+    control = sharedControl
+    writer = QueueWriter(documents, flushed=flushed, key=instrument["device"])
+    session = InstrumentSession(instrument["bands"], device=instrument["device"], mode=instrument.get("mode", ACQUISITION_MODE), writer=writer, axis_device=True)
+    captureContext.update(session=session, writer=writer)
+    logging.info(f"Instrument worker {instrument['device']} started (pid {os.getpid()})")
     try:
-        logging.info("Attempting to restart IFSS.service")
-        subprocess.run(['sudo', '/home/its/IFSS/Tools/restart_IFSS.sh'], check=True)
-        logging.info(f"Successfully requested restart IFSS.service.")
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Failed to restart the IFSS.service: {e}")
-    except Exception as e:
-        logging.error(f"Unexpected error while restarting the IFSS.service: {e}")
-
-def handle_pause(log_message, restart_message=None, sleep_time=5, loop_completed=None):
-    log_flag = True
-    was_paused = False
-    while os.path.exists("/home/its/IFSS/pause_flag.txt"):
-        if log_flag:
-            logging.info(log_message)
-            log_flag = False
-        was_paused = True
-        sleep(sleep_time)
-    
-        if was_paused:
-            logging("Instrument after pause successful")
-
-            if restart_message:
-                logging.info(restart_message)
-            if loop_completed is not None:
-                loop_completed[0] = False
-
-        return was_paused
-
-def process_schedule(specSet, freq_list_mhz):
+        session.prepare()
+    except RSAError as e:
+        logging.error(f"Instrument worker {instrument['device']} could not connect yet, retrying before its next pass: {e}")
+    for command in iter(commands.get, None):
+        name, args = command[0], command[1:]
+        try:
+            if name == "prepare":
+                session.prepare()
+            elif name == "pass":
+                row, aos, los, scheduleRunId = args
+                capture_pass(session, writer, row, aos, los, [True], scheduleRunId=scheduleRunId)
+        except Exception as e:
+            logging.error(f"Instrument worker {instrument['device']} {name} failed: {e}")
+    session.disconnect()
+
+def captures(instrument, row):
+    return instrument["sats"] is None or row[1].strip() in instrument["sats"]
+
+def acquire_dpx(refLevel, seconds=DPX_SUMMARY_SECONDS, continuous=False):
+    '''
+    Collect DPX frames for `seconds` and reduce them to one summary. The frame traces, the
+    spectrum bitmap and the spectrogram bitmap are read in place through NumPy views on the
+    API's buffers and folded into running max/sum/spread/occupancy counts before
+    DPX_FinishFrameBuffer hands them back.
+    Returns (max-hold dBm trace, encode_dpx_summary() document fields, OR of the frames' acqDataStatus).
+    '''
+    frameBuffer = DPX_FrameBuffer()
+    ready = c_bool(False)
+    available = c_bool(False)
+    # Spectrogram pixel value of the occupancy threshold (the bitmap spans yBottom..yTop as 0..255)
+    level = np.clip((DPX_OCCUPANCY_THRESHOLD - (refLevel - DPX_DYNAMIC_RANGE)) / DPX_DYNAMIC_RANGE * 255, 0, 255)
+    maxHold = total = hits = spread = None
+    frames = ffts = lines = 0
+    status = 0
+    minSigDuration = None
+
+    if not continuous:
+        err_check(rsa.DEVICE_Run())
+    deadline = monotonic() + seconds
+    while frames == 0 or monotonic() < deadline:
+        ready.value = False
+        timeout = monotonic() + TRACE_TIMEOUT
+        while not ready.value:
+            if monotonic() > timeout:
+                raise RSAError(f"No DPX frame within {TRACE_TIMEOUT} s")
+            err_check(rsa.DPX_WaitForDataReady(c_int(100), byref(ready)))
+        err_check(rsa.DPX_IsFrameBufferAvailable(byref(available)))
+        if not available.value:
+            continue
+        err_check(rsa.DPX_GetFrameBuffer(byref(frameBuffer)))
+        try:
+            length = frameBuffer.spectrumTraceLength
+            frameMax = np.ctypeslib.as_array(frameBuffer.spectrumTraces[0], shape=(length,))
+            frameAvg = np.ctypeslib.as_array(frameBuffer.spectrumTraces[2], shape=(length,))
+            if maxHold is None:
+                maxHold = frameMax.copy()
+                total = frameAvg.astype(np.float64)
+            else:
+                np.maximum(maxHold, frameMax, out=maxHold)
+                total += frameAvg
+            # Bitmap rows with hits per column, the amplitude range a point was seen across
+            bitmap = np.ctypeslib.as_array(frameBuffer.spectrumBitmap, shape=(frameBuffer.spectrumBitmapHeight, frameBuffer.spectrumBitmapWidth))
+            rows = np.count_nonzero(bitmap, axis=0)
+            spread = rows if spread is None else np.maximum(spread, rows, out=spread)
+            valid = frameBuffer.sogramBitmapNumValidLines
+            if valid:
+                sogram = np.ctypeslib.as_array(frameBuffer.sogramBitmap, shape=(frameBuffer.sogramBitmapHeight, frameBuffer.sogramBitmapWidth))[:valid]
+                counts = np.count_nonzero(sogram >= level, axis=0)
+                hits = counts if hits is None else hits + counts
+                lines += valid
+            frames += 1
+            ffts += frameBuffer.fftPerFrame
+            status |= frameBuffer.acqDataStatus
+            minSigDuration = frameBuffer.minSigDuration
+        finally:
+            err_check(rsa.DPX_FinishFrameBuffer())
+    if not continuous:
+        err_check(rsa.DEVICE_Stop())
+
+    # DPX traces are linear power in W
+    maxHold_dbm = 10 * np.log10(np.maximum(maxHold, 1e-20)) + 30
+    mean_dbm = 10 * np.log10(np.maximum(total / frames, 1e-20)) + 30
+    occupancy = np.rint(hits * 100.0 / lines) if lines else np.zeros(len(maxHold))
+    spread_db = spread * (DPX_DYNAMIC_RANGE / frameBuffer.spectrumBitmapHeight)
+    return maxHold_dbm, encode_dpx_summary(maxHold_dbm, mean_dbm, occupancy, DPX_OCCUPANCY_THRESHOLD, frames, ffts, minSigDuration, spread_db), status
+
+def handle_pause(log_message, restart_message=None, loop_completed=None):
+    # Only reads the in-memory flag set by the control channel, cheap enough for every trace
+    if not control.paused:
+        return False
+    logging.info(log_message)
+    control.wait_resumed()
+    logging.info("Instrument after pause successful")
+
+    if restart_message:
+        logging.info(restart_message)
+    if loop_completed is not None:
+        loop_completed[0] = False
+    return True
+
+def control_status():
+    '''Extra fields for control channel status replies.'''
+    session = captureContext.get("session")
+    writer = captureContext.get("writer")
+    return {
+        "currentPass": captureContext.get("current"),
+        "nextPasses": [{"sat": row[1].strip(), "aos": aos, "los": los} for aos, los, row in passIndex.passes()[:5]],
+        "writer": writer.stats() if writer is not None else None,
+        "reconnects": session.reconnects if session is not None else None,
+        "instruments": [{"device": worker.instrument["device"], "alive": worker.process.is_alive()}
+                        for worker in captureContext.get("workers") or []],
+    }
+
+def load_schedule(path=CSV_FILE_PATH):
+    '''Merge the rows of schedule.csv into the rolling pass index. Safe to call from any thread, at any time.'''
+    with open(path, 'r') as csvfile:
+        csvreader = csv.reader(csvfile)
+        next(csvreader)
+        # Investigate me
+        rows = [row for row in csvreader if len(row) >= 9]
+    merged = passIndex.merge(rows)
+    upcoming = passIndex.passes()
+    logging.info(f"Loaded {path}: {merged} passes added or rescheduled, {len(upcoming)} in the next {passIndex.window}")
+    if upcoming:
+        logging.info(f"Pass index covers {upcoming[0][0]} to {upcoming[-1][1]}")
+    return merged
+
+def process_schedule(session, writer, workers=None):
     """
-    This function is the timing and capture behind IFSS code.  Connect to RSA360 and setup for capture. Then read the CSV_FILE_PATH and goes through each row determining
-    aos/los, etc and compares against current time.  Three scenarios:
-       * If older entries exist continue (skip)
-       *  If current time matches an aos, data is being captured until los
-        * If current time doesnt meet aos time then continue (wait for aos)
+    This function is the timing and capture behind IFSS code. The schedule (CSV_FILE_PATH) is loaded through
+    load_schedule(), which leaves out passes that have already ended, and the upcoming rows are held in a rolling 48 hour
+    PassIndex. Its AOS events run on passScheduler, which sleeps until exactly the next AOS instead of polling the clock
+    every second; capture_pass() then runs the pass until LOS, on an instrument
+    session (InstrumentSession) that prepare_pass() checked SESSION_LEAD seconds earlier. With workers (several
+    INSTRUMENTS) both are handed to the worker processes of the instruments assigned the pass instead. This runs until the
+    service stops: each daily fetch (IFSS.py) merges the new schedule through load_schedule() while capture carries on.
+    Traces are stored as packed blobs referencing the session's spectrumAxis document (see IFSS_Storage.py) and are handed to writer (an IFSS_Pipeline.TraceWriter) so database latency never delays the next trace.
     """
 
-    loop_completed = [True]
+    captureContext.update(session=session, writer=writer, workers=workers)
 
-    with open(CSV_FILE_PATH, 'r') as csvfile:
-        csvreader = csv.reader(csvfile)
-        next(csvreader)
-        logging.info("Opened csv file and started process_schedule()")
-
-        for row in csvreader:
-            handle_pause("Pause flag detected at start of row.", "Pause_flag removed. Restarting schedule...", loop_completed=loop_completed)
-
-            # Investigate me
-            if len(row) < 5:
-                logging.info(f"End of rows in schedule")
-                continue
-
-            aos_time = datetime.strptime(row[6], '%H:%M:%S').time()
-            los_time = datetime.strptime(row[8], '%H:%M:%S').time()
-
-            now = datetime.utcnow().time()
-
-            # If current time has already passed the scheduled los_datetime, skip to the next schedule
-            if now > los_time:
-                continue
-
-            # If current time is before the scheduled aos_time, wait until aos_time is reached
-            while now < aos_time:
-                # logging.info("now < aos_time")
-                handle_pause("Pause flag detected. Pausing pass schedule.", "Pause_flag removed. Restarting schedule...", sleep_time=1, loop_completed=loop_completed)
-                now = datetime.utcnow().time()
-                sleep(1)
-
-            # Adding a trigger to provide single hit log and start running
-            triggered = False
-
-            #Between AOL/LOS time
-            while True:
-                # logging.info(f'Triggered: {triggered}')
-                handle_pause("Schedule paused. Waiting for flag to be removed.", "Pause_flag removed. Restarting schedule...", loop_completed=loop_completed)
-                
-                now = datetime.utcnow().time()
-                if now >= los_time:
-                    break
-                    
-                if not triggered:
-                    logging.info(f'Current scheduled row under test: {row}')
-                    triggered = True
-
-                    # Insert the schedule data into MongoDB as a single document
-                    schedule_document = {
-                        "timestamp": datetime.utcnow(),
-                        "row": row,
-                        }
-                    insert_result = scheduleRun.insert_one(schedule_document)
-                    document_id = insert_result.inserted_id
-                
-                # Intrumentation happens here
-                trace = acquire_spectrum(specSet)
-                currentTime = datetime.today().isoformat(sep=' ', timespec='milliseconds')
-
-                # Create a document for MongoDB and insert into thew collection
-                frequencies = {str(round(freq, 4)): float(value) for freq, value in zip(freq_list_mhz, trace)}
-                document = {
-                    "timestamp": currentTime,
-                    "frequencies": frequencies
-                }
-                spectrumData.insert_one(document)
-                sleep(1)
+    try:
+        load_schedule()
+    except OSError as e:
+        logging.error(f"Could not read {CSV_FILE_PATH}, waiting for the next schedule fetch: {e}")
+    logging.info("Started process_schedule()")
+    passScheduler.run()
+
+def prepare_pass(row, aos, los):
+    if captureContext["workers"]:
+        for worker in captureContext["workers"]:
+            if captures(worker.instrument, row):
+                worker.send("prepare")
+        return
+    if not captures(INSTRUMENTS[0], row):
+        return
+    elapsed = captureContext["session"].prepare()
+    logging.info(f"Instrument ready for {row[1].strip()} in {elapsed:.2f} s, AOS {aos}")
+
+def run_pass(row, aos, los):
+    if captureContext["workers"]:
+        assigned = [worker for worker in captureContext["workers"] if captures(worker.instrument, row)]
+        if not assigned:
+            return
+        # One scheduleRun document per pass, each worker adds its results under instruments.<device>.
+        # It goes through the writer so MongoDB latency cannot hold up the pass scheduler.
+        document_id = ObjectId()
+        captureContext["writer"].store(scheduleRun.name, {"_id": document_id, "timestamp": datetime.utcnow(), "row": row})
+        # Workers capture in parallel, the pass scheduler moves straight on to the next event
+        for worker in assigned:
+            worker.send("pass", row, aos, los, document_id)
+        return
+    if captures(INSTRUMENTS[0], row):
+        capture_pass(captureContext["session"], captureContext["writer"], row, aos, los, [True])
+
+def capture_pass(session, writer, row, aos, los, loop_completed, scheduleRunId=None):
+    '''
+    Capture one pass until LOS. The pass's scheduleRun document is made at AOS, or with
+    scheduleRunId (instrument workers) was made by run_pass() and this instrument's results
+    go under its instruments.<device>.
+    '''
+    handle_pause("Schedule paused at start of row.", "Schedule resumed. Restarting schedule...", loop_completed=loop_completed)
+    if control.take_skip():
+        logging.info(f"Skipping row {row} on operator request")
+        return
+
+    # Adding a trigger to provide single hit log and start running
+    triggered = False
+    trace_count = 0
+    # Sweep position and per band [traces, first, last] visit times for revisit rates
+    band = 0
+    band_visits = [[0, None, None] for _ in session.bands]
+    # IQ recordings of the pass by band ("iq" mode)
+    recordings = {}
+    # Running per band statistics, stored as the pass's spectrumPassSummary at LOS
+    accumulators = {}
+    traceInfo = Spectrum_TraceInfo()
+    # Traces carrying each ACQ_STATUS_FLAGS bit, and the device-timed trace intervals as [count, mean, M2] (Welford)
+    flagged = dict.fromkeys(ACQ_STATUS_FLAGS, 0)
+    intervals = [0, 0.0, 0.0]
+    previous_acquired = None
+    previous_status = 0
+
+    #Between AOL/LOS time
+    while True:
+        # logging.info(f'Triggered: {triggered}')
+        handle_pause("Schedule paused. Waiting for resume.", "Schedule resumed. Restarting schedule...", loop_completed=loop_completed)
+        
+        now = datetime.utcnow()
+        if now >= los:
+            break
+        if control.take_skip():
+            logging.info(f"Skipping rest of row {row} on operator request")
+            loop_completed[0] = False
+            break
             
-            # Updating scheduleRun after processing a row
-            if loop_completed[0]:  # This block and the else block need adjustment
-                document_update = {"$set": {"processed": "true"}}
-                logging.info("Scheduled row completed successfully and database updated!")
+        if not triggered:
+            logging.info(f'Current scheduled row under test: {row}')
+            triggered = True
+            captureContext["current"] = {"sat": row[1].strip(), "aos": aos, "los": los}
+            # How long after the scheduled AOS capture actually started
+            start_latency_ms = (now - aos).total_seconds() * 1000
+
+            if scheduleRunId is not None:
+                document_id = scheduleRunId
             else:
-                document_update = {"$set": {"processed": "false"}}
-                logging.info("Scheduled row encountered errors.")
-
-            update_result = scheduleRun.update_one({"_id": document_id}, document_update)
-            logging.info(f"Updated document _id: {document_id}, Matched count: {update_result.matched_count}, Modified count: {update_result.modified_count}")
+                # Insert the schedule data into MongoDB as a single document. The _id is made
+                # here so the pass keeps capturing (and is upserted at LOS) if MongoDB is down.
+                document_id = ObjectId()
+                schedule_document = {
+                    "_id": document_id,
+                    "timestamp": datetime.utcnow(),
+                    "row": row,
+                    }
+                try:
+                    scheduleRun.insert_one(schedule_document)
+                except Exception as e:
+                    logging.error(f"Could not insert scheduleRun document at AOS, continuing capture: {e}")
+
+            reconnects_at_aos = session.reconnects
+            if CONTINUOUS_RUN and session.mode != "iq":
+                rsa.DEVICE_Run()
+            pass_start = monotonic()
+            dropped_at_aos = writer.stats()["dropped"]
+        
+        # Intrumentation happens here
+        try:
+            session.select(band, running=CONTINUOUS_RUN)
+            # DPX frame timestamps are not usable through this binding (int64 on the device, c_double in RSA_API.py)
+            deviceTicks = None
+            if session.mode == "dpx":
+                trace, fields, acqStatus = acquire_dpx(session.bands[band][1], continuous=CONTINUOUS_RUN)
+            elif session.mode == "iq":
+                restarted = session.start_stream()
+                recorder = recordings.get(band)
+                if recorder is None:
+                    recorder = recordings[band] = iq_recording(session, band, row, aos, document_id)
+                elif restarted:
+                    recorder.new_capture(session.bands[band][0])
+                scaleFactor, iqStatus, deviceTicks = acquire_iq(session.traceBuffer, recorder)
+                if iqStatus & (IQSTRM_STATUS_IBUFFOVFLOW | IQSTRM_STATUS_OBUFFOVFLOW):
+                    logging.error(f"IQ stream overflowed, samples lost in {recorder.path}")
+                acqStatus = iq_acq_status(iqStatus)
+                ring = session.traceBuffer[2]
+                trace = iq_spectrum(session.specSet, ring, scaleFactor, session.bands[band][3])
+                if trace is None:
+                    # Not one FFT segment of IQ yet, the band keeps streaming until there is
+                    continue
+                fields = {**encode_trace(trace), "iq": {"recording": os.path.basename(recorder.path), "sample": recorder.samples - ring.filled // 2}}
+            else:
+                trace = acquire_spectrum(session.specSet, session.traceBuffer, continuous=CONTINUOUS_RUN, traceInfo=traceInfo)
+                fields = encode_trace(trace)
+                deviceTicks, acqStatus = traceInfo.timestamp, traceInfo.acqDataStatus
+            currentTime = datetime.utcnow()
+            acquired = device_time(deviceTicks) if deviceTicks is not None else currentTime
+        except RSAError as e:
+            logging.error(f"Acquisition failed mid pass, reconnecting the instrument: {e}")
+            session.recover(continuous=CONTINUOUS_RUN)
+            continue
+        trace_count += 1
+        names = [name for name, bit in ACQ_STATUS_FLAGS.items() if acqStatus & bit]
+        for name in names:
+            flagged[name] += 1
+        if acqStatus != previous_status:
+            # Logged on change only, an overrange can last a whole pass
+            logging.info(f"Instrument status from {acquired}: {', '.join(names) or 'ok'} ({acqStatus:#x})")
+            previous_status = acqStatus
+        if previous_acquired is not None:
+            interval = (acquired - previous_acquired).total_seconds() * 1000
+            intervals[0] += 1
+            delta = interval - intervals[1]
+            intervals[1] += delta / intervals[0]
+            intervals[2] += delta * (interval - intervals[1])
+        previous_acquired = acquired
+        if band not in accumulators:
+            accumulators[band] = (session.axis_id, TraceAccumulator(len(trace)))
+        accumulators[band][1].add(trace, acquired)
+        visits = band_visits[band]
+        visits[0] += 1
+        visits[2] = monotonic()
+        if visits[1] is None:
+            visits[1] = visits[2]
+        if trace_count == 1:
+            first_trace_ms = (currentTime - aos).total_seconds() * 1000
+            budget_ms = FIRST_TRACE_BUDGET_MS[session.mode]
+            if first_trace_ms > budget_ms:
+                logging.info(f"First trace {first_trace_ms:.0f} ms after AOS, over the {budget_ms} ms {session.mode} budget")
+
+        # Create a document for MongoDB and queue it for the writer thread
+        document = {
+            "timestamp": acquired,
+            "meta": {"axisId": session.axis_id, "scheduleRunId": document_id, "sat": row[1], "acqStatus": acqStatus},
+            **fields
+        }
+        if deviceTicks is not None:
+            document["deviceTicks"] = deviceTicks
+            # Transfer and processing time between acquisition and the host having the trace
+            document["hostLagMs"] = round((currentTime - acquired).total_seconds() * 1000, 3)
+        writer.submit(document)
+        band = (band + 1) % len(session.bands)
+        if TRACE_INTERVAL and band == 0 and session.mode == "spectrum":
+            sleep(TRACE_INTERVAL)
+
+    captureContext["current"] = None
+    if not triggered:
+        logging.info(f"LOS already passed for row {row}, nothing captured")
+        return
+
+    session.stop_stream()
+    for recorder in recordings.values():
+        recorder.close()
+        logging.info(f"IQ recording {recorder.path}: {recorder.samples} samples")
+    if CONTINUOUS_RUN and session.mode != "iq":
+        rsa.DEVICE_Stop()
+
+    # Achieved trace rate for comparing continuous and per-trace run modes
+    elapsed = monotonic() - pass_start
+    traces_per_second = trace_count / elapsed if elapsed > 0 else 0.0
+    run_mode = "continuous" if CONTINUOUS_RUN else "per-trace"
+    logging.info(f"Pass captured {trace_count} traces in {elapsed:.1f} s ({traces_per_second:.2f} traces/s, {run_mode} run), started {start_latency_ms:.1f} ms after AOS")
+    # Make sure the whole pass is in the database (or the local spool) before closing it out.
+    # Only this pass's buckets are closed, other instruments may still be capturing theirs.
+    if not writer.flush(scheduleRunId=document_id, axisIds=[axis_id for axis_id, _ in accumulators.values()]):
+        logging.error("Writer did not flush within timeout at LOS")
+    bands = []
+    for (cf, refLevel, span, rbw), (count, first, last) in zip(session.bands, band_visits):
+        revisit = (last - first) / (count - 1) if count > 1 else None
+        bands.append({"centerFreq": cf, "span": span, "rbw": rbw, "refLevel": refLevel, "traceCount": count, "revisitSeconds": revisit})
+        if len(session.bands) > 1:
+            logging.info(f"Band {cf / 1e6:.3f} MHz: {count} traces, revisited every {revisit or 0:.3f} s")
+    writer_stats = writer.stats()
+    dropped = writer_stats["dropped"] - dropped_at_aos
+    logging.info(f"Writer queue after pass: {writer_stats}")
+    pass_stats = {"traceCount": trace_count, "tracesPerSecond": traces_per_second, "runMode": run_mode, "droppedTraces": dropped,
+                  "aosLatencyMs": start_latency_ms, "firstTraceMs": first_trace_ms if trace_count else None,
+                  "reconnects": session.reconnects - reconnects_at_aos, "bands": bands, "flaggedTraces": flagged,
+                  "traceIntervalMs": intervals[1] if intervals[0] else None,
+                  "traceJitterMs": (intervals[2] / (intervals[0] - 1)) ** 0.5 if intervals[0] > 1 else None}
+    for band, (axis_id, accumulator) in accumulators.items():
+        summary = accumulator.document(axis_id, document_id, row[1])
+        try:
+            spectrumPassSummary.replace_one({"scheduleRunId": document_id, "axisId": axis_id}, summary, upsert=True)
+        except Exception as e:
+            logging.error(f"Could not store the pass summary of band {session.bands[band][0] / 1e6:.3f} MHz: {e}")
+    if recordings:
+        pass_stats["iqRecordings"] = [{"path": recorder.path, "samples": recorder.samples} for recorder in recordings.values()]
+    
+    # Updating scheduleRun after processing a row
+    if loop_completed[0]:  # This block and the else block need adjustment
+        results = {"processed": "true", **pass_stats}
+        logging.info("Scheduled row completed successfully and database updated!")
+    else:
+        results = {"processed": "false", **pass_stats}
+        logging.info("Scheduled row encountered errors.")
+    if scheduleRunId is not None:
+        document_update = {"$set": {f"instruments.{session.device}": results}}
+    else:
+        document_update = {"$set": results}
+
+    document_update["$setOnInsert"] = {"timestamp": datetime.utcnow(), "row": row}
+    try:
+        update_result = scheduleRun.update_one({"_id": document_id}, document_update, upsert=True)
+    except Exception as e:
+        logging.error(f"Could not update scheduleRun document {document_id} at LOS: {e}")
+        return
+    logging.info(f"Updated document _id: {document_id}, Matched count: {update_result.matched_count}, Modified count: {update_result.modified_count}")
+
+def stop_workers(workers, forwarder, timeout=30):
+    if not workers:
+        return
+    for worker in workers:
+        worker.stop()
+    # Lets the forwarder hand everything already queued to the writer and exit
+    workers[0].documents.put(None)
+    forwarder.join(timeout)
 
 def main():
     logging.info("Started IFSS_RSA main routine")
 
-    # Instrumentat setup here
-    search_connect()
-    logging.info("Connected to RSA306B")
-
-    cf_mhz = 140.0
-    span_mhz = 15.0
-    rbw_khz = 15.0
-    refLevel = -30
-    
-    # Convert MHz to Hz for the API calls
-    cf_hz = cf_mhz * 1e6
-    span_hz = span_mhz * 1e6
-    rbw_hz = rbw_khz * 1e3
-    
-    specSet = config_spectrum(cf_hz, refLevel, span_hz, rbw_hz)
-    spec_settings = Spectrum_Settings()
-    err_check(rsa.SPECTRUM_GetSettings(byref(spec_settings)))
-    trace_length = spec_settings.traceLength
-    
-    # Adjust frequency list calculation for 10 frequency points using MHz values
-    startfreq_mhz = cf_mhz - (span_mhz / 2)
-    stopfreq_mhz = cf_mhz + (span_mhz / 2)
-    step_mhz = (stopfreq_mhz - startfreq_mhz) / (trace_length - 1)
-    freq_list_mhz = [startfreq_mhz + i * step_mhz for i in range(trace_length)]
+    ensure_spectrum_collection(db)
+    ensure_bucket_collection(db)
+    ensure_aggregate_collections(db)
 
+    feed = spool = writer = session = workers = forwarder = controlServer = None
     try:
-        process_schedule(specSet, freq_list_mhz)
-        logging.info("Schedule finished for the day.\n")
-    except Exception as e:
-        logging.info(f"An error occurred in IFSS_PXA.py main(): {e}")
-        restart_service()
+        # Traces go to the dashboard as they are submitted, see IFSS_Live.py
+        feed = LiveFeed()
+        feed.start()
+        spool = TraceSpool(SPOOL_DIR)
+        writer = TraceWriter(spectrumData, batch_size=WRITE_BATCH_SIZE, flush_interval=WRITE_FLUSH_INTERVAL, write_concern=WRITE_CONCERN, bucket_collection=spectrumBuckets,
+                             collections=[spectrumAxis, scheduleRun], spool=spool, feed=feed)
+        writer.start()
+
+        # Instrumentat setup here, checked again ahead of every pass
+        if len(INSTRUMENTS) == 1:
+            session = InstrumentSession(INSTRUMENTS[0]["bands"], device=INSTRUMENTS[0]["device"], mode=INSTRUMENTS[0].get("mode", ACQUISITION_MODE), writer=writer)
+            session.prepare()
+        else:
+            # spawn, so every worker loads its own RSA API and MongoDB client
+            context = multiprocessing.get_context("spawn")
+            documents = context.Queue(WORKER_QUEUE_SIZE)
+            workers = [InstrumentWorker(instrument, documents, context) for instrument in INSTRUMENTS]
+            flushed = {worker.instrument["device"]: worker.flushed for worker in workers}
+            forwarder = threading.Thread(target=forward_documents, args=(documents, writer, flushed), name="WorkerForwarder", daemon=True)
+            forwarder.start()
+            for worker in workers:
+                worker.start()
+            logging.info(f"Started {len(workers)} instrument workers")
+        controlServer = ControlServer(control, status=control_status)
+        controlServer.start()
+        process_schedule(session, writer, workers)
+        logging.info("Pass scheduler stopped.\n")
+    finally:
+        # Everything main() started is torn down, errors included, so run_capture() (IFSS.py) can
+        # call it again in this process without leaking the spool, sockets or pass events
+        if controlServer is not None:
+            controlServer.stop()
+        stop_workers(workers, forwarder)
+        if writer is not None:
+            writer.stop()
+        if spool is not None:
+            spool.close()
+        if session is not None:
+            session.disconnect()
+        if feed is not None:
+            feed.stop()
+        passScheduler.stop()
+        passIndex.clear()
+        captureContext.clear()
 
 if __name__ == "__main__":
     try:    
@@ -0,0 +1,161 @@
+from datetime import datetime, timedelta
+import logging
+from time import sleep
+import numpy as np
+from pymongo import MongoClient, ReplaceOne, ASCENDING
+from IFSS_Storage import (SPECTRUM_TTL_DAYS, ensure_aggregate_collections, ensure_spectrum_expiry, load_pass, decode_trace,
+                          document_axis_id, minute_documents, pass_summary_document)
+
+# Tiered retention for spectrum data, run as its own service (Tools/systemd/IFSS_retention.service)
+#   * raw traces are kept at full resolution in their pass buckets (spectrumBuckets) for RAW_RETENTION_DAYS;
+#     the per-trace spectrumData copy is only the recent tier and expires after IFSS_Storage.SPECTRUM_TTL_DAYS
+#   * older passes are rolled into per-minute min/mean/max aggregates (spectrumMinute) and one
+#     summary per pass (spectrumPassSummary, unless IFSS_RSA stored one at LOS), then their buckets are deleted
+#   * minute aggregates are kept for MINUTE_RETENTION_DAYS, pass summaries indefinitely
+#   * if the database grows past DISK_BUDGET_BYTES the oldest data is shed tier by tier
+
+RAW_RETENTION_DAYS = 7
+# Legacy spectrumData traces (no buckets) are rolled up this long before their TTL removes them
+RAW_EXPIRY_GRACE_DAYS = 1
+MINUTE_RETENTION_DAYS = 90
+DISK_BUDGET_BYTES = 50 * 1024 ** 3
+RETENTION_INTERVAL = 3600
+
+# MongoDB setup
+client = MongoClient('mongodb://localhost:27017/')
+db = client["ifss"]
+spectrumData = db["spectrumData"]
+spectrumBuckets = db["spectrumBuckets"]
+retentionState = db["retentionState"]
+spectrumMinute = db["spectrumMinute"]
+spectrumPassSummary = db["spectrumPassSummary"]
+
+# Reset the Root Logger and seup logging
+for handler in logging.root.handlers[:]:
+    logging.root.removeHandler(handler)
+logging.basicConfig(filename='/home/its/IFSS/IFSS_SA.log', level=logging.INFO, format='%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+def write_minutes(documents):
+    if documents:
+        spectrumMinute.bulk_write([ReplaceOne({"scheduleRunId": d["scheduleRunId"], "axisId": d["axisId"], "minute": d["minute"]}, d, upsert=True)
+                                   for d in documents], ordered=False)
+
+def rollup_pass(scheduleRunId):
+    '''Aggregate every axis of one pass into spectrumMinute and spectrumPassSummary, then drop its buckets.'''
+    for axisId in spectrumBuckets.distinct("axisId", {"scheduleRunId": scheduleRunId}):
+        loaded = load_pass(spectrumBuckets, scheduleRunId, axisId)
+        if loaded is None:
+            continue
+        timestamps, traces, _ = loaded
+        sat = spectrumBuckets.find_one({"scheduleRunId": scheduleRunId}, {"sat": 1}).get("sat")
+        write_minutes(minute_documents(timestamps, traces, axisId, scheduleRunId, sat))
+        summary = pass_summary_document(timestamps, traces, axisId, scheduleRunId, sat)
+        # A summary stored at LOS by IFSS_RSA also carries std and percentiles, keep it
+        spectrumPassSummary.update_one({"scheduleRunId": scheduleRunId, "axisId": axisId}, {"$setOnInsert": summary}, upsert=True)
+    deleted = spectrumBuckets.delete_many({"scheduleRunId": scheduleRunId}).deleted_count
+    logging.info(f"Retention rolled up pass {scheduleRunId}, {deleted} buckets removed")
+
+def expired_passes(cutoff, limit=None):
+    '''scheduleRun ids whose last bucket ended before cutoff, oldest first.'''
+    pipeline = [
+        {"$match": {"start": {"$lt": cutoff}}},
+        {"$group": {"_id": "$scheduleRunId", "end": {"$max": "$end"}}},
+        {"$match": {"end": {"$lt": cutoff}}},
+        {"$sort": {"end": ASCENDING}},
+    ]
+    if limit:
+        pipeline.append({"$limit": limit})
+    return [group["_id"] for group in spectrumBuckets.aggregate(pipeline)]
+
+def rollup_legacy(cutoff):
+    '''Roll raw spectrumData traces that have no pass buckets (pre-bucket or migrated data) into spectrumMinute, an hour at a time.'''
+    state = retentionState.find_one({"_id": "legacyRollup"})
+    query = {"meta.scheduleRunId": None}
+    if state is None:
+        first = spectrumData.find_one(query, sort=[("timestamp", ASCENDING)])
+        if first is None or not isinstance(first["timestamp"], datetime):
+            return
+        watermark = first["timestamp"].replace(minute=0, second=0, microsecond=0)
+    else:
+        watermark = state["until"]
+
+    while watermark < cutoff:
+        until = min(watermark + timedelta(hours=1), cutoff.replace(second=0, microsecond=0))
+        if until <= watermark:
+            break
+        groups = {}
+        for document in spectrumData.find({**query, "timestamp": {"$gte": watermark, "$lt": until}}).sort("timestamp", ASCENDING):
+            groups.setdefault(document_axis_id(document), []).append(document)
+        for axisId, documents in groups.items():
+            timestamps = np.array([document["timestamp"] for document in documents], dtype='datetime64[ms]')
+            traces = np.vstack([decode_trace(document) for document in documents])
+            write_minutes(minute_documents(timestamps, traces, axisId))
+        watermark = until
+        if not groups:
+            # Jump over gaps instead of querying them hour by hour
+            following = spectrumData.find_one({**query, "timestamp": {"$gte": until}}, sort=[("timestamp", ASCENDING)])
+            watermark = until if following is None else max(until, following["timestamp"].replace(minute=0, second=0, microsecond=0))
+            watermark = min(watermark, cutoff)
+        retentionState.replace_one({"_id": "legacyRollup"}, {"_id": "legacyRollup", "until": watermark}, upsert=True)
+
+def database_size():
+    # dataSize shrinks as soon as documents are deleted, unlike storageSize which WiredTiger keeps allocated
+    stats = db.command("dbStats")
+    return stats["dataSize"] + stats["indexSize"]
+
+def shed_oldest():
+    '''Free space from the oldest data of the cheapest tier. Returns False if there is nothing left to shed.'''
+    oldest_raw = spectrumData.find_one({}, sort=[("timestamp", ASCENDING)])
+    if oldest_raw is not None and isinstance(oldest_raw["timestamp"], datetime):
+        try:
+            # Raw traces duplicate the pass buckets, so they go first
+            spectrumData.delete_many({"timestamp": {"$lt": oldest_raw["timestamp"] + timedelta(days=1)}})
+            return True
+        except Exception as e:
+            logging.info(f"Retention cannot delete raw spectrumData by time on this MongoDB version: {e}")
+    passes = expired_passes(datetime.utcnow(), limit=1)
+    if passes:
+        rollup_pass(passes[0])
+        return True
+    oldest_minute = spectrumMinute.find_one({}, sort=[("minute", ASCENDING)])
+    if oldest_minute is not None:
+        spectrumMinute.delete_many({"minute": {"$lt": oldest_minute["minute"] + timedelta(days=1)}})
+        return True
+    return False
+
+def enforce_budget():
+    size = database_size()
+    if size <= DISK_BUDGET_BYTES:
+        return
+    logging.info(f"Retention: database at {size / 1024 ** 3:.1f} GiB, over the {DISK_BUDGET_BYTES / 1024 ** 3:.1f} GiB budget")
+    while database_size() > DISK_BUDGET_BYTES:
+        if not shed_oldest():
+            logging.error("Retention: over disk budget with nothing left to shed")
+            break
+
+def run_retention():
+    now = datetime.utcnow()
+    cutoff = now - timedelta(days=RAW_RETENTION_DAYS)
+
+    for scheduleRunId in expired_passes(cutoff):
+        rollup_pass(scheduleRunId)
+    rollup_legacy(now - timedelta(days=SPECTRUM_TTL_DAYS - RAW_EXPIRY_GRACE_DAYS))
+
+    deleted = spectrumMinute.delete_many({"minute": {"$lt": now - timedelta(days=MINUTE_RETENTION_DAYS)}}).deleted_count
+    if deleted:
+        logging.info(f"Retention removed {deleted} minute aggregates")
+    enforce_budget()
+
+def main():
+    logging.info("Started IFSS_Retention")
+    ensure_aggregate_collections(db)
+    ensure_spectrum_expiry(db)
+    while True:
+        try:
+            run_retention()
+        except Exception as e:
+            logging.error(f"An error occurred in IFSS_Retention run_retention(): {e}")
+        sleep(RETENTION_INTERVAL)
+
+if __name__ == "__main__":
+    main()
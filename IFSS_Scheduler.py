@@ -0,0 +1,202 @@
+import heapq
+import itertools
+import logging
+import threading
+from datetime import datetime, timedelta
+
+# Event-driven replacement for the sleep(1) polling loops. Events are kept in a priority
+# queue ordered by their UTC due time and the scheduler thread sleeps until exactly the
+# next one is due instead of waking every second to compare clocks.
+
+# Longest single sleep; the remaining time is recomputed from the wall clock after each
+# one, so an NTP step or a suspended machine cannot make an event fire far off time.
+MAX_SLEEP = 60.0
+
+# How far ahead the pass index holds passes; the AOML schedule covers the next 48 hours
+PASS_WINDOW = timedelta(hours=48)
+
+def sleep_until(when, interrupt=None):
+    '''
+    Sleep until the naive UTC datetime `when`. Returns how late the wake-up was in seconds,
+    or None if `interrupt` (a threading.Event) was set first.
+    '''
+    interrupt = interrupt if interrupt is not None else threading.Event()
+    while True:
+        remaining = (when - datetime.utcnow()).total_seconds()
+        if remaining <= 0:
+            return -remaining
+        if interrupt.wait(min(remaining, MAX_SLEEP)):
+            return None
+
+class ScheduledEvent:
+    __slots__ = ("when", "name", "action", "args", "cancelled")
+
+    def __init__(self, when, name, action, args):
+        self.when = when
+        self.name = name
+        self.action = action
+        self.args = args
+        self.cancelled = False
+
+class EventScheduler:
+    '''
+    Priority queue of timed actions (AOS/LOS captures, the daily schedule fetch, ...).
+    run() executes them in due order on the calling thread and logs how late each one
+    started; schedule(), cancel() and stop() may be called from any thread and wake it.
+    An exception raised by an action is logged, or re-raised out of run() with propagate_errors.
+    '''
+
+    def __init__(self, name="EventScheduler", propagate_errors=False):
+        self.name = name
+        self.propagate_errors = propagate_errors
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self.latencies = {}
+
+    def schedule(self, when, name, action, *args):
+        event = ScheduledEvent(when, name, action, args)
+        with self._lock:
+            heapq.heappush(self._heap, (when, next(self._counter), event))
+        self._wakeup.set()
+        return event
+
+    def cancel(self, event):
+        event.cancelled = True
+        self._wakeup.set()
+
+    def every_day(self, at, name, action, *args):
+        '''Run action every day at the UTC datetime.time `at`, starting with the next occurrence.'''
+        def repeat():
+            self.schedule(_next_daily(at), name, repeat)
+            action(*args)
+        return self.schedule(_next_daily(at), name, repeat)
+
+    def pending(self):
+        with self._lock:
+            return [event for _, _, event in sorted(self._heap) if not event.cancelled]
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+    def run(self, until_empty=False):
+        '''Dispatch events until stop() is called, or until the queue is empty if until_empty.'''
+        self._stopped = False
+        while not self._stopped:
+            with self._lock:
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+                head = self._heap[0] if self._heap else None
+                self._wakeup.clear()
+            if head is None:
+                if until_empty:
+                    return
+                self._wakeup.wait(MAX_SLEEP)
+                continue
+
+            when, _, event = head
+            lateness = sleep_until(when, self._wakeup)
+            if lateness is None:
+                # Queue changed or stop() was called; look at the head again
+                continue
+            with self._lock:
+                if not self._heap or self._heap[0][2] is not event:
+                    continue
+                heapq.heappop(self._heap)
+            if event.cancelled:
+                continue
+
+            self.latencies[event.name] = lateness
+            logging.info(f"{self.name}: {event.name} due {when:%Y-%m-%d %H:%M:%S.%f} started {lateness * 1000:.1f} ms late")
+            try:
+                event.action(*event.args)
+            except Exception as e:
+                if self.propagate_errors:
+                    raise
+                logging.error(f"{self.name}: {event.name} failed: {e}")
+
+def _next_daily(at):
+    now = datetime.utcnow()
+    when = datetime.combine(now.date(), at)
+    return when if when > now else when + timedelta(days=1)
+
+def row_window(row):
+    '''AOS and LOS of a schedule.csv row as naive UTC datetimes. An LOS earlier than AOS rolls over midnight.'''
+    def parse(date, time):
+        for fmt in ('%Y-%m-%d %H:%M:%S', '%d-%b-%Y %H:%M:%S'):
+            try:
+                return datetime.strptime(f"{date} {time}", fmt)
+            except ValueError:
+                pass
+        raise ValueError(f"Unrecognised schedule date/time: {date} {time}")
+    aos = parse(row[5], row[6])
+    los = parse(row[7], row[8])
+    if los <= aos:
+        los += timedelta(days=1)
+    return aos, los
+
+class PassIndex:
+    '''
+    Rolling index of the passes in the next `window`, keyed by schedule ITEM and satellite.
+    merge() folds in the rows of a new schedule fetch: unseen passes get an AOS event on
+    `scheduler` calling action(row, aos, los), passes whose times moved are rescheduled, and
+    passes missing from the fetch are kept until their LOS. A pass already past its AOS is
+    never touched, so a refresh cannot interrupt or repeat a capture. With prepare given,
+    prepare(row, aos, los) is scheduled `lead` ahead of every AOS as well.
+    '''
+
+    def __init__(self, scheduler, action, window=PASS_WINDOW, prepare=None, lead=timedelta(0)):
+        self.scheduler = scheduler
+        self.action = action
+        self.window = window
+        self.prepare = prepare
+        self.lead = lead
+        self._passes = {}
+        self._lock = threading.Lock()
+
+    def merge(self, rows):
+        '''Merge schedule rows. Returns the number of passes added or rescheduled.'''
+        now = datetime.utcnow()
+        merged = 0
+        with self._lock:
+            for key in [key for key, (_, los, _, _) in self._passes.items() if los <= now]:
+                del self._passes[key]
+            for row in rows:
+                try:
+                    aos, los = row_window(row)
+                except (ValueError, IndexError) as e:
+                    logging.error(f"Skipping schedule row {row}: {e}")
+                    continue
+                if los <= now or aos > now + self.window:
+                    continue
+                key = (row[0].strip(), row[1].strip())
+                existing = self._passes.get(key)
+                if existing is not None:
+                    if existing[:2] == (aos, los) or existing[0] <= now:
+                        continue
+                    for event in existing[3]:
+                        self.scheduler.cancel(event)
+                events = []
+                if self.prepare is not None:
+                    # Scheduled first so it also runs ahead of a pass that is already under way
+                    events.append(self.scheduler.schedule(min(max(aos - self.lead, now), aos), f"Prepare {key[1]} item {key[0]}", self.prepare, row, aos, los))
+                events.append(self.scheduler.schedule(aos, f"AOS {key[1]} item {key[0]}", self.action, row, aos, los))
+                self._passes[key] = (aos, los, row, events)
+                merged += 1
+        return merged
+
+    def clear(self):
+        '''Cancel the events of every indexed pass and forget them, so a new merge() schedules them afresh.'''
+        with self._lock:
+            for _, _, _, events in self._passes.values():
+                for event in events:
+                    self.scheduler.cancel(event)
+            self._passes.clear()
+
+    def passes(self):
+        '''(aos, los, row) of every indexed pass in AOS order.'''
+        with self._lock:
+            return sorted(entry[:3] for entry in self._passes.values())
@@ -0,0 +1,185 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+import bson
+from bson.objectid import ObjectId
+
+# Append-only local write-ahead spool for documents bound for MongoDB.
+#
+# Documents are BSON encoded into memory-mapped segment files
+#     <dir>/<segment number>.seg     fixed size, records back to back, zero filled tail
+# each record being
+#     <u32 payload length><u32 crc32 of payload><payload: BSON {"c": collection name, "d": document}>
+# A zero length marks the end of the written part of a segment. <dir>/cursor holds the
+# (segment, offset) up to which records are known to be in MongoDB; segments entirely
+# behind it are deleted. Every document gets its _id before it is spooled, so replaying
+# a record twice (after a crash or a failed write) is recognised and skipped.
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+_HEADER = struct.Struct('<II')
+_CURSOR = struct.Struct('<QQ')
+
+class TraceSpool:
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._cursor = self._read_cursor()
+        segments = self._segments()
+        self._segment = segments[-1] if segments else self._cursor[0]
+        self._open_segment(self._segment)
+        self._offset = self._scan_end(self._mm)
+        if self.pending():
+            logging.info(f"Spool {directory} holds unreplayed records from segment {self._cursor[0]} offset {self._cursor[1]}")
+
+    ################ WRITE SIDE ################
+    def append(self, collection_name, documents):
+        '''Durably append documents bound for collection_name. Assigns _id where missing.'''
+        if not documents:
+            return
+        records = []
+        for document in documents:
+            document.setdefault("_id", ObjectId())
+            payload = bson.encode({"c": collection_name, "d": document})
+            records.append(_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+        with self._lock:
+            for record in records:
+                # Leave room for the zero length terminator
+                if self._offset + len(record) + _HEADER.size > len(self._mm):
+                    self._rotate(len(record) + _HEADER.size)
+                self._mm[self._offset:self._offset + len(record)] = record
+                self._offset += len(record)
+            self._mm.flush()
+
+    def pending(self):
+        with self._lock:
+            return self._cursor < (self._segment, self._offset)
+
+    def close(self):
+        '''Unmap the write segment. The spool is reopened by constructing a new TraceSpool on the directory.'''
+        with self._lock:
+            if not self._mm.closed:
+                self._mm.flush()
+                self._mm.close()
+
+    ################ REPLAY SIDE ################
+    def replay(self, sink, limit=500, verify=False, blocking=True):
+        '''
+        Hand up to `limit` unreplayed records to sink(collection_name, documents, verify) in order
+        and advance the cursor past them once sink returns. sink raises if the write failed, in
+        which case the cursor stays put. Returns the number of records replayed, or None if
+        another replay was already running and blocking is False.
+        '''
+        if not self._replay_lock.acquire(blocking=blocking):
+            return None
+        try:
+            with self._lock:
+                records, cursor = self._read_from_cursor(limit)
+            if not records:
+                if cursor != self._cursor:
+                    self._write_cursor(cursor)
+                return 0
+            # Keep per-collection runs in order so each becomes one insert_many
+            start = 0
+            for i in range(1, len(records) + 1):
+                if i == len(records) or records[i]["c"] != records[start]["c"]:
+                    sink(records[start]["c"], [record["d"] for record in records[start:i]], verify)
+                    start = i
+            self._write_cursor(cursor)
+            return len(records)
+        finally:
+            self._replay_lock.release()
+
+    def _read_from_cursor(self, limit):
+        # Called with self._lock held so the write segment cannot rotate underneath
+        records = []
+        segment, offset = self._cursor
+        end = (self._segment, self._offset)
+        while len(records) < limit and (segment, offset) < end:
+            mm = self._mm if segment == self._segment else self._map_readonly(segment)
+            try:
+                while len(records) < limit:
+                    if offset + _HEADER.size > len(mm):
+                        break
+                    length, crc = _HEADER.unpack_from(mm, offset)
+                    if length == 0 or (segment, offset) >= end:
+                        break
+                    payload = mm[offset + _HEADER.size:offset + _HEADER.size + length]
+                    if zlib.crc32(payload) != crc:
+                        logging.error(f"Spool segment {segment} corrupt at offset {offset}, skipping rest of segment")
+                        break
+                    records.append(bson.decode(payload))
+                    offset += _HEADER.size + length
+            finally:
+                if mm is not self._mm:
+                    mm.close()
+            if len(records) < limit and segment < end[0]:
+                segment, offset = segment + 1, 0
+            else:
+                break
+        return records, (segment, offset)
+
+    ################ SEGMENTS AND CURSOR ################
+    def _segments(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith('.seg'))
+
+    def _path(self, segment):
+        return os.path.join(self.directory, f"{segment:010d}.seg")
+
+    def _open_segment(self, segment, size=None):
+        path = self._path(segment)
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.truncate(max(self.segment_size, size or 0))
+        with open(path, 'r+b') as f:
+            self._mm = mmap.mmap(f.fileno(), 0)
+
+    def _map_readonly(self, segment):
+        with open(self._path(segment), 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _rotate(self, needed):
+        self._mm.flush()
+        self._mm.close()
+        self._segment += 1
+        self._open_segment(self._segment, needed)
+        self._offset = 0
+
+    @staticmethod
+    def _scan_end(mm):
+        # Walk the records of a segment to find where writing stopped (torn tail records are ignored)
+        offset = 0
+        while offset + _HEADER.size <= len(mm):
+            length, crc = _HEADER.unpack_from(mm, offset)
+            end = offset + _HEADER.size + length
+            if length == 0 or end > len(mm) or zlib.crc32(mm[offset + _HEADER.size:end]) != crc:
+                break
+            offset = end
+        return offset
+
+    def _read_cursor(self):
+        try:
+            with open(os.path.join(self.directory, 'cursor'), 'rb') as f:
+                return _CURSOR.unpack(f.read(_CURSOR.size))
+        except (OSError, struct.error):
+            segments = self._segments()
+            return (segments[0] if segments else 0, 0)
+
+    def _write_cursor(self, cursor):
+        path = os.path.join(self.directory, 'cursor')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(_CURSOR.pack(*cursor))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        self._cursor = cursor
+        # Segments wholly behind the cursor are in MongoDB and can go
+        for segment in self._segments():
+            if segment < cursor[0]:
+                os.remove(self._path(segment))
@@ -0,0 +1,479 @@
+import logging
+import numpy as np
+from bson.binary import Binary
+from pymongo import ReturnDocument, ASCENDING, DESCENDING
+
+# Compact spectrumData schema
+#
+#   spectrumAxis: one document per spectrum configuration
+#       {"startFreq": Hz, "stepFreq": Hz, "length": points, "centerFreq": Hz, "span": Hz, "rbw": Hz, "refLevel": dBm}
+#   spectrumData: MongoDB time-series collection, one measurement per trace
+#       {"timestamp": UTC datetime, "meta": {"axisId": spectrumAxis _id, "scheduleRunId": scheduleRun _id, "sat": name,
+#                                            "acqStatus": AcqDataStatus bits},
+#        "encoding": "float32" | "int16", "scale": dB per count (int16 only), "trace": Binary,
+#        "deviceTicks": device timestamp, "hostLagMs": ms from acquisition until the host had the trace}
+#       timestamp is the device's acquisition time where the mode provides one (spectrum, iq), otherwise the
+#       host's. acqStatus sits in meta because it is almost always 0: it costs no extra time-series buckets and
+#       flagged traces are found through the meta.acqStatus index, e.g. {"meta.acqStatus": {"$gt": 0}}.
+#       DPX summaries (IFSS_RSA ACQUISITION_MODE "dpx") keep the max-hold of all frames of the second in
+#       trace and add
+#        "dpx": {"frames": n, "ffts": n, "minSigDuration": s, "mean": Binary int16 (same scale),
+#                "occupancy": Binary uint8 % of spectrogram lines above "threshold" dBm per point, "threshold": dBm,
+#                "spread": Binary uint8 dB of amplitude the DPX spectrum bitmap saw hits across per bitmap column}
+#       Spectra computed on the host in ACQUISITION_MODE "iq" point back into the pass's IQ recording (IFSS_IQ.py)
+#        "iq": {"recording": name in IQ_DIR, "sample": first IQ sample the spectrum was computed from}
+#
+#   spectrumBuckets: all traces of one scheduleRun pass, grouped BUCKET_TRACES traces / BUCKET_SECONDS per document
+#       {"scheduleRunId": ..., "axisId": ..., "sat": name, "start": UTC datetime, "end": UTC datetime, "count": rows,
+#        "encoding": ..., "scale": ..., "offsets": Binary int32 ms since start per row, "traces": Binary rows x length,
+#        "acqStatus": AcqDataStatus bits of any row, "max": Binary float32, "mean": Binary float32}
+#       max and mean are over the bucket's rows, so a coarse spectrogram (spectrogram_rows()) reads one row per
+#       bucket instead of its traces. Buckets written before they were added have neither.
+#
+#   spectrumMinute: per-minute aggregates written by IFSS_Retention.py once raw data ages out
+#       {"minute": UTC datetime, "axisId": ..., "scheduleRunId": ... | None, "sat": name | None, "count": traces,
+#        "min": Binary float32, "mean": Binary float32, "max": Binary float32}
+#   spectrumPassSummary: one document per pass and axis, min/mean/max blobs over the whole pass
+#       {"scheduleRunId": ..., "axisId": ..., "sat": name, "start": ..., "end": ..., "count": traces, "min", "mean", "max"}
+#       written at LOS from a TraceAccumulator, which adds
+#        "std": Binary float32, "percentiles": {"10": Binary float32, ...}, "sketchResolution": dB, "source": "live"
+#
+# The trace blob is little-endian float32 dBm, or int16 counts of `scale` dB. Legacy documents with a
+# "frequencies" dict of str(MHz) -> dBm are still understood by the decode helpers.
+
+TRACE_ENCODING = "float32"
+INT16_SCALE = 0.01
+BUCKET_TRACES = 60
+BUCKET_SECONDS = 60
+
+# Pass percentiles are read from a per-bin histogram of SKETCH_BINS steps of SKETCH_RESOLUTION dB
+# from SKETCH_FLOOR dBm, values outside are counted in the end bins
+PASS_PERCENTILES = (10, 50, 90)
+SKETCH_FLOOR = -180.0
+SKETCH_RESOLUTION = 0.5
+SKETCH_BINS = 440
+
+SPECTRUM_TIMESERIES = {"timeField": "timestamp", "metaField": "meta", "granularity": "seconds"}
+# spectrumData is the recent tier: every trace is also written to its pass's spectrumBuckets
+# documents, the long-term raw copy (IFSS_Retention.py), so MongoDB expires it after this long
+SPECTRUM_TTL_DAYS = 2
+
+def ensure_spectrum_collection(db, name="spectrumData"):
+    '''
+    Create spectrumData as a time-series collection with its query indexes if it does not exist yet.
+    An existing regular collection is left alone; Tools/migrate_spectrumData.py converts it.
+
+    spectrumData only holds the recent per-trace copy of every trace, for the latest-trace views and
+    ad-hoc queries of the last days: documents expire SPECTRUM_TTL_DAYS after their timestamp. The
+    same traces are kept in spectrumBuckets (see PassBucketer) for IFSS_Retention.RAW_RETENTION_DAYS.
+    '''
+    info = next(db.list_collections(filter={"name": name}), None)
+    if info is None:
+        db.create_collection(name, timeseries=SPECTRUM_TIMESERIES, expireAfterSeconds=SPECTRUM_TTL_DAYS * 86400)
+        logging.info(f"Created time-series collection {name}")
+    elif info.get("type") != "timeseries":
+        logging.info(f"{name} is not a time-series collection, run Tools/migrate_spectrumData.py to convert it")
+        return db[name]
+    else:
+        ensure_spectrum_expiry(db, name)
+    collection = db[name]
+    collection.create_index([("timestamp", DESCENDING)])
+    collection.create_index([("meta.scheduleRunId", ASCENDING), ("timestamp", ASCENDING)])
+    collection.create_index([("meta.sat", ASCENDING), ("timestamp", ASCENDING)])
+    collection.create_index([("meta.acqStatus", ASCENDING), ("timestamp", ASCENDING)])
+    return collection
+
+def ensure_spectrum_expiry(db, name="spectrumData"):
+    '''Set the SPECTRUM_TTL_DAYS expiry on an existing time-series spectrumData.'''
+    try:
+        db.command("collMod", name, expireAfterSeconds=SPECTRUM_TTL_DAYS * 86400)
+    except Exception as e:
+        logging.error(f"Could not set the {name} expiry (is it a time-series collection?): {e}")
+
+def ensure_bucket_collection(db, name="spectrumBuckets"):
+    collection = db[name]
+    collection.create_index([("scheduleRunId", ASCENDING), ("start", ASCENDING)])
+    collection.create_index([("start", DESCENDING)])
+    collection.create_index([("acqStatus", ASCENDING), ("start", ASCENDING)])
+    collection.create_index([("axisId", ASCENDING), ("start", ASCENDING)])
+    return collection
+
+def ensure_aggregate_collections(db):
+    spectrumMinute = db["spectrumMinute"]
+    spectrumMinute.create_index([("minute", ASCENDING)])
+    spectrumMinute.create_index([("axisId", ASCENDING), ("minute", ASCENDING)])
+    spectrumMinute.create_index([("scheduleRunId", ASCENDING), ("axisId", ASCENDING), ("minute", ASCENDING)], unique=True)
+    spectrumPassSummary = db["spectrumPassSummary"]
+    spectrumPassSummary.create_index([("scheduleRunId", ASCENDING), ("axisId", ASCENDING)], unique=True)
+    spectrumPassSummary.create_index([("start", ASCENDING)])
+    spectrumPassSummary.create_index([("end", ASCENDING)])
+    spectrumPassSummary.create_index([("sat", ASCENDING), ("start", ASCENDING)])
+    return spectrumMinute, spectrumPassSummary
+
+def ensure_schedule_collection(db):
+    '''satSchedule is looked up by ingest timestamp, for today's schedule and its newest document.'''
+    satSchedule = db["satSchedule"]
+    satSchedule.create_index([("timestamp", DESCENDING)])
+    return satSchedule
+
+def spectrum_axis(specSet, centerFreq, refLevel):
+    '''spectrumAxis document of a Spectrum_Settings configuration, see upsert_axis().'''
+    return {
+        "startFreq": specSet.actualStartFreq,
+        "stepFreq": specSet.actualFreqStepSize,
+        "length": specSet.traceLength,
+        "centerFreq": centerFreq,
+        "span": specSet.span,
+        "rbw": specSet.actualRBW,
+        "refLevel": refLevel,
+    }
+
+def dpx_axis(dpxSet, centerFreq, span, refLevel):
+    '''Like spectrum_axis() for the traces of a DPX_SettingStruct configuration.'''
+    return {
+        "startFreq": centerFreq - span / 2,
+        "stepFreq": span / (dpxSet.traceLength - 1) if dpxSet.traceLength > 1 else 0.0,
+        "length": dpxSet.traceLength,
+        "centerFreq": centerFreq,
+        "span": span,
+        "rbw": dpxSet.actualRBW,
+        "refLevel": refLevel,
+    }
+
+def iq_axis(offsets, centerFreq, bandwidth, rbw, refLevel):
+    '''Like spectrum_axis() for spectra computed on the host from IQ (IFSS_IQ.welch() bin offsets from centerFreq).'''
+    return {
+        "startFreq": centerFreq + float(offsets[0]),
+        "stepFreq": float(offsets[1] - offsets[0]) if len(offsets) > 1 else 0.0,
+        "length": len(offsets),
+        "centerFreq": centerFreq,
+        "span": bandwidth,
+        "rbw": rbw,
+        "refLevel": refLevel,
+    }
+
+def upsert_axis(spectrumAxis, axis):
+    '''Return the _id of the spectrumAxis document with these fields, creating it on first use.'''
+    document = spectrumAxis.find_one_and_update(axis, {"$setOnInsert": axis}, upsert=True, return_document=ReturnDocument.AFTER)
+    return document["_id"]
+
+def document_axis_id(document):
+    '''spectrumAxis _id of a spectrumData document (kept in meta since the time-series schema).'''
+    return document.get("meta", {}).get("axisId", document.get("axisId"))
+
+def axis_frequencies(axis):
+    '''Frequency of every trace point in Hz for a spectrumAxis document.'''
+    return axis["startFreq"] + np.arange(axis["length"]) * axis["stepFreq"]
+
+def encode_trace(trace, encoding=TRACE_ENCODING):
+    '''Pack a dBm trace into the document fields used by spectrumData (copies out of the trace buffer).'''
+    if encoding == "int16":
+        counts = np.clip(np.rint(np.asarray(trace) / INT16_SCALE), -32768, 32767).astype('<i2')
+        return {"encoding": "int16", "scale": INT16_SCALE, "trace": Binary(counts.tobytes())}
+    return {"encoding": "float32", "trace": Binary(np.asarray(trace, dtype='<f4').tobytes())}
+
+def encode_dpx_summary(maxHold, mean, occupancy, threshold, frames, ffts, minSigDuration, spread):
+    '''Document fields of a DPX summary: int16 max-hold as the trace, mean, occupancy and amplitude spread alongside.'''
+    fields = encode_trace(maxHold, "int16")
+    fields["dpx"] = {
+        "frames": frames,
+        "ffts": ffts,
+        "minSigDuration": minSigDuration,
+        "mean": encode_trace(mean, "int16")["trace"],
+        "occupancy": Binary(np.asarray(occupancy, dtype=np.uint8).tobytes()),
+        "threshold": threshold,
+        "spread": Binary(np.clip(np.rint(spread), 0, 255).astype(np.uint8).tobytes()),
+    }
+    return fields
+
+def decode_dpx(document):
+    '''
+    (mean dBm float32, occupancy % uint8, amplitude spread dB uint8 or None for summaries stored
+    before it) of a DPX summary document, None for a swept trace.
+    '''
+    if "dpx" not in document:
+        return None
+    dpx = document["dpx"]
+    spread = np.frombuffer(dpx["spread"], dtype=np.uint8) if "spread" in dpx else None
+    return _decode_values(dpx["mean"], document), np.frombuffer(dpx["occupancy"], dtype=np.uint8), spread
+
+def _decode_values(blob, document):
+    if document.get("encoding") == "int16":
+        return np.frombuffer(blob, dtype='<i2').astype(np.float32) * np.float32(document["scale"])
+    return np.frombuffer(blob, dtype='<f4')
+
+def decode_trace(document):
+    '''Return the dBm values of a spectrumData document as a float32 array.'''
+    if "trace" not in document:
+        return np.fromiter(document["frequencies"].values(), dtype=np.float32)
+    return _decode_values(document["trace"], document)
+
+def decode_bucket(bucket):
+    '''Return (timestamps, traces) of a spectrumBuckets document; traces is a rows x length float32 array.'''
+    offsets = np.frombuffer(bucket["offsets"], dtype='<i4')
+    timestamps = np.datetime64(bucket["start"], 'ms') + offsets.astype('timedelta64[ms]')
+    return timestamps, _decode_values(bucket["traces"], bucket).reshape(bucket["count"], -1)
+
+def load_pass(spectrumBuckets, scheduleRunId, axisId=None):
+    '''
+    Return (timestamps, traces, axisId) for a whole pass from its buckets, or None if nothing was stored.
+    Pass axisId when the pass may have used more than one spectrum configuration.
+    '''
+    query = {"scheduleRunId": scheduleRunId}
+    if axisId is not None:
+        query["axisId"] = axisId
+    buckets = list(spectrumBuckets.find(query).sort("start", ASCENDING))
+    if not buckets:
+        return None
+    decoded = [decode_bucket(bucket) for bucket in buckets]
+    return np.concatenate([d[0] for d in decoded]), np.vstack([d[1] for d in decoded]), buckets[0]["axisId"]
+
+def _f32(values):
+    return Binary(np.ascontiguousarray(values, dtype='<f4').tobytes())
+
+def minute_aggregates(timestamps, traces):
+    '''
+    Reduce time-sorted traces (rows x bins, timestamps as datetime64) to one min/mean/max row per
+    UTC minute. Returns (minutes, counts, mins, means, maxes); means are of the dBm values.
+    '''
+    minutes = timestamps.astype('datetime64[m]')
+    starts = np.flatnonzero(np.r_[True, minutes[1:] != minutes[:-1]])
+    counts = np.diff(np.r_[starts, len(minutes)])
+    means = np.add.reduceat(traces, starts, axis=0, dtype=np.float64) / counts[:, None]
+    return minutes[starts], counts, np.minimum.reduceat(traces, starts, axis=0), means, np.maximum.reduceat(traces, starts, axis=0)
+
+def minute_documents(timestamps, traces, axisId, scheduleRunId=None, sat=None):
+    minutes, counts, mins, means, maxes = minute_aggregates(timestamps, traces)
+    return [{
+        "minute": minute.astype('datetime64[ms]').astype(object),
+        "axisId": axisId,
+        "scheduleRunId": scheduleRunId,
+        "sat": sat,
+        "count": int(count),
+        "min": _f32(low),
+        "mean": _f32(mean),
+        "max": _f32(high),
+    } for minute, count, low, mean, high in zip(minutes, counts, mins, means, maxes)]
+
+def pass_summary_document(timestamps, traces, axisId, scheduleRunId, sat):
+    return {
+        "scheduleRunId": scheduleRunId,
+        "axisId": axisId,
+        "sat": sat,
+        "start": timestamps[0].astype('datetime64[ms]').astype(object),
+        "end": timestamps[-1].astype('datetime64[ms]').astype(object),
+        "count": len(traces),
+        "min": _f32(traces.min(axis=0)),
+        "mean": _f32(traces.mean(axis=0, dtype=np.float64)),
+        "max": _f32(traces.max(axis=0)),
+    }
+
+class TraceAccumulator:
+    '''
+    Per-bin statistics of the traces of one pass and axis, updated in place as each trace is
+    acquired: running mean and variance (Welford), max-hold, min-hold and a fixed dBm histogram
+    per bin that percentiles are read from. Memory does not grow with the number of traces.
+    document() is the pass's spectrumPassSummary document.
+    '''
+
+    def __init__(self, length):
+        self.count = 0
+        self.start = self.end = None
+        self.mean = np.zeros(length)
+        self.m2 = np.zeros(length)
+        self.max = np.full(length, -np.inf, dtype=np.float32)
+        self.min = np.full(length, np.inf, dtype=np.float32)
+        self.histogram = np.zeros((length, SKETCH_BINS), dtype=np.uint32)
+        self._bins = np.arange(length)
+
+    def add(self, trace, timestamp):
+        '''Fold in a dBm trace. trace may be a view on a buffer reused by the next acquisition.'''
+        self.count += 1
+        delta = trace - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (trace - self.mean)
+        np.maximum(self.max, trace, out=self.max)
+        np.minimum(self.min, trace, out=self.min)
+        steps = np.clip(((trace - SKETCH_FLOOR) / SKETCH_RESOLUTION).astype(np.intp), 0, SKETCH_BINS - 1)
+        self.histogram[self._bins, steps] += 1
+        if self.start is None:
+            self.start = timestamp
+        self.end = timestamp
+
+    def std(self):
+        return np.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else np.zeros(len(self.mean))
+
+    def percentiles(self, percentiles=PASS_PERCENTILES):
+        '''{percentile: dBm per bin}, to within SKETCH_RESOLUTION.'''
+        cumulative = np.cumsum(self.histogram, axis=1)
+        return {p: SKETCH_FLOOR + ((cumulative >= max(np.ceil(p / 100 * self.count), 1)).argmax(axis=1) + 0.5) * SKETCH_RESOLUTION
+                for p in percentiles}
+
+    def document(self, axisId, scheduleRunId, sat):
+        return {
+            "scheduleRunId": scheduleRunId,
+            "axisId": axisId,
+            "sat": sat,
+            "start": self.start,
+            "end": self.end,
+            "count": self.count,
+            "min": _f32(self.min),
+            "mean": _f32(self.mean),
+            "max": _f32(self.max),
+            "std": _f32(self.std()),
+            "percentiles": {str(p): _f32(values) for p, values in self.percentiles().items()},
+            "sketchResolution": SKETCH_RESOLUTION,
+            "source": "live",
+        }
+
+def decode_aggregate(document):
+    '''Return (min, mean, max) float32 arrays of a spectrumMinute or spectrumPassSummary document.'''
+    return tuple(np.frombuffer(document[field], dtype='<f4') for field in ("min", "mean", "max"))
+
+def decode_percentiles(document):
+    '''{percentile: float32 array} of a spectrumPassSummary document written at LOS, empty for rolled up ones.'''
+    return {int(p): np.frombuffer(blob, dtype='<f4') for p, blob in document.get("percentiles", {}).items()}
+
+def load_minutes(spectrumMinute, start, end, axisId=None):
+    '''Return (minutes, mins, means, maxes) for aggregates in [start, end), optionally for one axis.'''
+    query = {"minute": {"$gte": start, "$lt": end}}
+    if axisId is not None:
+        query["axisId"] = axisId
+    documents = list(spectrumMinute.find(query).sort("minute", ASCENDING))
+    if not documents:
+        return None
+    decoded = [decode_aggregate(document) for document in documents]
+    minutes = np.array([document["minute"] for document in documents], dtype='datetime64[ms]')
+    return (minutes,) + tuple(np.vstack([d[i] for d in decoded]) for i in range(3))
+
+def spectrogram_rows(spectrumBuckets, spectrumMinute, axisId, start, end, reduce="max", summaries=False):
+    '''
+    Time-sorted rows of axisId over [start, end) as (times datetime64[ms], rows x bins float32, traces per row),
+    or None. Pass buckets give every trace, or with summaries=True their max or mean row (reduce) alone.
+    Stretches whose buckets were already rolled up come from spectrumMinute.
+    '''
+    times, rows, counts = [], [], []
+    query = {"axisId": axisId, "start": {"$lt": end}, "end": {"$gte": start}}
+    projection = {"traces": 0, "offsets": 0} if summaries else {"max": 0, "mean": 0}
+    first_bucket = None
+    for bucket in spectrumBuckets.find(query, projection).sort("start", ASCENDING):
+        first_bucket = first_bucket or bucket["start"]
+        if summaries and reduce in bucket:
+            times.append(np.array([bucket["start"]], dtype='datetime64[ms]'))
+            rows.append(np.frombuffer(bucket[reduce], dtype='<f4')[None])
+            counts.append(np.array([bucket["count"]]))
+            continue
+        if summaries:
+            # Written before buckets had summaries
+            bucket = spectrumBuckets.find_one({"_id": bucket["_id"]})
+        stamps, traces = decode_bucket(bucket)
+        times.append(stamps)
+        rows.append(traces)
+        counts.append(np.ones(len(traces), dtype=np.int64))
+    query = {"axisId": axisId, "minute": {"$gte": start, "$lt": first_bucket or end}}
+    minutes = list(spectrumMinute.find(query, {"minute": 1, "count": 1, reduce: 1}).sort("minute", ASCENDING))
+    if minutes:
+        times.insert(0, np.array([document["minute"] for document in minutes], dtype='datetime64[ms]'))
+        rows.insert(0, np.vstack([np.frombuffer(document[reduce], dtype='<f4') for document in minutes]))
+        counts.insert(0, np.array([document["count"] for document in minutes]))
+    if not times:
+        return None
+    times = np.concatenate(times)
+    order = np.argsort(times, kind='stable')
+    return times[order], np.vstack(rows)[order], np.concatenate(counts)[order]
+
+def pool_spectrogram(times, rows, counts, start, end, height, width, reduce="max"):
+    '''
+    Pool spectrogram rows onto a grid of height time bins of (end - start) / height and at most width
+    frequency columns, each the max or the count weighted mean (reduce) of its cells. Returns
+    (height x columns float32 grid, NaN where a time bin has no rows, first point of each column, points per column).
+    '''
+    points = rows.shape[1]
+    edges = np.linspace(0, points, min(width, points) + 1).astype(np.intp)
+    firsts, widths = edges[:-1], np.diff(edges)
+    span = (np.datetime64(end, 'ms') - np.datetime64(start, 'ms')).astype(np.int64)
+    elapsed = (times - np.datetime64(start, 'ms')).astype(np.int64)
+    inside = (elapsed >= 0) & (elapsed < span)
+    grid = np.full((height, len(firsts)), np.nan, dtype=np.float32)
+    if not inside.any():
+        return grid, firsts, widths
+    rows, counts = rows[inside], counts[inside]
+    slots = elapsed[inside] * height // span
+    groups = np.flatnonzero(np.r_[True, slots[1:] != slots[:-1]])
+    if reduce == "max":
+        pooled = np.maximum.reduceat(np.maximum.reduceat(rows, firsts, axis=1), groups, axis=0)
+    else:
+        columns = np.add.reduceat(rows, firsts, axis=1, dtype=np.float64) / widths
+        pooled = np.add.reduceat(columns * counts[:, None], groups, axis=0) / np.add.reduceat(counts, groups)[:, None]
+    grid[slots[groups]] = pooled
+    return grid, firsts, widths
+
+def decode_frequencies(document, axis=None):
+    '''Return the frequency axis of a spectrumData document in MHz. axis is its spectrumAxis document.'''
+    if "trace" not in document:
+        return np.array([float(freq) for freq in document["frequencies"]])
+    return axis_frequencies(axis) / 1e6
+
+class AxisCache:
+    '''Memoize spectrumAxis lookups; axis documents never change once written.'''
+
+    def __init__(self, spectrumAxis):
+        self.spectrumAxis = spectrumAxis
+        self._axes = {}
+
+    def get(self, axis_id):
+        if axis_id not in self._axes:
+            self._axes[axis_id] = self.spectrumAxis.find_one({"_id": axis_id})
+        return self._axes[axis_id]
+
+class PassBucketer:
+    '''
+    Group packed spectrumData documents of a pass into spectrumBuckets documents.
+
+    add() takes trace documents in time order and returns the buckets that closed. One
+    bucket is open per pass and axis, so the bands of a sweep and the passes of several
+    instruments interleave without splitting each other's buckets; a bucket closes when it
+    holds max_traces traces or spans max_seconds. close() returns the open buckets, if
+    any: those of one pass (and only the given axes of it) at LOS, all of them on shutdown.
+    '''
+
+    def __init__(self, max_traces=BUCKET_TRACES, max_seconds=BUCKET_SECONDS):
+        self.max_traces = max_traces
+        self.max_seconds = max_seconds
+        self._open = {}
+
+    def add(self, document):
+        key = (document["meta"]["scheduleRunId"], document["meta"]["axisId"])
+        closed = [self._build(open_key) for open_key, rows in list(self._open.items())
+                  if (document["timestamp"] - rows[0]["timestamp"]).total_seconds() >= self.max_seconds]
+        self._open.setdefault(key, []).append(document)
+        if len(self._open[key]) >= self.max_traces:
+            closed.append(self._build(key))
+        return closed
+
+    def close(self, scheduleRunId=None, axisIds=None):
+        return [self._build(key) for key in list(self._open)
+                if scheduleRunId is None or (key[0] == scheduleRunId and (axisIds is None or key[1] in axisIds))]
+
+    def _build(self, key):
+        rows = self._open.pop(key)
+        first, start = rows[0], rows[0]["timestamp"]
+        values = np.vstack([decode_trace(row) for row in rows])
+        offsets = np.array([(row["timestamp"] - start).total_seconds() * 1000 for row in rows], dtype='<i4')
+        bucket = {
+            "scheduleRunId": first["meta"]["scheduleRunId"],
+            "axisId": first["meta"]["axisId"],
+            "sat": first["meta"]["sat"],
+            "start": start,
+            "end": rows[-1]["timestamp"],
+            "count": len(rows),
+            "encoding": first["encoding"],
+            "offsets": Binary(offsets.tobytes()),
+            "traces": Binary(b"".join(row["trace"] for row in rows)),
+            "acqStatus": int(np.bitwise_or.reduce([row["meta"].get("acqStatus", 0) for row in rows])),
+            "max": _f32(values.max(axis=0)),
+            "mean": _f32(values.mean(axis=0, dtype=np.float64)),
+        }
+        if "scale" in first:
+            bucket["scale"] = first["scale"]
+        return bucket
@@ -0,0 +1,215 @@
+from datetime import datetime, timedelta
+import json
+import logging
+import math
+import os
+import shutil
+import struct
+import zlib
+from time import sleep
+import numpy as np
+from pymongo import MongoClient, ASCENDING
+from IFSS_Storage import ensure_aggregate_collections, load_pass, pool_spectrogram
+
+# Pre-rendered spectrogram tiles for post-pass review, run as its own service (Tools/systemd/IFSS_tiles.service)
+#
+# Every completed pass (one per spectrumPassSummary document, i.e. per pass and axis) is rendered from its
+# buckets once into a pyramid of TILE_SIZE square PNG tiles in the dashboard's colour scale:
+#     TILE_DIR/<scheduleRunId>/<axisId>/manifest.json      pass, axis and pyramid geometry
+#     TILE_DIR/<scheduleRunId>/<axisId>/<level>/<row>_<column>.png
+# Level 0 has one pixel per axis point across and one per ROW_SECONDS of the pass down, newest last;
+# each further level halves both by max-hold until the pass fits one tile. Seconds without a trace are
+# transparent. TILE_DIR/days/<YYYY-MM-DD>.json lists the passes that started on that UTC day, so the
+# dashboard (/passes) browses days of passes from disk alone. A pass whose buckets are already rolled up
+# (or whose axis is missing) is marked "tiles": false on its summary and not looked at again.
+
+TILE_DIR = '/home/its/IFSS/tiles'
+TILE_SIZE = 256
+ROW_SECONDS = 1
+# The colour scale of the dashboard spectrogram: Plotly's Viridis over DBM_RANGE
+DBM_RANGE = (-140.0, -40.0)
+VIRIDIS = ["#440154", "#48186a", "#472d7b", "#424086", "#3b528b", "#33638d", "#2c728e", "#26828e", "#21918c",
+           "#1fa088", "#28ae80", "#3fbc73", "#5ec962", "#84d44b", "#addc30", "#d8e219", "#fde725"]
+# A pass is rendered once its summary is this old, so the last bucket has been written
+SETTLE_SECONDS = 120
+# Passes are looked for as far back as raw buckets are kept (IFSS_Retention.RAW_RETENTION_DAYS)
+LOOKBACK_DAYS = 7
+TILE_RETENTION_DAYS = 90
+TILE_INTERVAL = 60
+
+# MongoDB setup
+client = MongoClient('mongodb://localhost:27017/')
+db = client["ifss"]
+spectrumBuckets = db["spectrumBuckets"]
+spectrumAxis = db["spectrumAxis"]
+spectrumPassSummary = db["spectrumPassSummary"]
+
+# Reset the Root Logger and seup logging
+for handler in logging.root.handlers[:]:
+    logging.root.removeHandler(handler)
+logging.basicConfig(filename='/home/its/IFSS/IFSS_SA.log', level=logging.INFO, format='%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+def palette():
+    '''256 RGB entries: 0 is the transparent "no data" colour, 1..255 run through VIRIDIS.'''
+    stops = np.array([[int(colour[i:i + 2], 16) for i in (1, 3, 5)] for colour in VIRIDIS], dtype=np.float64)
+    positions = np.linspace(0, 1, 255)
+    anchors = np.linspace(0, 1, len(stops))
+    colours = np.column_stack([np.interp(positions, anchors, stops[:, channel]) for channel in range(3)])
+    return np.vstack([np.zeros((1, 3)), np.rint(colours)]).astype(np.uint8)
+
+PALETTE = palette()
+
+def colour_indices(grid):
+    '''dBm grid (NaN for no data) as palette indices. Indices keep the order of the dBm values, so pyramid levels max-hold them.'''
+    scaled = (np.nan_to_num(grid, nan=DBM_RANGE[0]) - DBM_RANGE[0]) / (DBM_RANGE[1] - DBM_RANGE[0])
+    indices = 1 + np.rint(np.clip(scaled, 0, 1) * 254).astype(np.uint8)
+    indices[np.isnan(grid)] = 0
+    return indices
+
+def encode_png(indices):
+    '''Palette PNG of a uint8 index image, index 0 transparent.'''
+    height, width = indices.shape
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    # Filter type 0 (none) at the start of every scanline
+    scanlines = np.hstack([np.zeros((height, 1), dtype=np.uint8), indices]).tobytes()
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0)),
+        chunk(b'PLTE', PALETTE.tobytes()),
+        chunk(b'tRNS', b'\x00'),
+        chunk(b'IDAT', zlib.compress(scanlines, 6)),
+        chunk(b'IEND', b''),
+    ])
+
+def halve(indices):
+    '''Next pyramid level: max-hold of every 2 x 2 block, odd edges padded with "no data".'''
+    height, width = indices.shape
+    padded = np.zeros((height + height % 2, width + width % 2), dtype=np.uint8)
+    padded[:height, :width] = indices
+    return padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2).max(axis=(1, 3))
+
+def pass_directory(scheduleRunId, axisId):
+    return os.path.join(TILE_DIR, str(scheduleRunId), str(axisId))
+
+def render_pass(summary):
+    '''Render the tile pyramid of one spectrumPassSummary document. Returns its manifest, or None if its buckets are gone.'''
+    scheduleRunId, axisId = summary["scheduleRunId"], summary["axisId"]
+    loaded = load_pass(spectrumBuckets, scheduleRunId, axisId)
+    axis = spectrumAxis.find_one({"_id": axisId})
+    if loaded is None or axis is None:
+        return None
+    timestamps, traces, _ = loaded
+    start = timestamps[0].astype('datetime64[s]').astype(datetime)
+    end = (timestamps[-1] + np.timedelta64(1, 's')).astype('datetime64[s]').astype(datetime)
+    rows = max(math.ceil((end - start).total_seconds() / ROW_SECONDS), 1)
+    grid, _, _ = pool_spectrogram(timestamps, traces, np.ones(len(traces)), start, end, rows, traces.shape[1])
+    indices = colour_indices(grid)
+
+    final = pass_directory(scheduleRunId, axisId)
+    building = final + '.tmp'
+    shutil.rmtree(building, ignore_errors=True)
+    level = 0
+    while True:
+        os.makedirs(os.path.join(building, str(level)))
+        for top in range(0, indices.shape[0], TILE_SIZE):
+            for left in range(0, indices.shape[1], TILE_SIZE):
+                tile = indices[top:top + TILE_SIZE, left:left + TILE_SIZE]
+                with open(os.path.join(building, str(level), f"{top // TILE_SIZE}_{left // TILE_SIZE}.png"), 'wb') as f:
+                    f.write(encode_png(tile))
+        if max(indices.shape) <= TILE_SIZE:
+            break
+        indices = halve(indices)
+        level += 1
+
+    manifest = {
+        "scheduleRunId": str(scheduleRunId),
+        "axisId": str(axisId),
+        "sat": (summary.get("sat") or "").strip(),
+        "start": start.isoformat() + "Z",
+        "end": end.isoformat() + "Z",
+        "rowSeconds": ROW_SECONDS,
+        "rows": int(grid.shape[0]),
+        "columns": int(grid.shape[1]),
+        "startFreq": axis["startFreq"],
+        "stepFreq": axis["stepFreq"],
+        "tileSize": TILE_SIZE,
+        "levels": level + 1,
+        "dbmRange": list(DBM_RANGE),
+        "colorscale": "Viridis",
+        "traces": int(len(traces)),
+    }
+    with open(os.path.join(building, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    shutil.rmtree(final, ignore_errors=True)
+    os.replace(building, final)
+    add_to_day(manifest)
+    logging.info(f"Tiles rendered for pass {scheduleRunId} axis {axisId}: {manifest['rows']} x {manifest['columns']}, {level + 1} levels")
+    return manifest
+
+def day_path(day):
+    return os.path.join(TILE_DIR, 'days', f"{day}.json")
+
+def add_to_day(manifest):
+    '''List a rendered pass in the index of the UTC day it started on.'''
+    path = day_path(manifest["start"][:10])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    passes = []
+    if os.path.exists(path):
+        with open(path) as f:
+            passes = json.load(f)
+    entry = {key: manifest[key] for key in ("scheduleRunId", "axisId", "sat", "start", "end")}
+    passes = [p for p in passes if (p["scheduleRunId"], p["axisId"]) != (entry["scheduleRunId"], entry["axisId"])] + [entry]
+    passes.sort(key=lambda p: p["start"])
+    with open(path + '.tmp', 'w') as f:
+        json.dump(passes, f)
+    os.replace(path + '.tmp', path)
+
+def prune(now):
+    '''Remove the tiles and day indexes of days older than TILE_RETENTION_DAYS.'''
+    cutoff = (now - timedelta(days=TILE_RETENTION_DAYS)).strftime('%Y-%m-%d')
+    directory = os.path.join(TILE_DIR, 'days')
+    if not os.path.isdir(directory):
+        return
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.json') or name[:10] >= cutoff:
+            continue
+        with open(os.path.join(directory, name)) as f:
+            passes = json.load(f)
+        for entry in passes:
+            shutil.rmtree(pass_directory(entry["scheduleRunId"], entry["axisId"]), ignore_errors=True)
+            try:
+                os.rmdir(os.path.join(TILE_DIR, entry["scheduleRunId"]))
+            except OSError:
+                pass
+        os.remove(os.path.join(directory, name))
+        logging.info(f"Tiles removed for {len(passes)} passes of {name[:10]}")
+
+def run_tiles():
+    now = datetime.utcnow()
+    query = {"end": {"$gte": now - timedelta(days=LOOKBACK_DAYS), "$lt": now - timedelta(seconds=SETTLE_SECONDS)}, "tiles": {"$ne": False}}
+    for summary in spectrumPassSummary.find(query, {"scheduleRunId": 1, "axisId": 1, "sat": 1}).sort("end", ASCENDING):
+        if os.path.exists(os.path.join(pass_directory(summary["scheduleRunId"], summary["axisId"]), 'manifest.json')):
+            continue
+        try:
+            if render_pass(summary) is None:
+                spectrumPassSummary.update_one({"_id": summary["_id"]}, {"$set": {"tiles": False}})
+                logging.info(f"Tiles cannot be rendered for pass {summary['scheduleRunId']} axis {summary['axisId']}, its buckets or axis are gone")
+        except Exception as e:
+            logging.error(f"Tiles could not be rendered for pass {summary['scheduleRunId']} axis {summary['axisId']}: {e}")
+    prune(now)
+
+def main():
+    logging.info("Started IFSS_Tiles")
+    ensure_aggregate_collections(db)
+    while True:
+        try:
+            run_tiles()
+        except Exception as e:
+            logging.error(f"An error occurred in IFSS_Tiles run_tiles(): {e}")
+        sleep(TILE_INTERVAL)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,534 @@
+"""
+Simulated RSA_API backend
+Drop-in replacement for the CDLL handle returned by loading libRSA_API.so, for
+benchmarking and load-testing IFSS without an instrument attached.
+
+It accepts the same ctypes arguments as the real library (byref() pointers,
+c_double/c_int/c_bool values, Structures passed by value), writes results back
+through them and returns ReturnStatus codes as ints. Traces are a noise floor
+plus configurable carriers, delivered with a realistic acquisition latency.
+
+Enable it by setting IFSS_RSA_BACKEND=sim before starting IFSS. Carriers can be
+configured with IFSS_SIM_CARRIERS as a comma separated list of
+freq_hz:power_dbm:bandwidth_hz, e.g. "137.1e6:-70:40e3,137.9125e6:-75:40e3".
+"""
+
+from ctypes import *
+from time import sleep, monotonic, time
+import os
+import numpy as np
+from RSA_API import *
+
+# Default carriers inside the 140 MHz / 15 MHz span IFSS monitors (freq Hz, power dBm, bandwidth Hz)
+DEFAULT_CARRIERS = [(137.1e6, -70.0, 40e3), (137.9125e6, -75.0, 40e3), (143.0e6, -90.0, 5e3)]
+
+# Simulated DPX frames per second and FFTs (spectrogram lines) per frame
+DPX_FRAME_RATE = 20
+DPX_LINES_PER_FRAME = 10
+DPX_BITMAP_HEIGHT = 201
+
+# IQ streaming: the ADC rate is decimated by powers of two, keeping this share of it as usable bandwidth
+IQSTREAM_BANDWIDTH_RATIO = 40e6 / 56e6
+IQSTREAM_MIN_RATE = 56e6 / 2 ** 13
+IQSTREAM_BUFFER_SIZE = 65536
+# Samples not collected within this many seconds are lost to an input buffer overflow
+IQSTREAM_BACKLOG = 1.0
+
+# RSA306B characteristics used to shape timing and noise
+TIMESTAMP_RATE = 112000000
+IQ_SAMPLE_RATE = 56e6
+MAX_SPAN = 40e6
+MIN_FREQ = 9e3
+MAX_FREQ = 6.2e9
+NOISE_FIGURE_DB = 15.0
+
+
+def _target(arg):
+    # Unwrap byref() so results can be written into the referenced object
+    return arg._obj if hasattr(arg, '_obj') else arg
+
+
+def _value(arg):
+    arg = _target(arg)
+    return arg.value if hasattr(arg, 'value') else arg
+
+
+def parse_carriers(spec):
+    carriers = []
+    for item in spec.split(','):
+        if item.strip():
+            freq, power, bandwidth = (float(part) for part in item.split(':'))
+            carriers.append((freq, power, bandwidth))
+    return carriers
+
+
+class SimulatedRSA:
+    """
+    Stand-in for rsa = CDLL("libRSA_API.so"). Only the DEVICE_*, CONFIG_*, REFTIME_*,
+    SPECTRUM_*, DPX_* and client (int16) IQSTREAM_* calls used by IFSS are implemented; anything else raises AttributeError
+    just like a missing symbol on the real library.
+    """
+
+    def __init__(self, carriers=None, num_devices=1, run_latency=0.05, transfer_latency=0.01, seed=None):
+        self.carriers = list(DEFAULT_CARRIERS if carriers is None else carriers)
+        self.num_devices = num_devices
+        self.run_latency = run_latency
+        self.transfer_latency = transfer_latency
+        self.rng = np.random.default_rng(seed)
+        self.epoch = monotonic()
+        # Reference time of timestamp 0, set from the system clock like the API does on connect
+        self.epoch_time = time()
+
+        self.connected = False
+        self.running = False
+        self.spectrum_enabled = False
+        self.center_freq = 1e9
+        self.ref_level = 0.0
+        self.settings = Spectrum_Settings()
+        self.trace_info = Spectrum_TraceInfo()
+        self.ready_at = None
+        self.acquired_at = None
+        self._set_default_settings()
+
+        self.dpx_enabled = False
+        self.dpx = DPX_SettingStruct()
+        self.dpx_span = 40e6
+        self.dpx_sogram_power = (0.0, -100.0)
+        self.dpx_bitmap_range = (0.0, -100.0)
+        self.dpx_next_frame = None
+        self.dpx_frame_count = 0
+        self.dpx_buffers = None
+
+        self.iq_sample_rate = IQ_SAMPLE_RATE
+        self.iq_streaming = False
+        self.iq_next_sample = 0
+        self.iq_started_at = None
+
+        # Expose each API call as a plain function so callers can set .restype/.argtypes on it
+        for name in dir(self):
+            if name.split('_')[0] in ('DEVICE', 'CONFIG', 'REFTIME', 'SPECTRUM', 'DPX', 'IQSTREAM'):
+                setattr(self, name, self._export(getattr(self, name)))
+
+    @classmethod
+    def from_env(cls):
+        carriers = os.environ.get('IFSS_SIM_CARRIERS')
+        return cls(carriers=parse_carriers(carriers) if carriers else None,
+                   num_devices=int(os.environ.get('IFSS_SIM_DEVICES', 1)))
+
+    @staticmethod
+    def _export(method):
+        def call(*args):
+            return method(*args)
+        call.__name__ = method.__name__
+        return call
+
+    def _set_default_settings(self):
+        self.settings.span = 40e6
+        self.settings.rbw = 300e3
+        self.settings.enableVBW = False
+        self.settings.vbw = 300e3
+        self.settings.traceLength = 801
+        self.settings.window = SpectrumWindows.SpectrumWindow_Kaiser.value
+        self.settings.verticalUnit = SpectrumVerticalUnits.SpectrumVerticalUnit_dBm.value
+        self._update_actual_settings()
+
+    def _update_actual_settings(self):
+        s = self.settings
+        s.actualStartFreq = self.center_freq - s.span / 2
+        s.actualStopFreq = self.center_freq + s.span / 2
+        s.actualFreqStepSize = s.span / (s.traceLength - 1)
+        s.actualRBW = s.rbw
+        s.actualVBW = s.vbw
+        # A Hann/Kaiser window needs roughly 2/RBW seconds of IQ for the requested resolution
+        s.actualNumIQSamples = 2.0 * IQ_SAMPLE_RATE / s.rbw
+
+    def _acquisition_time(self):
+        return self.settings.actualNumIQSamples / IQ_SAMPLE_RATE + self.transfer_latency
+
+    ################ DEVICE ################
+    def DEVICE_GetAPIVersion(self, apiVersion):
+        _target(apiVersion).value = b'SIM 1.0'
+        return ReturnStatus.noError.value
+
+    def DEVICE_GetErrorString(self, status):
+        return ReturnStatus(_value(status)).name.encode()
+
+    def DEVICE_Search(self, numFound, deviceIDs, deviceSerial, deviceType):
+        _target(numFound).value = self.num_devices
+        for i in range(self.num_devices):
+            _target(deviceIDs)[i] = i
+        _target(deviceSerial).value = b'SIM000001'
+        _target(deviceType).value = b'RSA306B'
+        return ReturnStatus.noError.value
+
+    def DEVICE_Connect(self, deviceID):
+        if not 0 <= _value(deviceID) < self.num_devices:
+            return ReturnStatus.errorNotConnected.value
+        self.connected = True
+        return ReturnStatus.noError.value
+
+    def DEVICE_Disconnect(self):
+        self.connected = False
+        self.running = False
+        return ReturnStatus.noError.value
+
+    def DEVICE_Reset(self, deviceID):
+        self.DEVICE_Disconnect()
+        return ReturnStatus.noError.value
+
+    def DEVICE_Run(self):
+        if not self.connected:
+            return ReturnStatus.errorNotConnected.value
+        if not self.running:
+            # Restarting the acquisition pipeline is the expensive part of DEVICE_Run
+            sleep(self.run_latency)
+            self.running = True
+        return ReturnStatus.noError.value
+
+    def DEVICE_Stop(self):
+        self.running = False
+        self.iq_streaming = False
+        self.ready_at = None
+        return ReturnStatus.noError.value
+
+    def DEVICE_GetEnable(self, enable):
+        _target(enable).value = self.running
+        return ReturnStatus.noError.value
+
+    ################ CONFIG ################
+    def CONFIG_Preset(self):
+        self.center_freq = 1.5e9
+        self.ref_level = 0.0
+        self._set_default_settings()
+        return ReturnStatus.noError.value
+
+    def CONFIG_SetCenterFreq(self, cf):
+        cf = _value(cf)
+        if not MIN_FREQ <= cf <= MAX_FREQ:
+            return ReturnStatus.errorFrequencyOutOfRange.value
+        self.center_freq = cf
+        self._update_actual_settings()
+        return ReturnStatus.noError.value
+
+    def CONFIG_GetCenterFreq(self, cf):
+        if not self.connected:
+            return ReturnStatus.errorNotConnected.value
+        _target(cf).value = self.center_freq
+        return ReturnStatus.noError.value
+
+    def CONFIG_SetReferenceLevel(self, refLevel):
+        self.ref_level = _value(refLevel)
+        return ReturnStatus.noError.value
+
+    def CONFIG_GetReferenceLevel(self, refLevel):
+        _target(refLevel).value = self.ref_level
+        return ReturnStatus.noError.value
+
+    ################ REFTIME ################
+    def REFTIME_GetTimestampRate(self, rate):
+        _target(rate).value = TIMESTAMP_RATE
+        return ReturnStatus.noError.value
+
+    def REFTIME_GetCurrentTime(self, secs, nsecs, timestamp):
+        now = monotonic() - self.epoch
+        _target(timestamp).value = int(now * TIMESTAMP_RATE)
+        return self.REFTIME_GetTimeFromTimestamp(int(now * TIMESTAMP_RATE), secs, nsecs)
+
+    def REFTIME_GetTimeFromTimestamp(self, timestamp, secs, nsecs):
+        ticks = _value(timestamp)
+        whole, rest = divmod(ticks, TIMESTAMP_RATE)
+        _target(secs).value = int(self.epoch_time) + whole
+        _target(nsecs).value = int((self.epoch_time % 1) * 1e9) + rest * 1000000000 // TIMESTAMP_RATE
+        if _target(nsecs).value >= 1000000000:
+            _target(secs).value += 1
+            _target(nsecs).value -= 1000000000
+        return ReturnStatus.noError.value
+
+    ################ SPECTRUM ################
+    def SPECTRUM_SetEnable(self, enable):
+        self.spectrum_enabled = bool(_value(enable))
+        return ReturnStatus.noError.value
+
+    def SPECTRUM_SetDefault(self):
+        self._set_default_settings()
+        return ReturnStatus.noError.value
+
+    def SPECTRUM_GetLimits(self, limits):
+        limits = _target(limits)
+        limits.maxSpan = MAX_SPAN
+        limits.minSpan = 1e3
+        limits.maxRBW = 10e6
+        limits.minRBW = 10.0
+        limits.maxVBW = 10e6
+        limits.minVBW = 1.0
+        limits.maxTraceLength = 64001
+        limits.minTraceLength = 801
+        return ReturnStatus.noError.value
+
+    def SPECTRUM_SetSettings(self, settings):
+        settings = _target(settings)
+        if settings.span > MAX_SPAN or settings.traceLength < 2:
+            return ReturnStatus.errorParameter.value
+        if settings.span < settings.rbw:
+            return ReturnStatus.errorSpanIsLessThanRBW.value
+        for name, _ in Spectrum_Settings._fields_:
+            setattr(self.settings, name, getattr(settings, name))
+        self._update_actual_settings()
+        return ReturnStatus.noError.value
+
+    def SPECTRUM_GetSettings(self, settings):
+        settings = _target(settings)
+        for name, _ in Spectrum_Settings._fields_:
+            setattr(settings, name, getattr(self.settings, name))
+        return ReturnStatus.noError.value
+
+    def SPECTRUM_AcquireTrace(self):
+        if not self.spectrum_enabled:
+            return ReturnStatus.errorMeasurementNotEnabled.value
+        self.acquired_at = monotonic()
+        self.ready_at = self.acquired_at + self._acquisition_time()
+        return ReturnStatus.noError.value
+
+    def SPECTRUM_WaitForDataReady(self, timeoutMsec, ready):
+        if not self.connected:
+            return ReturnStatus.errorNotConnected.value
+        timeout = _value(timeoutMsec) / 1000.0
+        if not self.running or self.ready_at is None:
+            # A stopped device never completes a trace, exactly like the hardware
+            sleep(timeout)
+            _target(ready).value = False
+            return ReturnStatus.noError.value
+        remaining = self.ready_at - monotonic()
+        if remaining > 0:
+            sleep(min(remaining, timeout))
+        _target(ready).value = monotonic() >= self.ready_at
+        return ReturnStatus.noError.value
+
+    def SPECTRUM_GetTrace(self, trace, maxTracePoints, traceData, outTracePoints):
+        if self.ready_at is None or monotonic() < self.ready_at:
+            return ReturnStatus.errorDataNotReady.value
+        points = min(_value(maxTracePoints), self.settings.traceLength)
+        out = np.ctypeslib.as_array(_target(traceData))
+        out[:points] = self.synthesize_trace()[:points]
+        _target(outTracePoints).value = points
+
+        status = 0
+        if any(power > self.ref_level for _, power, _ in self.carriers):
+            status |= AcqDataStatus_ADC_OVERRANGE
+        self.trace_info.timestamp = int((self.acquired_at - self.epoch) * TIMESTAMP_RATE)
+        self.trace_info.acqDataStatus = status
+        self.ready_at = None
+        return ReturnStatus.noError.value
+
+    def SPECTRUM_GetTraceInfo(self, traceInfo):
+        traceInfo = _target(traceInfo)
+        traceInfo.timestamp = self.trace_info.timestamp
+        traceInfo.acqDataStatus = self.trace_info.acqDataStatus
+        return ReturnStatus.noError.value
+
+    def synthesize_trace(self, freqs=None, rbw=None):
+        """Return one dBm trace: thermal noise at the RBW plus Gaussian-shaped carriers."""
+        s = self.settings
+        if freqs is None:
+            freqs = s.actualStartFreq + np.arange(s.traceLength) * s.actualFreqStepSize
+        rbw = s.actualRBW if rbw is None else rbw
+        noise_floor_dbm = -174.0 + 10 * np.log10(rbw) + NOISE_FIGURE_DB
+        power_mw = 10 ** (noise_floor_dbm / 10) * self.rng.exponential(1.0, len(freqs))
+        for freq, power, bandwidth in self.carriers:
+            sigma = max(bandwidth, rbw) / 2.355
+            power_mw += 10 ** (power / 10) * np.exp(-0.5 * ((freqs - freq) / sigma) ** 2)
+        return (10 * np.log10(power_mw)).astype(np.float32)
+
+    ################ DPX ################
+    def DPX_SetEnable(self, enable):
+        self.dpx_enabled = bool(_value(enable))
+        return ReturnStatus.noError.value
+
+    def DPX_Reset(self):
+        self.dpx_next_frame = None
+        self.dpx_frame_count = 0
+        return ReturnStatus.noError.value
+
+    def DPX_SetParameters(self, fspan, rbw, bitmapWidth, tracePtsPerPixel, yUnit, yTop, yBottom,
+                          infinitePersistence, persistenceTimeSec, showOnlyTrigFrame):
+        if _value(fspan) > MAX_SPAN or _value(rbw) <= 0:
+            return ReturnStatus.errorParameter.value
+        self.dpx_span = _value(fspan)
+        self.dpx.bitmapWidth = _value(bitmapWidth)
+        self.dpx.bitmapHeight = DPX_BITMAP_HEIGHT
+        self.dpx.traceLength = _value(bitmapWidth) * _value(tracePtsPerPixel)
+        self.dpx.actualRBW = _value(rbw)
+        self.dpx.decayFactor = 0.0
+        self.dpx_bitmap_range = (_value(yTop), _value(yBottom))
+        return ReturnStatus.noError.value
+
+    def DPX_SetSogramParameters(self, timePerBitmapLine, timeResolution, maxPower, minPower):
+        self.dpx_sogram_power = (_value(maxPower), _value(minPower))
+        return ReturnStatus.noError.value
+
+    def DPX_Configure(self, enableSpectrum, enableSpectrogram):
+        self.dpx.enableSpectrum = bool(_value(enableSpectrum))
+        self.dpx.enableSpectrogram = bool(_value(enableSpectrogram))
+        return ReturnStatus.noError.value
+
+    def DPX_SetSpectrumTraceType(self, traceIndex, traceType):
+        # Traces 1-3 are always delivered as max, min and average of the frame
+        return ReturnStatus.noError.value
+
+    def DPX_GetSettings(self, settings):
+        memmove(byref(_target(settings)), byref(self.dpx), sizeof(DPX_SettingStruct))
+        return ReturnStatus.noError.value
+
+    def DPX_WaitForDataReady(self, timeoutMsec, ready):
+        if not self.connected:
+            return ReturnStatus.errorNotConnected.value
+        timeout = _value(timeoutMsec) / 1000.0
+        if not self.running or not self.dpx_enabled:
+            sleep(timeout)
+            _target(ready).value = False
+            return ReturnStatus.noError.value
+        if self.dpx_next_frame is None:
+            self.dpx_next_frame = monotonic() + 1.0 / DPX_FRAME_RATE
+        remaining = self.dpx_next_frame - monotonic()
+        if remaining > 0:
+            sleep(min(remaining, timeout))
+        _target(ready).value = monotonic() >= self.dpx_next_frame
+        return ReturnStatus.noError.value
+
+    def DPX_IsFrameBufferAvailable(self, available):
+        _target(available).value = self.dpx_next_frame is not None and monotonic() >= self.dpx_next_frame
+        return ReturnStatus.noError.value
+
+    def DPX_GetFrameBuffer(self, frameBuffer):
+        if self.dpx_next_frame is None or monotonic() < self.dpx_next_frame:
+            return ReturnStatus.errorDataNotReady.value
+        d = self.dpx
+        freqs = self.center_freq - self.dpx_span / 2 + np.arange(d.traceLength) * self.dpx_span / max(d.traceLength - 1, 1)
+        lines_dbm = np.vstack([self.synthesize_trace(freqs, d.actualRBW) for _ in range(DPX_LINES_PER_FRAME)])
+        lines_w = 10 ** ((lines_dbm - 30) / 10)
+        max_power, min_power = self.dpx_sogram_power
+        sogram = np.clip((lines_dbm[:, ::max(d.traceLength // d.bitmapWidth, 1)] - min_power) / (max_power - min_power) * 255, 0, 255).astype(np.uint8)
+        traces = [np.ascontiguousarray(lines_w.max(axis=0), dtype=np.float32),
+                  np.ascontiguousarray(lines_w.min(axis=0), dtype=np.float32),
+                  np.ascontiguousarray(lines_w.mean(axis=0), dtype=np.float32)]
+        # Hit density in % of the frame's lines per (dBm row from yTop down, column)
+        top, bottom = self.dpx_bitmap_range
+        columns = lines_dbm[:, ::max(d.traceLength // d.bitmapWidth, 1)][:, :d.bitmapWidth]
+        rows = np.clip(np.rint((top - columns) / (top - bottom) * (d.bitmapHeight - 1)), 0, d.bitmapHeight - 1).astype(np.intp)
+        bitmap = np.zeros((d.bitmapHeight, d.bitmapWidth), dtype=np.float32)
+        np.add.at(bitmap, (rows, np.broadcast_to(np.arange(columns.shape[1]), rows.shape)), np.float32(100.0 / DPX_LINES_PER_FRAME))
+        bitmap = bitmap.ravel()
+        trace_pointers = (POINTER(c_float) * 3)(*(trace.ctypes.data_as(POINTER(c_float)) for trace in traces))
+        timestamps = np.zeros(DPX_LINES_PER_FRAME, dtype=np.float64)
+        # The buffers stay referenced until the next frame, like the API's own until DPX_FinishFrameBuffer
+        self.dpx_buffers = (traces, bitmap, sogram, trace_pointers, timestamps)
+
+        fb = _target(frameBuffer)
+        self.dpx_frame_count += 1
+        fb.fftPerFrame = DPX_LINES_PER_FRAME
+        fb.fftCount = self.dpx_frame_count * DPX_LINES_PER_FRAME
+        fb.frameCount = self.dpx_frame_count
+        fb.timestamp = monotonic() - self.epoch
+        fb.acqDataStatus = AcqDataStatus_ADC_OVERRANGE if any(power > self.ref_level for _, power, _ in self.carriers) else 0
+        fb.minSigDuration = 1.0 / DPX_FRAME_RATE / DPX_LINES_PER_FRAME
+        fb.minSigDurOutOfRange = False
+        fb.spectrumBitmapWidth = d.bitmapWidth
+        fb.spectrumBitmapHeight = d.bitmapHeight
+        fb.spectrumBitmapSize = bitmap.size
+        fb.spectrumTraceLength = d.traceLength
+        fb.numSpectrumTraces = 3
+        fb.spectrumEnabled = d.enableSpectrum
+        fb.spectrogramEnabled = d.enableSpectrogram
+        fb.spectrumBitmap = bitmap.ctypes.data_as(POINTER(c_float))
+        fb.spectrumTraces = cast(trace_pointers, POINTER(POINTER(c_float)))
+        fb.sogramBitmapWidth = sogram.shape[1]
+        fb.sogramBitmapHeight = sogram.shape[0]
+        fb.sogramBitmapSize = sogram.size
+        fb.sogramBitmapNumValidLines = sogram.shape[0]
+        fb.sogramBitmap = sogram.ctypes.data_as(POINTER(c_uint8))
+        fb.sogramBitmapTimestampArray = timestamps.ctypes.data_as(POINTER(c_double))
+        fb.sogramBitmapContainTriggerArray = timestamps.ctypes.data_as(POINTER(c_double))
+        return ReturnStatus.noError.value
+
+    def DPX_FinishFrameBuffer(self):
+        self.dpx_next_frame += 1.0 / DPX_FRAME_RATE
+        return ReturnStatus.noError.value
+
+    ################ IQSTREAM ################
+    def IQSTREAM_SetAcqBandwidth(self, bwHz_req):
+        bandwidth = _value(bwHz_req)
+        if not 0 < bandwidth <= MAX_SPAN:
+            return ReturnStatus.errorParameter.value
+        rate = IQ_SAMPLE_RATE
+        while rate / 2 * IQSTREAM_BANDWIDTH_RATIO >= bandwidth and rate / 2 >= IQSTREAM_MIN_RATE:
+            rate /= 2
+        self.iq_sample_rate = rate
+        return ReturnStatus.noError.value
+
+    def IQSTREAM_GetAcqParameters(self, bwHz_act, srSps):
+        _target(bwHz_act).value = self.iq_sample_rate * IQSTREAM_BANDWIDTH_RATIO
+        _target(srSps).value = self.iq_sample_rate
+        return ReturnStatus.noError.value
+
+    def IQSTREAM_SetOutputConfiguration(self, dest, dtype):
+        # Only the client int16 output IFSS streams is simulated
+        if _value(dest) != IQSOUTDEST.IQSOD_CLIENT.value or _value(dtype) != IQSOUTDTYPE.IQSODT_INT16.value:
+            return ReturnStatus.errorParameter.value
+        return ReturnStatus.noError.value
+
+    def IQSTREAM_GetIQDataBufferSize(self, maxSize):
+        _target(maxSize).value = IQSTREAM_BUFFER_SIZE
+        return ReturnStatus.noError.value
+
+    def IQSTREAM_Start(self):
+        if not self.connected:
+            return ReturnStatus.errorNotConnected.value
+        self.iq_streaming = True
+        self.iq_next_sample = 0
+        self.iq_started_at = monotonic()
+        return ReturnStatus.noError.value
+
+    def IQSTREAM_Stop(self):
+        self.iq_streaming = False
+        return ReturnStatus.noError.value
+
+    def IQSTREAM_GetIQData(self, iqdata, iqlen, iqinfo):
+        if not self.connected:
+            return ReturnStatus.errorNotConnected.value
+        info = _target(iqinfo)
+        _target(iqlen).value = 0
+        if not self.iq_streaming or not self.running:
+            return ReturnStatus.noError.value
+        rate = self.iq_sample_rate
+        available = int((monotonic() - self.iq_started_at) * rate) - self.iq_next_sample
+        status = 0
+        if available > IQSTREAM_BACKLOG * rate:
+            # Not collected in time, the oldest samples are gone
+            self.iq_next_sample += available - IQSTREAM_BUFFER_SIZE
+            available = IQSTREAM_BUFFER_SIZE
+            status |= IQSTRM_STATUS_IBUFFOVFLOW | IQSTRM_STATUS_IBUFFOVFLOW << IQSTRM_STATUS_STICKY_SHIFT
+        if available < IQSTREAM_BUFFER_SIZE:
+            return ReturnStatus.noError.value
+
+        count = IQSTREAM_BUFFER_SIZE
+        t = (self.iq_next_sample + np.arange(count)) / rate
+        noise_mw = 10 ** ((-174.0 + NOISE_FIGURE_DB + 10 * np.log10(rate)) / 10)
+        # 10 * |V|^2 is the power in mW of a complex sample in volts
+        iq = self.rng.normal(0, np.sqrt(noise_mw / 20), (count, 2)).view(np.complex128)[:, 0]
+        for freq, power, _ in self.carriers:
+            offset = freq - self.center_freq
+            if abs(offset) < rate / 2:
+                iq += np.sqrt(10 ** (power / 10) / 10) * np.exp(2j * np.pi * offset * t)
+        scale = np.sqrt(10 ** (self.ref_level / 10) / 10) / 32767
+        counts = np.stack([iq.real, iq.imag], axis=1) / scale
+        if np.abs(counts).max() > 32767:
+            status |= IQSTRM_STATUS_OVERRANGE | IQSTRM_STATUS_OVERRANGE << IQSTRM_STATUS_STICKY_SHIFT
+        np.ctypeslib.as_array(_target(iqdata))[:2 * count] = np.clip(np.rint(counts), -32768, 32767).ravel()
+
+        info.timestamp = int((self.iq_started_at - self.epoch + self.iq_next_sample / rate) * TIMESTAMP_RATE)
+        info.triggerCount = 0
+        info.scaleFactor = scale
+        info.acqStatus = status
+        self.iq_next_sample += count
+        _target(iqlen).value = count
+        return ReturnStatus.noError.value
@@ -6,12 +6,17 @@ import sys
 from datetime import datetime
 import matplotlib.pyplot as plt
 import pandas as pd 
-# import os
+import os
 
 RTLD_LAZY = 0x0001
 LAZYLOAD = RTLD_LAZY | RTLD_GLOBAL
-rsa = CDLL("./libRSA_API.so",LAZYLOAD)
-usbapi = CDLL("./libcyusb_shared.so",LAZYLOAD)
+if os.environ.get("IFSS_RSA_BACKEND") == "sim":
+    # Simulated instrument for hardware-free testing, see RSA_SIM.py
+    from RSA_SIM import SimulatedRSA
+    rsa = SimulatedRSA.from_env()
+else:
+    rsa = CDLL("./libRSA_API.so",LAZYLOAD)
+    usbapi = CDLL("./libcyusb_shared.so",LAZYLOAD)
 
 # rsa = cdll.LoadLibrary("C:\\Tektronix\\RSA_API\\lib\\x64\\RSA_API.dll")
 
@@ -2,6 +2,7 @@ from ctypes import *
 from time import sleep
 from RSA_API import *
 import sys
+import os
 from datetime import datetime
 from pymongo import MongoClient
 from pymongo.errors import ConnectionFailure
@@ -14,8 +15,13 @@ satSchedule = db["satSchedule"]
 
 RTLD_LAZY = 0x0001
 LAZYLOAD = RTLD_LAZY | RTLD_GLOBAL
-rsa = CDLL("/home/its/IFSS/Tools/lib/libRSA_API.so", LAZYLOAD)
-usbapi = CDLL("/home/its/IFSS/Tools/lib/libcyusb_shared.so", LAZYLOAD)
+if os.environ.get("IFSS_RSA_BACKEND") == "sim":
+    # Simulated instrument for hardware-free benchmarking, see RSA_SIM.py
+    from RSA_SIM import SimulatedRSA
+    rsa = SimulatedRSA.from_env()
+else:
+    rsa = CDLL("/home/its/IFSS/Tools/lib/libRSA_API.so", LAZYLOAD)
+    usbapi = CDLL("/home/its/IFSS/Tools/lib/libcyusb_shared.so", LAZYLOAD)
 
 err_check =0 
 
@@ -118,7 +124,7 @@ def spectrum_capture(specSet, freq_list_mhz):
         print(f'Trace {cycle}: ')
         trace = acquire_spectrum(specSet)
         print(f'Trace {cycle}: ')
-        currentTime = datetime.today().isoformat(sep=' ', timespec='milliseconds')
+        currentTime = datetime.utcnow()
 
         # Create a document for MongoDB and insert into thew collection
         frequencies = {str(round(freq, 4)): float(value) for freq, value in zip(freq_list_mhz, trace)}
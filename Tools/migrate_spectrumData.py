@@ -0,0 +1,140 @@
+"""
+One-shot migration of spectrumData to the time-series schema (see IFSS_Storage.py).
+
+The existing regular collection is renamed to spectrumData_legacy, spectrumData is
+recreated as a time-series collection keyed by a UTC datetime, and every legacy
+document is copied across:
+    * ISO string timestamps written with datetime.today() are local time of the
+      capture machine and are converted to UTC (override with --utc-offset)
+    * {"frequencies": {MHz: dBm}} documents are packed into float32 blobs with a
+      shared spectrumAxis document
+    * packed documents with a top level axisId get it moved into meta
+
+Progress is recorded after every batch, so an interrupted run can simply be
+restarted; the first batch of a run skips documents that are already copied, in
+case the previous run stopped between inserting a batch and recording it. Stop
+IFSS before running it.
+
+    python3 Tools/migrate_spectrumData.py [--batch 1000] [--utc-offset HOURS] [--drop-legacy]
+"""
+
+import argparse
+import logging
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+import numpy as np
+from pymongo import MongoClient, ASCENDING
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from IFSS_Storage import ensure_spectrum_collection, upsert_axis, encode_trace
+
+LEGACY = "spectrumData_legacy"
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+def to_utc(timestamp, utc_offset):
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+        if utc_offset is None:
+            # Naive local time of this machine, the same clock the capture used
+            return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+        return timestamp - timedelta(hours=utc_offset)
+    return timestamp
+
+def convert(document, spectrumAxis, axis_ids, utc_offset):
+    converted = {"_id": document["_id"], "timestamp": to_utc(document["timestamp"], utc_offset)}
+    if "frequencies" in document:
+        freqs_mhz = [float(freq) for freq in document["frequencies"]]
+        values = np.fromiter(document["frequencies"].values(), dtype=np.float32)
+        key = (len(freqs_mhz), freqs_mhz[0], freqs_mhz[-1])
+        if key not in axis_ids:
+            start, stop, length = freqs_mhz[0] * 1e6, freqs_mhz[-1] * 1e6, len(freqs_mhz)
+            axis_ids[key] = upsert_axis(spectrumAxis, {
+                "startFreq": start,
+                "stepFreq": (stop - start) / (length - 1) if length > 1 else 0.0,
+                "length": length,
+                "centerFreq": (start + stop) / 2,
+                "span": stop - start,
+                "rbw": None,
+                "refLevel": None,
+            })
+        converted["meta"] = {"axisId": axis_ids[key], "scheduleRunId": None, "sat": None}
+        converted.update(encode_trace(values))
+    else:
+        converted["meta"] = document.get("meta") or {"axisId": document.get("axisId"), "scheduleRunId": None, "sat": None}
+        for field in ("encoding", "scale", "trace"):
+            if field in document:
+                converted[field] = document[field]
+    return converted
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate spectrumData to a time-series collection")
+    parser.add_argument("--mongo", default="mongodb://localhost:27017/")
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--utc-offset", type=float, default=None, help="hours the legacy string timestamps are ahead of UTC (default: this machine's local zone)")
+    parser.add_argument("--drop-legacy", action="store_true", help="drop spectrumData_legacy once everything is copied")
+    args = parser.parse_args()
+
+    db = MongoClient(args.mongo)["ifss"]
+    migrations = db["migrations"]
+    spectrumAxis = db["spectrumAxis"]
+
+    names = db.list_collection_names()
+    info = next(db.list_collections(filter={"name": "spectrumData"}), None)
+    if info is not None and info.get("type") != "timeseries":
+        if LEGACY in names:
+            sys.exit(f"Both spectrumData and {LEGACY} are regular collections, resolve manually")
+        db["spectrumData"].rename(LEGACY)
+        logging.info(f"Renamed spectrumData to {LEGACY}")
+    elif LEGACY not in names:
+        logging.info("spectrumData is already a time-series collection and there is nothing to migrate")
+        return
+
+    spectrumData = ensure_spectrum_collection(db)
+    legacy = db[LEGACY]
+    state = migrations.find_one({"_id": "spectrumData_timeseries"}) or {}
+    query = {"_id": {"$gt": state["lastId"]}} if "lastId" in state else {}
+    total = legacy.count_documents(query)
+    logging.info(f"Migrating {total} documents from {LEGACY}")
+
+    axis_ids = {}
+    batch = []
+    copied = 0
+    # Time-series collections do not enforce a unique _id, the batch after lastId may already be there
+    verify = True
+    for document in legacy.find(query).sort("_id", ASCENDING):
+        batch.append(convert(document, spectrumAxis, axis_ids, args.utc_offset))
+        if len(batch) >= args.batch:
+            copied += flush(spectrumData, migrations, batch, verify)
+            verify = False
+            logging.info(f"{copied}/{total} documents migrated")
+    copied += flush(spectrumData, migrations, batch, verify)
+    logging.info(f"Migration finished, {copied} documents copied")
+
+    if args.drop_legacy:
+        legacy.drop()
+        logging.info(f"Dropped {LEGACY}")
+
+def flush(spectrumData, migrations, batch, verify=False):
+    if not batch:
+        return 0
+    documents = batch
+    if verify:
+        # Same lookup as IFSS_Pipeline.TraceWriter._spool_sink, kept on the timestamp index
+        query = {"_id": {"$in": [document["_id"] for document in batch]},
+                 "timestamp": {"$gte": min(document["timestamp"] for document in batch),
+                               "$lte": max(document["timestamp"] for document in batch)}}
+        existing = {document["_id"] for document in spectrumData.find(query, {"_id": 1})}
+        documents = [document for document in batch if document["_id"] not in existing]
+        if existing:
+            logging.info(f"Skipped {len(existing)} documents copied by the interrupted run")
+    if documents:
+        spectrumData.insert_many(documents, ordered=False)
+    migrations.update_one({"_id": "spectrumData_timeseries"}, {"$set": {"lastId": batch[-1]["_id"], "updated": datetime.utcnow()}}, upsert=True)
+    count = len(batch)
+    batch.clear()
+    return count
+
+if __name__ == "__main__":
+    main()
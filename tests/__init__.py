@@ -0,0 +1,3 @@
+# Unit tests of the host-side modules that need neither an analyzer nor a MongoDB server:
+#     python3 -m pytest tests
+# Tests that exercise MongoDB queries run against mongomock and are skipped where it is not installed.
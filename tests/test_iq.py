@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from IFSS_IQ import welch, spectrum_bins, to_complex
+
+SAMPLE_RATE = 1e6
+RBW = 1e3
+
+def tone(offset, dbm, samples):
+    '''Complex tone `offset` Hz from the centre reading `dbm` into 50 ohm.'''
+    amplitude = np.sqrt(10 ** (dbm / 10) / 10)
+    return (amplitude * np.exp(2j * np.pi * offset * np.arange(samples) / SAMPLE_RATE)).astype(np.complex64)
+
+def test_spectrum_bins_match_rbw_and_bandwidth():
+    nfft, keep, offsets = spectrum_bins(SAMPLE_RATE, RBW, bandwidth=200e3)
+    # Hann window: 1.5 bins of equivalent noise bandwidth
+    assert nfft == 1500
+    assert np.all(np.abs(offsets) <= 100e3) and offsets[0] < -99e3 and offsets[-1] > 99e3
+    assert len(offsets) == keep.stop - keep.start
+
+def test_welch_reads_tone_power_in_its_bin():
+    nfft, _, _ = spectrum_bins(SAMPLE_RATE, RBW)
+    offset = 100 * SAMPLE_RATE / nfft
+    offsets, dbm = welch(tone(offset, -30.0, 20 * nfft), SAMPLE_RATE, RBW)
+    peak = np.argmax(dbm)
+    assert offsets[peak] == pytest.approx(offset)
+    assert dbm[peak] == pytest.approx(-30.0, abs=0.01)
+    # Hann sidelobes are far below the tone a few bins away
+    assert np.max(np.delete(dbm, range(peak - 3, peak + 4))) < -90
+
+def test_welch_trims_to_bandwidth():
+    offsets, dbm = welch(tone(0, -50.0, 10000), SAMPLE_RATE, RBW, bandwidth=100e3)
+    assert len(offsets) == len(dbm)
+    assert np.all(np.abs(offsets) <= 50e3)
+    assert dbm[np.argmin(np.abs(offsets))] == pytest.approx(-50.0, abs=0.01)
+
+def test_welch_needs_one_full_segment():
+    with pytest.raises(ValueError):
+        welch(np.zeros(1499, dtype=np.complex64), SAMPLE_RATE, RBW)
+
+def test_to_complex_scales_interleaved_pairs():
+    pairs = np.array([100, -200, 0, 32767], dtype=np.int16)
+    np.testing.assert_allclose(to_complex(pairs, 1e-3), [0.1 - 0.2j, 32.767j], rtol=1e-6)
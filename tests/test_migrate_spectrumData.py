@@ -0,0 +1,51 @@
+from datetime import datetime
+import numpy as np
+import pytest
+from bson.objectid import ObjectId
+from IFSS_Storage import decode_trace
+from Tools.migrate_spectrumData import to_utc, convert, flush
+
+mongomock = pytest.importorskip("mongomock")
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient()["ifss"]
+
+def test_to_utc_applies_offset_to_strings_only():
+    assert to_utc("2024-03-01T01:30:00", 2) == datetime(2024, 2, 29, 23, 30)
+    assert to_utc("2024-03-01T01:30:00", -5.5) == datetime(2024, 3, 1, 7, 0)
+    stored = datetime(2024, 3, 1, 1, 30)
+    assert to_utc(stored, 2) is stored
+
+def test_convert_packs_frequencies_onto_a_shared_axis(db):
+    axis_ids = {}
+    frequencies = {"1700.0": -90.5, "1700.5": -91.0, "1701.0": -89.25}
+    documents = [{"_id": ObjectId(), "timestamp": "2024-03-01T12:00:00", "frequencies": dict(frequencies)} for _ in range(2)]
+    converted = [convert(document, db["spectrumAxis"], axis_ids, 0) for document in documents]
+
+    assert db["spectrumAxis"].count_documents({}) == 1
+    axis = db["spectrumAxis"].find_one()
+    assert axis["startFreq"] == 1700e6 and axis["stepFreq"] == 0.5e6 and axis["length"] == 3
+    for document, original in zip(converted, documents):
+        assert document["_id"] == original["_id"]
+        assert document["timestamp"] == datetime(2024, 3, 1, 12)
+        assert document["meta"] == {"axisId": axis["_id"], "scheduleRunId": None, "sat": None}
+        np.testing.assert_array_equal(decode_trace(document), np.array(list(frequencies.values()), dtype=np.float32))
+
+def test_convert_moves_top_level_axis_id_into_meta(db):
+    axisId = ObjectId()
+    document = {"_id": ObjectId(), "timestamp": datetime(2024, 3, 1), "axisId": axisId, "encoding": "float32", "trace": b"\x00" * 8}
+    converted = convert(document, db["spectrumAxis"], {}, None)
+    assert converted["meta"]["axisId"] == axisId
+    assert converted["trace"] == document["trace"] and "axisId" not in converted
+
+def test_flush_records_progress_and_skips_copied_documents(db):
+    spectrumData, migrations = db["spectrumData"], db["migrations"]
+    batch = [{"_id": ObjectId(), "timestamp": datetime(2024, 3, 1, 0, 0, second)} for second in range(4)]
+    # An interrupted run that inserted half the batch before it could record it
+    spectrumData.insert_many([dict(document) for document in batch[:2]])
+
+    assert flush(spectrumData, migrations, list(batch), verify=True) == 4
+    assert spectrumData.count_documents({}) == 4
+    assert migrations.find_one({"_id": "spectrumData_timeseries"})["lastId"] == batch[-1]["_id"]
+    assert flush(spectrumData, migrations, [], verify=True) == 0
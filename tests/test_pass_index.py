@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+import pytest
+from IFSS_Scheduler import EventScheduler, PassIndex, row_window
+
+def schedule_row(item, sat, aos, los, fmt='%Y-%m-%d'):
+    '''A schedule.csv row: ITEM, satellite, three unused columns, then AOS and LOS date and time.'''
+    return [item, sat, "", "", "", aos.strftime(fmt), aos.strftime('%H:%M:%S'), los.strftime(fmt), los.strftime('%H:%M:%S')]
+
+def upcoming(minutes, duration=10):
+    aos = (datetime.utcnow() + timedelta(minutes=minutes)).replace(microsecond=0)
+    return aos, aos + timedelta(minutes=duration)
+
+def test_row_window_parses_both_date_formats():
+    aos, los = datetime(2024, 3, 1, 10, 0), datetime(2024, 3, 1, 10, 12, 30)
+    assert row_window(schedule_row("1", "NOAA 19", aos, los)) == (aos, los)
+    assert row_window(schedule_row("1", "NOAA 19", aos, los, fmt='%d-%b-%Y')) == (aos, los)
+    with pytest.raises(ValueError):
+        row_window(["1", "NOAA 19", "", "", "", "01/03/2024", "10:00:00", "01/03/2024", "10:12:30"])
+
+def test_row_window_rolls_los_over_midnight():
+    # The schedule carries the AOS date on both columns of a pass that spans midnight
+    row = ["7", "METOP-B", "", "", "", "2024-02-29", "23:55:00", "2024-02-29", "00:07:00"]
+    assert row_window(row) == (datetime(2024, 2, 29, 23, 55), datetime(2024, 3, 1, 0, 7))
+
+def test_merge_schedules_new_passes_with_prepare_lead():
+    scheduler = EventScheduler()
+    index = PassIndex(scheduler, "capture", prepare="prepare", lead=timedelta(minutes=2))
+    aos, los = upcoming(30)
+    row = schedule_row("1", "NOAA 19", aos, los)
+    assert index.merge([row]) == 1
+    assert index.passes() == [(aos, los, row)]
+    assert [(event.when, event.action) for event in scheduler.pending()] == [(aos - timedelta(minutes=2), "prepare"), (aos, "capture")]
+
+def test_merge_skips_past_distant_and_unparseable_rows():
+    scheduler = EventScheduler()
+    index = PassIndex(scheduler, "capture", window=timedelta(hours=48))
+    rows = [
+        schedule_row("1", "NOAA 19", *upcoming(-30)),
+        schedule_row("2", "NOAA 18", *upcoming(49 * 60)),
+        ["3", "NOAA 15", "", "", "", "soon"],
+        schedule_row("4", "METOP-B", *upcoming(60)),
+    ]
+    assert index.merge(rows) == 1
+    assert [row[0] for _, _, row in index.passes()] == ["4"]
+
+def test_merge_of_a_refresh_reschedules_only_moved_passes():
+    scheduler = EventScheduler()
+    index = PassIndex(scheduler, "capture")
+    first, second = upcoming(30), upcoming(90)
+    assert index.merge([schedule_row("1", "NOAA 19", *first), schedule_row("2", "NOAA 18", *second)]) == 2
+    original = scheduler.pending()
+
+    # Item 1 unchanged, item 2 moved by a minute, item 1 again under another satellite is a new pass
+    moved = (second[0] + timedelta(minutes=1), second[1] + timedelta(minutes=1))
+    refresh = [schedule_row("1", "NOAA 19", *first), schedule_row("2", "NOAA 18", *moved), schedule_row("1", "NOAA 15", *first)]
+    assert index.merge(refresh) == 2
+    pending = scheduler.pending()
+    assert original[0] in pending and original[1] not in pending
+    assert sorted(event.when for event in pending) == sorted([first[0], first[0], moved[0]])
+
+def test_merge_keeps_passes_missing_from_a_refresh_and_clear_cancels_them():
+    scheduler = EventScheduler()
+    index = PassIndex(scheduler, "capture")
+    index.merge([schedule_row("1", "NOAA 19", *upcoming(30))])
+    assert index.merge([]) == 0
+    assert len(index.passes()) == 1 and len(scheduler.pending()) == 1
+
+    index.clear()
+    assert index.passes() == [] and scheduler.pending() == []
+    # A merge after clear() schedules the pass afresh
+    assert index.merge([schedule_row("1", "NOAA 19", *upcoming(30))]) == 1
+
+def test_merge_leaves_a_pass_under_way_alone():
+    scheduler = EventScheduler()
+    index = PassIndex(scheduler, "capture")
+    aos, los = upcoming(-1)
+    index.merge([schedule_row("1", "NOAA 19", aos, los)])
+    assert index.merge([schedule_row("1", "NOAA 19", aos, los + timedelta(minutes=5))]) == 0
+    assert index.passes()[0][:2] == (aos, los)
@@ -0,0 +1,64 @@
+import threading
+from datetime import datetime, timedelta
+import pytest
+from IFSS_Scheduler import EventScheduler
+
+def test_events_run_in_due_order_and_on_time():
+    scheduler = EventScheduler()
+    ran = []
+    start = datetime.utcnow()
+    for name, delay in (("late", 0.15), ("early", 0.05), ("middle", 0.1)):
+        scheduler.schedule(start + timedelta(seconds=delay), name, lambda name=name: ran.append((name, datetime.utcnow())))
+    scheduler.run(until_empty=True)
+
+    assert [name for name, _ in ran] == ["early", "middle", "late"]
+    for name, delay in (("early", 0.05), ("middle", 0.1), ("late", 0.15)):
+        assert 0 <= scheduler.latencies[name] < 0.05
+        assert dict(ran)[name] >= start + timedelta(seconds=delay)
+
+def test_same_time_events_keep_scheduling_order():
+    scheduler = EventScheduler()
+    ran = []
+    when = datetime.utcnow()
+    for n in range(5):
+        scheduler.schedule(when, f"event {n}", ran.append, n)
+    scheduler.run(until_empty=True)
+    assert ran == list(range(5))
+
+def test_cancelled_events_do_not_run():
+    scheduler = EventScheduler()
+    ran = []
+    now = datetime.utcnow()
+    kept = scheduler.schedule(now + timedelta(seconds=0.05), "kept", ran.append, "kept")
+    dropped = scheduler.schedule(now, "dropped", ran.append, "dropped")
+    scheduler.cancel(dropped)
+    assert scheduler.pending() == [kept]
+    scheduler.run(until_empty=True)
+    assert ran == ["kept"] and "dropped" not in scheduler.latencies
+
+def test_schedule_from_another_thread_wakes_the_runner():
+    scheduler = EventScheduler()
+    done = threading.Event()
+    runner = threading.Thread(target=scheduler.run, daemon=True)
+    runner.start()
+    # The runner is idle on an empty queue and must not wait out MAX_SLEEP
+    scheduler.schedule(datetime.utcnow() + timedelta(seconds=0.05), "wake", done.set)
+    assert done.wait(1)
+    scheduler.stop()
+    runner.join(1)
+    assert not runner.is_alive()
+
+def test_action_errors_are_logged_unless_propagated():
+    def fail():
+        raise RuntimeError("capture failed")
+    scheduler = EventScheduler()
+    ran = []
+    scheduler.schedule(datetime.utcnow(), "fail", fail)
+    scheduler.schedule(datetime.utcnow(), "after", ran.append, "after")
+    scheduler.run(until_empty=True)
+    assert ran == ["after"]
+
+    scheduler = EventScheduler(propagate_errors=True)
+    scheduler.schedule(datetime.utcnow(), "fail", fail)
+    with pytest.raises(RuntimeError):
+        scheduler.run(until_empty=True)
@@ -0,0 +1,66 @@
+import pytest
+from IFSS_Spool import TraceSpool
+
+class Sink:
+    '''Collects replayed records; fails while `failing` is set, like a MongoDB write that raised.'''
+
+    def __init__(self):
+        self.records = []
+        self.failing = False
+
+    def __call__(self, collection_name, documents, verify):
+        if self.failing:
+            raise ConnectionError("MongoDB unavailable")
+        self.records.extend((collection_name, document["n"], verify) for document in documents)
+
+@pytest.fixture
+def spool(tmp_path):
+    spool = TraceSpool(str(tmp_path / "spool"), segment_size=4096)
+    yield spool
+    spool.close()
+
+def test_replay_hands_records_over_in_order(spool):
+    sink = Sink()
+    spool.append("spectrumData", [{"n": n} for n in range(3)])
+    spool.append("scheduleRun", [{"n": 3}])
+    spool.append("spectrumData", [{"n": 4}])
+    assert spool.pending()
+
+    assert spool.replay(sink, limit=2) == 2
+    assert spool.replay(sink, verify=True) == 3
+    assert sink.records == [("spectrumData", 0, False), ("spectrumData", 1, False),
+                            ("spectrumData", 2, True), ("scheduleRun", 3, True), ("spectrumData", 4, True)]
+    assert not spool.pending()
+    assert spool.replay(sink) == 0
+
+def test_failed_sink_keeps_records(spool):
+    sink = Sink()
+    documents = [{"n": n} for n in range(3)]
+    spool.append("spectrumData", documents)
+    assert all("_id" in document for document in documents)
+
+    sink.failing = True
+    with pytest.raises(ConnectionError):
+        spool.replay(sink)
+    assert spool.pending()
+    sink.failing = False
+    assert spool.replay(sink) == 3
+    assert [record[1] for record in sink.records] == [0, 1, 2]
+
+def test_replay_across_segments_and_reopen(tmp_path):
+    directory = str(tmp_path / "spool")
+    spool = TraceSpool(directory, segment_size=4096)
+    padding = "x" * 1000
+    spool.append("spectrumData", [{"n": n, "padding": padding} for n in range(10)])
+    sink = Sink()
+    assert spool.replay(sink, limit=4) == 4
+    spool.close()
+
+    # A restart resumes from the cursor, records spread over several segments
+    spool = TraceSpool(directory, segment_size=4096)
+    assert spool.pending()
+    spool.append("spectrumData", [{"n": 10}])
+    assert spool.replay(sink) == 7
+    assert [record[1] for record in sink.records] == list(range(11))
+    assert not spool.pending()
+    spool.close()
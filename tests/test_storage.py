@@ -0,0 +1,81 @@
+from datetime import datetime, timedelta
+import numpy as np
+from bson.objectid import ObjectId
+from IFSS_Storage import PassBucketer, TraceAccumulator, SKETCH_RESOLUTION, encode_trace, decode_bucket, decode_aggregate, decode_percentiles
+
+START = datetime(2024, 3, 1, 12)
+
+def trace_document(scheduleRunId, axisId, second, value=-100.0, acqStatus=0, length=4):
+    document = {
+        "timestamp": START + timedelta(seconds=second),
+        "meta": {"scheduleRunId": scheduleRunId, "axisId": axisId, "sat": "NOAA 19", "acqStatus": acqStatus},
+    }
+    document.update(encode_trace(np.full(length, value, dtype=np.float32)))
+    return document
+
+def test_bucketer_closes_at_max_traces():
+    bucketer = PassBucketer(max_traces=3, max_seconds=60)
+    run, axis = ObjectId(), ObjectId()
+    closed = [bucket for second in range(7) for bucket in bucketer.add(trace_document(run, axis, second, value=-100.0 + second))]
+    assert [bucket["count"] for bucket in closed] == [3, 3]
+    tail = bucketer.close()
+    assert [bucket["count"] for bucket in tail] == [1] and bucketer.close() == []
+
+    timestamps, traces = decode_bucket(closed[1])
+    assert list(timestamps) == [np.datetime64(START + timedelta(seconds=second), 'ms') for second in (3, 4, 5)]
+    np.testing.assert_array_equal(traces[:, 0], [-97.0, -96.0, -95.0])
+    np.testing.assert_array_equal(np.frombuffer(closed[1]["max"], dtype="<f4"), np.full(4, -95.0, dtype=np.float32))
+
+def test_bucketer_closes_at_max_seconds_and_ors_status():
+    bucketer = PassBucketer(max_traces=100, max_seconds=10)
+    run, axis = ObjectId(), ObjectId()
+    assert bucketer.add(trace_document(run, axis, 0, acqStatus=1)) == []
+    assert bucketer.add(trace_document(run, axis, 5, acqStatus=4)) == []
+    closed = bucketer.add(trace_document(run, axis, 10))
+    assert len(closed) == 1
+    assert closed[0]["count"] == 2 and closed[0]["acqStatus"] == 5
+    assert closed[0]["end"] == START + timedelta(seconds=5)
+
+def test_bucketer_keeps_passes_and_axes_apart():
+    bucketer = PassBucketer(max_traces=100, max_seconds=60)
+    runA, runB, axis1, axis2 = ObjectId(), ObjectId(), ObjectId(), ObjectId()
+    for second in range(4):
+        for run in (runA, runB):
+            for axis in (axis1, axis2):
+                assert bucketer.add(trace_document(run, axis, second)) == []
+
+    closed = bucketer.close(scheduleRunId=runA, axisIds=[axis1])
+    assert [(bucket["scheduleRunId"], bucket["axisId"], bucket["count"]) for bucket in closed] == [(runA, axis1, 4)]
+    closed = bucketer.close(scheduleRunId=runA)
+    assert [(bucket["scheduleRunId"], bucket["axisId"]) for bucket in closed] == [(runA, axis2)]
+    assert {bucket["scheduleRunId"] for bucket in bucketer.close()} == {runB}
+
+def test_accumulator_matches_numpy_statistics():
+    traces = np.random.default_rng(19).normal(-100.0, 6.0, size=(500, 8)).astype(np.float32)
+    accumulator = TraceAccumulator(8)
+    for second, trace in enumerate(traces):
+        accumulator.add(trace, START + timedelta(seconds=second))
+
+    assert accumulator.count == 500
+    assert (accumulator.start, accumulator.end) == (START, START + timedelta(seconds=499))
+    np.testing.assert_allclose(accumulator.mean, traces.mean(axis=0, dtype=np.float64), atol=1e-9)
+    np.testing.assert_allclose(accumulator.std(), traces.std(axis=0, ddof=1, dtype=np.float64), rtol=1e-9)
+    np.testing.assert_array_equal(accumulator.max, traces.max(axis=0))
+    np.testing.assert_array_equal(accumulator.min, traces.min(axis=0))
+    for p, values in accumulator.percentiles((10, 50, 90)).items():
+        assert np.all(np.abs(values - np.percentile(traces, p, axis=0)) <= SKETCH_RESOLUTION)
+
+def test_accumulator_document_round_trips():
+    accumulator = TraceAccumulator(4)
+    assert np.all(accumulator.std() == 0)
+    accumulator.add(np.full(4, -90.0, dtype=np.float32), START)
+    accumulator.add(np.full(4, -80.0, dtype=np.float32), START + timedelta(seconds=1))
+    document = accumulator.document(ObjectId(), ObjectId(), "NOAA 19")
+
+    minimum, mean, maximum = decode_aggregate(document)
+    np.testing.assert_array_equal(minimum, np.full(4, -90.0, dtype=np.float32))
+    np.testing.assert_array_equal(mean, np.full(4, -85.0, dtype=np.float32))
+    np.testing.assert_array_equal(maximum, np.full(4, -80.0, dtype=np.float32))
+    percentiles = decode_percentiles(document)
+    assert np.all(np.abs(percentiles[10] + 90.0) <= SKETCH_RESOLUTION)
+    assert np.all(np.abs(percentiles[90] + 80.0) <= SKETCH_RESOLUTION)